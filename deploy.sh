@@ -188,6 +188,7 @@ echo "RDS_INSTANCE_CLASS: $RDS_INSTANCE_CLASS"
 echo "RDS_ALLOCATED_STORAGE_GB: $RDS_ALLOCATED_STORAGE_GB"
 echo "REDIS_NODE_TYPE: $REDIS_NODE_TYPE"
 echo "REDIS_NUM_CACHE_CLUSTERS: $REDIS_NUM_CACHE_CLUSTERS"
+echo "MIDDLEWARE_SESSION_REDIS_ENABLED: $MIDDLEWARE_SESSION_REDIS_ENABLED"
 echo "DISABLE_SWAGGER_PAGE: $DISABLE_SWAGGER_PAGE"
 echo "DISABLE_ADMIN_UI: $DISABLE_ADMIN_UI"
 echo "LANGFUSE_PUBLIC_KEY: $LANGFUSE_PUBLIC_KEY"
@@ -367,6 +368,7 @@ export TF_VAR_rds_instance_class=$RDS_INSTANCE_CLASS
 export TF_VAR_rds_allocated_storage=$RDS_ALLOCATED_STORAGE_GB
 export TF_VAR_redis_node_type=$REDIS_NODE_TYPE
 export TF_VAR_redis_num_cache_clusters=$REDIS_NUM_CACHE_CLUSTERS
+export TF_VAR_middleware_session_redis_enabled=${MIDDLEWARE_SESSION_REDIS_ENABLED:-false}
 export TF_VAR_disable_swagger_page=$DISABLE_SWAGGER_PAGE
 export TF_VAR_disable_admin_ui=$DISABLE_ADMIN_UI
 export TF_VAR_langfuse_public_key=$LANGFUSE_PUBLIC_KEY
@@ -45,6 +45,7 @@ module "ecs_cluster" {
   redis_host = module.base.RedisHost
   redis_port = module.base.RedisPort
   redis_password = module.base.RedisPassword
+  middleware_session_redis_enabled = var.middleware_session_redis_enabled
   log_bucket_arn = var.log_bucket_arn
   ecr_litellm_repository_url = module.base.LiteLLMRepositoryUrl
   ecr_middleware_repository_url = module.base.MiddlewareRepositoryUrl
@@ -144,6 +145,7 @@ module "eks_cluster" {
   redis_host = module.base.RedisHost
   redis_port = module.base.RedisPort
   redis_password = module.base.RedisPassword
+  middleware_session_redis_enabled = var.middleware_session_redis_enabled
   log_bucket_arn = var.log_bucket_arn
   ecr_litellm_repository_url = module.base.LiteLLMRepositoryUrl
   ecr_middleware_repository_url = module.base.MiddlewareRepositoryUrl
@@ -60,6 +60,12 @@ variable "redis_password" {
   type        = string
 }
 
+variable "middleware_session_redis_enabled" {
+  description = "Whether the middleware serves active chat history sessions from Redis"
+  type        = string
+  default     = "false"
+}
+
 variable "openai_api_key" {
   description = "OpenAI API key"
   type        = string
@@ -234,6 +234,31 @@ resource "kubernetes_deployment" "litellm" {
             value = var.okta_audience
           }
 
+          env {
+            name  = "SESSION_REDIS_ENABLED"
+            value = var.middleware_session_redis_enabled
+          }
+
+          env {
+            name  = "REDIS_HOST"
+            value = var.redis_host
+          }
+
+          env {
+            name  = "REDIS_PORT"
+            value = var.redis_port
+          }
+
+          env {
+            name  = "REDIS_PASSWORD"
+            value = var.redis_password
+          }
+
+          env {
+            name  = "REDIS_SSL"
+            value = "True"
+          }
+
           env {
             name  = "AWS_REGION"
             value = data.aws_region.current.name
@@ -70,6 +70,12 @@ variable "redis_password" {
   type        = string
 }
 
+variable "middleware_session_redis_enabled" {
+  description = "Whether the middleware serves active chat history sessions from Redis"
+  type        = string
+  default     = "false"
+}
+
 variable "database_url" {
   description = "Database connection URL"
   type        = string
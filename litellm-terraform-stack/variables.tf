@@ -366,6 +366,12 @@ variable "redis_num_cache_clusters" {
   description = "The number of cache clusters for Redis"
 }
 
+variable "middleware_session_redis_enabled" {
+  type        = string
+  description = "Whether the middleware serves active chat history sessions from Redis"
+  default     = "false"
+}
+
 variable "disable_swagger_page" {
   type    = bool
   description = "Whether to disable the swagger page or not"
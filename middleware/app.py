@@ -10,40 +10,101 @@ import boto3
 import re
 import os
 import uuid
+import fcntl
+import gzip
+import hmac
+import io
+import tempfile
+from datetime import datetime, timezone
 from sqlalchemy import (
     create_engine,
     MetaData,
     Table,
     Column,
+    Integer,
     String,
     Text,
     inspect,
     text,
 )
+from sqlalchemy.engine import make_url
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.sql import select, insert, update
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.sql import select
 import hashlib
 from okta_jwt_verifier import AccessTokenVerifier
 from okta_jwt_verifier.jwt_utils import JWTUtils
 from fastapi.middleware.cors import CORSMiddleware
-import aiohttp
+from starlette.background import BackgroundTask
+import time
+import asyncio
+from collections import OrderedDict
 from contextlib import asynccontextmanager
 from anyio import to_thread
 
-app = FastAPI()
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Allows all origins
-    allow_credentials=True,
-    allow_methods=["*"],  # Allows all methods
-    allow_headers=["*"],  # Allows all headers
-    expose_headers=["X-Session-Id"],  # Expose the X-Session-Id header
+from middleware_metrics import LATENCY_MS_BUCKETS, metrics
+from session_store import (
+    MODEL_KEY,
+    BatchingSessionStore,
+    CachedSessionStore,
+    ChatHistory,
+    DatabaseStoreProtocol,
+    DeferredHistoryStore,
+    HistoryCodec,
+    HistoryWriter,
+    InvalidCursor,
+    JsonbSessionStore,
+    MessageTableSessionStore,
+    RedisSessionStore,
+    ReplicaRoutingStore,
+    SessionCache,
+    SessionStore,
+    SessionStoreProtocol,
+    SqliteSessionStore,
+    deferred_writes,
+    last_model,
+    replica_reads_allowed,
+    stored_message_count,
 )
 
 LITELLM_ENDPOINT = "http://localhost:4000"
 LITELLM_CHAT = f"{LITELLM_ENDPOINT}/v1/chat/completions"
 
+# Connection pool shared by every call from the middleware to the LiteLLM sidecar.
+LITELLM_MAX_CONNECTIONS = int(os.environ.get("LITELLM_MAX_CONNECTIONS", "1000"))
+LITELLM_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.environ.get("LITELLM_MAX_KEEPALIVE_CONNECTIONS", "200")
+)
+LITELLM_KEEPALIVE_EXPIRY = float(os.environ.get("LITELLM_KEEPALIVE_EXPIRY", "60"))
+LITELLM_CONNECT_TIMEOUT = float(os.environ.get("LITELLM_CONNECT_TIMEOUT", "5"))
+LITELLM_POOL_TIMEOUT = float(os.environ.get("LITELLM_POOL_TIMEOUT", "30"))
+
+
+def env_timeout(name: str, default: str) -> Optional[float]:
+    # An empty value or "none" disables the read timeout for that route
+    value = os.environ.get(name, default)
+    if value.strip().lower() in ("", "none"):
+        return None
+    return float(value)
+
+
+# Per-route read timeouts (seconds) for requests to LiteLLM
+LITELLM_TIMEOUTS = {
+    "health": env_timeout("LITELLM_HEALTH_TIMEOUT", "5"),
+    "converse": env_timeout("LITELLM_CONVERSE_TIMEOUT", "155"),
+    "chat": env_timeout("LITELLM_CHAT_TIMEOUT", "300"),
+    "stream": env_timeout("LITELLM_STREAM_TIMEOUT", "none"),
+    "management": env_timeout("LITELLM_MANAGEMENT_TIMEOUT", "30"),
+    "compaction": env_timeout("LITELLM_COMPACTION_TIMEOUT", "120"),
+}
+
+# AsyncOpenAI clients used by the Bedrock converse-stream path, cached per API key
+OPENAI_CLIENT_CACHE_SIZE = int(os.environ.get("OPENAI_CLIENT_CACHE_SIZE", "256"))
+OPENAI_CLIENT_IDLE_SECONDS = float(os.environ.get("OPENAI_CLIENT_IDLE_SECONDS", "300"))
+
+litellm_client: Optional[httpx.AsyncClient] = None
+
 print(f"AWS_REGION: {os.getenv('AWS_REGION')}")
 print(f"AWS_DEFAULT_REGION: {os.getenv('AWS_DEFAULT_REGION')}")
 bedrock_client = boto3.client("bedrock-agent")
@@ -51,6 +112,217 @@ bedrock_client = boto3.client("bedrock-agent")
 db_engine = None
 metadata = MetaData()
 chat_sessions = None
+chat_messages = None
+chat_message_contents = None
+chat_session_summaries = None
+session_store = None
+history_compactor = None
+
+# "blob" keeps the whole conversation in chat_sessions.chat_history (rewritten every
+# turn). "messages" stores one chat_messages row per message and only inserts the new
+# ones each turn; existing blob sessions are migrated the first time they are read.
+# "jsonb" keeps the conversation in chat_sessions.chat_history_jsonb and appends new
+# messages server side, converting legacy Text blobs on their first append.
+# Switching from "messages" or "jsonb" back to "blob" is not supported.
+# "sqlite" keeps sessions in an embedded SQLite database file (SQLITE_DATABASE_PATH)
+# instead of Postgres, for single-node deployments and load tests: no
+# DATABASE_MIDDLEWARE_URL is needed. Sessions are not carried over between SQLite and
+# Postgres, except through /middleware/sessions/export and import.
+CHAT_HISTORY_STORAGE = os.environ.get("CHAT_HISTORY_STORAGE", "blob").lower()
+CHAT_HISTORY_MIGRATION_BATCH_SIZE = int(
+    os.environ.get("CHAT_HISTORY_MIGRATION_BATCH_SIZE", "100")
+)
+# "messages" mode only: message contents of at least this many characters are stored
+# once in chat_message_contents, keyed by their SHA-256, and the chat_messages rows
+# reference them. A system prompt or few-shot block shared by many sessions is then
+# one row instead of one copy per session. 0 stores every content inline.
+CHAT_MESSAGE_DEDUPE_MIN_LENGTH = int(
+    os.environ.get("CHAT_MESSAGE_DEDUPE_MIN_LENGTH", "0")
+)
+# "blob" mode only: histories whose JSON is at least this many bytes are stored zstd
+# compressed in chat_history_compressed instead of as text in chat_history. 0 stores
+# every history as text. Rows already compressed stay readable with this at 0, and
+# are converted back to text when the middleware starts in another storage mode.
+CHAT_HISTORY_COMPRESSION_MIN_BYTES = int(
+    os.environ.get("CHAT_HISTORY_COMPRESSION_MIN_BYTES", "0")
+)
+CHAT_HISTORY_COMPRESSION_LEVEL = int(
+    os.environ.get("CHAT_HISTORY_COMPRESSION_LEVEL", "3")
+)
+# Optional zstd dictionary file trained on chat history JSON (see
+# scripts/history_compression_benchmark.py --save-dictionary). Rows compressed with
+# it can only be read while the same dictionary is configured.
+CHAT_HISTORY_COMPRESSION_DICTIONARY = os.environ.get(
+    "CHAT_HISTORY_COMPRESSION_DICTIONARY"
+)
+# "sqlite" mode only: the database file, shared by the workers of the node, the most
+# writes its writer thread commits in one transaction, and the reads run at once
+# (each on its own connection)
+SQLITE_DATABASE_PATH = os.environ.get("SQLITE_DATABASE_PATH", "middleware.db")
+SQLITE_WRITE_MAX_BATCH_SIZE = int(os.environ.get("SQLITE_WRITE_MAX_BATCH_SIZE", "100"))
+SQLITE_READ_THREADS = int(os.environ.get("SQLITE_READ_THREADS", "8"))
+# How long a statement waits for another worker's writer to release the write lock
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# Per-worker cache of recently used sessions, bounded by approximate size in bytes.
+# 0 disables it. Another worker or task serving the same session is not seen by this
+# cache until the entry expires, so only enable it when a session's turns are served
+# by the same worker (for example a single worker, or sticky routing).
+SESSION_CACHE_MAX_BYTES = int(os.environ.get("SESSION_CACHE_MAX_BYTES", "0"))
+SESSION_CACHE_TTL_SECONDS = float(os.environ.get("SESSION_CACHE_TTL_SECONDS", "60"))
+
+# Optional Redis tier for active sessions, shared by every worker and task. Turns are
+# appended to Redis and a background flusher persists them to Postgres.
+SESSION_REDIS_ENABLED = (
+    os.environ.get("SESSION_REDIS_ENABLED", "false").lower() == "true"
+)
+REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
+REDIS_PASSWORD = os.environ.get("REDIS_PASSWORD") or None
+REDIS_SSL = os.environ.get("REDIS_SSL", "false").lower() == "true"
+SESSION_REDIS_TTL_SECONDS = int(os.environ.get("SESSION_REDIS_TTL_SECONDS", "3600"))
+SESSION_REDIS_FLUSH_INTERVAL = float(
+    os.environ.get("SESSION_REDIS_FLUSH_INTERVAL", "1.0")
+)
+SESSION_REDIS_FLUSH_BATCH_SIZE = int(
+    os.environ.get("SESSION_REDIS_FLUSH_BATCH_SIZE", "100")
+)
+
+# Group commit: history writes from concurrent requests are collected by one writer
+# task per worker and committed together, waiting at most HISTORY_WRITE_MAX_DELAY_MS
+# for up to HISTORY_WRITE_MAX_BATCH_SIZE sessions.
+HISTORY_GROUP_COMMIT_ENABLED = (
+    os.environ.get("HISTORY_GROUP_COMMIT_ENABLED", "false").lower() == "true"
+)
+HISTORY_WRITE_MAX_BATCH_SIZE = int(
+    os.environ.get("HISTORY_WRITE_MAX_BATCH_SIZE", "100")
+)
+HISTORY_WRITE_MAX_DELAY_MS = float(os.environ.get("HISTORY_WRITE_MAX_DELAY_MS", "5"))
+
+# When a turn's history is persisted relative to its response:
+#   sync           - before the response is returned (default)
+#   after-response - in a background task once the handler has returned
+#   async-batched  - like after-response, but through the group-commit writer
+# Deferred writes to one session run in order, and reading a session waits for its
+# pending writes, so the next turn sees the previous one. A worker only knows its own
+# writes, so the deferred modes need SESSION_REDIS_ENABLED, where sessions with
+# writes pending on any worker are marked, or HISTORY_SESSION_AFFINITY=true to
+# declare that every turn of a session is served by the same worker (a single
+# worker, or sticky routing). Reads wait at most HISTORY_PENDING_WAIT_SECONDS for
+# another worker's writes.
+HISTORY_DURABILITY = os.environ.get("HISTORY_DURABILITY", "sync").lower()
+HISTORY_SESSION_AFFINITY = (
+    os.environ.get("HISTORY_SESSION_AFFINITY", "false").lower() == "true"
+)
+HISTORY_DEFERRED_MAX_PENDING = int(
+    os.environ.get("HISTORY_DEFERRED_MAX_PENDING", "1000")
+)
+HISTORY_WRITE_MAX_RETRIES = int(os.environ.get("HISTORY_WRITE_MAX_RETRIES", "3"))
+HISTORY_PENDING_WAIT_SECONDS = float(
+    os.environ.get("HISTORY_PENDING_WAIT_SECONDS", "5")
+)
+
+# Token budget for the history sent to the model on history-enabled turns; the full
+# history is still stored. 0 sends everything. MAX_HISTORY_TOKENS_BY_KEY is a JSON
+# object mapping API key hashes (as in chat_sessions.api_key_hash) to a budget, and
+# a request can set its own with "max_history_tokens".
+MAX_HISTORY_TOKENS = int(os.environ.get("MAX_HISTORY_TOKENS", "0"))
+MAX_HISTORY_TOKENS_BY_KEY = json.loads(
+    os.environ.get("MAX_HISTORY_TOKENS_BY_KEY", "{}")
+)
+# Stored with every history message so it is only measured once
+TOKEN_COUNT_KEY = "token_count"
+# Bookkeeping kept in stored messages but never sent upstream or to clients
+STORED_ONLY_KEYS = (TOKEN_COUNT_KEY, MODEL_KEY)
+
+# /session-ids pages, newest activity first. Requests without paging parameters
+# still get every session_id, read SESSION_LIST_MAX_LIMIT at a time.
+SESSION_LIST_DEFAULT_LIMIT = int(os.environ.get("SESSION_LIST_DEFAULT_LIMIT", "1000"))
+SESSION_LIST_MAX_LIMIT = int(os.environ.get("SESSION_LIST_MAX_LIMIT", "1000"))
+
+# Full-history responses for sessions with at least this many messages are encoded
+# and sent incrementally from a server-side cursor instead of built in memory
+HISTORY_STREAM_MIN_MESSAGES = int(os.environ.get("HISTORY_STREAM_MIN_MESSAGES", "500"))
+HISTORY_STREAM_FETCH_SIZE = int(os.environ.get("HISTORY_STREAM_FETCH_SIZE", "100"))
+HISTORY_STREAM_CHUNK_BYTES = 64 * 1024
+
+# Most session IDs accepted by one /chat-history/batch call
+HISTORY_BATCH_MAX_SESSIONS = int(os.environ.get("HISTORY_BATCH_MAX_SESSIONS", "1000"))
+
+# Admin export/import of chat_sessions: sessions per cursor fetch (and per Parquet
+# row group) and sessions per COPY transaction
+SESSION_EXPORT_FETCH_SIZE = int(os.environ.get("SESSION_EXPORT_FETCH_SIZE", "1000"))
+SESSION_IMPORT_BATCH_SIZE = int(os.environ.get("SESSION_IMPORT_BATCH_SIZE", "1000"))
+# Parquet bodies are spooled to disk past this size, since Parquet is read footer first
+SESSION_IMPORT_SPOOL_BYTES = 64 * 1024 * 1024
+
+# Compaction: once a session's stored history passes the threshold, a background
+# task summarizes all but the newest HISTORY_COMPACTION_KEEP_TOKENS of it with
+# HISTORY_COMPACTION_MODEL. Turns send the summary in place of the turns it covers
+# once it is ready, and the raw history otherwise.
+HISTORY_COMPACTION_ENABLED = (
+    os.environ.get("HISTORY_COMPACTION_ENABLED", "false").lower() == "true"
+)
+HISTORY_COMPACTION_MODEL = os.environ.get("HISTORY_COMPACTION_MODEL", "")
+HISTORY_COMPACTION_THRESHOLD_TOKENS = int(
+    os.environ.get("HISTORY_COMPACTION_THRESHOLD_TOKENS", "8000")
+)
+HISTORY_COMPACTION_KEEP_TOKENS = int(
+    os.environ.get("HISTORY_COMPACTION_KEEP_TOKENS", "2000")
+)
+HISTORY_COMPACTION_CONCURRENCY = int(
+    os.environ.get("HISTORY_COMPACTION_CONCURRENCY", "2")
+)
+HISTORY_COMPACTION_MAX_QUEUE = int(
+    os.environ.get("HISTORY_COMPACTION_MAX_QUEUE", "1000")
+)
+# Key used for summarization calls; defaults to the key of the session's owner
+HISTORY_COMPACTION_API_KEY = os.environ.get("HISTORY_COMPACTION_API_KEY")
+
+# Session expiry: a session idle (no history write) for longer than its TTL is
+# deleted by a background reaper. 0 keeps sessions forever. SESSION_TTL_BY_KEY is
+# a JSON object mapping API key hashes to a TTL in seconds (0 = never expire).
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", "0"))
+SESSION_TTL_BY_KEY = json.loads(os.environ.get("SESSION_TTL_BY_KEY", "{}"))
+SESSION_REAPER_INTERVAL_SECONDS = float(
+    os.environ.get("SESSION_REAPER_INTERVAL_SECONDS", "60")
+)
+# Sessions deleted per transaction, and the pause between full batches
+SESSION_REAPER_BATCH_SIZE = int(os.environ.get("SESSION_REAPER_BATCH_SIZE", "500"))
+SESSION_REAPER_BATCH_PAUSE_SECONDS = float(
+    os.environ.get("SESSION_REAPER_BATCH_PAUSE_SECONDS", "0.1")
+)
+# Archive expired sessions to this S3 bucket before deleting them. The endpoint URL
+# is only needed for S3-compatible stores such as MinIO.
+SESSION_ARCHIVE_BUCKET = os.environ.get("SESSION_ARCHIVE_BUCKET")
+SESSION_ARCHIVE_PREFIX = os.environ.get("SESSION_ARCHIVE_PREFIX", "chat-sessions/")
+SESSION_ARCHIVE_ENDPOINT_URL = os.environ.get("SESSION_ARCHIVE_ENDPOINT_URL")
+
+# Create chat_sessions hash-partitioned on session_id into this many partitions, so
+# writes, indexes and vacuum are spread over smaller tables. 0 keeps a plain table.
+# The count is fixed once the table exists. Converting an existing plain table
+# rewrites it under an exclusive lock, so it also needs
+# CHAT_SESSIONS_MIGRATE_TO_PARTITIONED=true.
+CHAT_SESSIONS_PARTITIONS = int(os.environ.get("CHAT_SESSIONS_PARTITIONS", "0"))
+CHAT_SESSIONS_MIGRATE_TO_PARTITIONED = (
+    os.environ.get("CHAT_SESSIONS_MIGRATE_TO_PARTITIONED", "false").lower() == "true"
+)
+
+# Pool for the async (asyncpg) engine that serves chat history in request handlers
+DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", "10"))
+DATABASE_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW", "20"))
+DATABASE_POOL_TIMEOUT = float(os.environ.get("DATABASE_POOL_TIMEOUT", "30"))
+DATABASE_POOL_RECYCLE = int(os.environ.get("DATABASE_POOL_RECYCLE", "1800"))
+
+# Optional read replica of the middleware database, in the same form as
+# DATABASE_MIDDLEWARE_URL. History reads go to it when it can't return a stale turn.
+DATABASE_REPLICA_URL = os.environ.get("DATABASE_REPLICA_URL")
+# How long a read of the replica's replay position is reused
+REPLICA_LSN_REFRESH_SECONDS = float(
+    os.environ.get("REPLICA_LSN_REFRESH_SECONDS", "0.05")
+)
+# Sessions whose last write position each worker remembers
+REPLICA_TRACKED_SESSIONS = int(os.environ.get("REPLICA_TRACKED_SESSIONS", "100000"))
 
 OKTA_ISSUER = os.environ.get("OKTA_ISSUER")
 OKTA_AUDIENCE = os.environ.get("OKTA_AUDIENCE")
@@ -68,6 +340,114 @@ else:
     )
 
 
+# Columns that setup_database adds to an existing chat_sessions table
+CHAT_SESSIONS_ADDED_COLUMNS = {
+    "chat_history_jsonb": "JSONB",
+    "created_at": "TIMESTAMPTZ NOT NULL DEFAULT now()",
+    "updated_at": "TIMESTAMPTZ NOT NULL DEFAULT now()",
+    "message_count": "INTEGER",
+    "last_model": "VARCHAR",
+    "version": "BIGINT NOT NULL DEFAULT 0",
+    "parent_session_id": "VARCHAR",
+    "parent_message_count": "INTEGER",
+    "chat_history_compressed": "BYTEA",
+}
+
+
+def decompress_chat_histories(engine):
+    """
+    Converts rows compressed in "blob" mode back to text in chat_history, where the
+    other storage modes read legacy blobs from. Runs in one transaction holding a
+    lock that keeps out writers and the other workers starting up, which find
+    nothing left to convert once they get it.
+    """
+    with engine.begin() as conn:
+        conn.execute(text("LOCK TABLE chat_sessions IN SHARE ROW EXCLUSIVE MODE"))
+        rows = conn.execute(
+            text(
+                "SELECT session_id, chat_history_compressed FROM chat_sessions "
+                "WHERE chat_history_compressed IS NOT NULL"
+            )
+        ).fetchall()
+        if not rows:
+            return
+        print(f"Decompressing {len(rows)} chat histories")
+        codec = create_history_codec()
+        for session_id, compressed in rows:
+            conn.execute(
+                text(
+                    "UPDATE chat_sessions "
+                    "SET chat_history = :chat_history, chat_history_compressed = NULL "
+                    "WHERE session_id = :session_id"
+                ),
+                {
+                    "session_id": session_id,
+                    "chat_history": codec.decompress(compressed),
+                },
+            )
+
+
+def create_chat_sessions_partitions(conn, partitions: int):
+    for remainder in range(partitions):
+        conn.execute(
+            text(
+                f"CREATE TABLE chat_sessions_p{remainder} PARTITION OF chat_sessions "
+                f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+            )
+        )
+
+
+def migrate_chat_sessions_to_partitioned(engine, partitions: int):
+    """
+    Rewrites a plain chat_sessions into a hash-partitioned one, in one transaction
+    holding an exclusive lock on the table. Secondary indexes are recreated under
+    the same names before the lock is released, so no other worker starting up
+    tries to create them as well.
+    """
+    with engine.begin() as conn:
+        conn.execute(text("LOCK TABLE chat_sessions IN ACCESS EXCLUSIVE MODE"))
+        # Another worker may have converted it while this one waited for the lock
+        relkind = conn.execute(
+            text("SELECT relkind FROM pg_class WHERE oid = 'chat_sessions'::regclass")
+        ).scalar()
+        if relkind != "r":
+            return
+        print(f"Partitioning chat_sessions into {partitions} partitions")
+        index_definitions = conn.execute(
+            text(
+                "SELECT indexname, indexdef FROM pg_indexes "
+                "WHERE tablename = 'chat_sessions' AND indexname <> 'chat_sessions_pkey'"
+            )
+        ).fetchall()
+        conn.execute(
+            text("ALTER TABLE chat_sessions RENAME TO chat_sessions_unpartitioned")
+        )
+        conn.execute(
+            text(
+                "ALTER INDEX chat_sessions_pkey "
+                "RENAME TO chat_sessions_unpartitioned_pkey"
+            )
+        )
+        for index_name, _ in index_definitions:
+            conn.execute(text(f"DROP INDEX {index_name}"))
+        conn.execute(
+            text(
+                "CREATE TABLE chat_sessions (LIKE chat_sessions_unpartitioned "
+                "INCLUDING DEFAULTS) PARTITION BY HASH (session_id)"
+            )
+        )
+        conn.execute(text("ALTER TABLE chat_sessions ADD PRIMARY KEY (session_id)"))
+        create_chat_sessions_partitions(conn, partitions)
+        result = conn.execute(
+            text("INSERT INTO chat_sessions SELECT * FROM chat_sessions_unpartitioned")
+        )
+        conn.execute(text("DROP TABLE chat_sessions_unpartitioned"))
+        # Built after the copy, which is faster than maintaining them row by row
+        for _, index_definition in index_definitions:
+            conn.execute(text(index_definition))
+        print(f"Moved {result.rowcount} sessions into the partitioned chat_sessions")
+
+
 def setup_database():
     to_thread.current_default_thread_limiter().total_tokens = 1000
     print("Thread limiter configured")
@@ -99,18 +479,43 @@ def setup_database():
         engine = create_engine(f"{url_parts[0]}/middleware")
         metadata_obj = MetaData()
 
+        if (
+            CHAT_SESSIONS_PARTITIONS > 0
+            and "chat_sessions" in inspect(engine).get_table_names()
+        ):
+            with engine.connect() as conn:
+                partitioned = conn.execute(
+                    text(
+                        "SELECT relkind = 'p' FROM pg_class "
+                        "WHERE oid = 'chat_sessions'::regclass"
+                    )
+                ).scalar()
+            if not partitioned and CHAT_SESSIONS_MIGRATE_TO_PARTITIONED:
+                migrate_chat_sessions_to_partitioned(engine, CHAT_SESSIONS_PARTITIONS)
+            elif not partitioned:
+                print(
+                    "chat_sessions is not partitioned; set "
+                    "CHAT_SESSIONS_MIGRATE_TO_PARTITIONED=true to convert it"
+                )
+
         # Rest of your existing code remains the same
         with engine.begin() as conn:
             inspector = inspect(engine)
             if "chat_sessions" not in inspector.get_table_names():
+                partition_options = {}
+                if CHAT_SESSIONS_PARTITIONS > 0:
+                    partition_options["postgresql_partition_by"] = "HASH (session_id)"
                 chat_sessions_table = Table(
                     "chat_sessions",
                     metadata_obj,
                     Column("session_id", String, primary_key=True),
                     Column("chat_history", Text),
                     Column("api_key_hash", String),
+                    **partition_options,
                 )
                 metadata_obj.create_all(engine)
+                if CHAT_SESSIONS_PARTITIONS > 0:
+                    create_chat_sessions_partitions(conn, CHAT_SESSIONS_PARTITIONS)
                 print("Created chat_sessions table")
             else:
                 chat_sessions_table = Table(
@@ -126,89 +531,1367 @@ def setup_database():
                 else:
                     print("chat_sessions table already exists with api_key_hash column")
 
-            # Check and create index within the same transaction
-            indexes = inspector.get_indexes("chat_sessions")
-            index_names = [idx["name"] for idx in indexes]
+            # Columns added after the table was first created
+            session_columns = [
+                c["name"] for c in inspector.get_columns("chat_sessions")
+            ]
+            for column_name, column_ddl in CHAT_SESSIONS_ADDED_COLUMNS.items():
+                if column_name not in session_columns:
+                    print(f"Adding chat_sessions column {column_name}")
+                    conn.execute(
+                        text(
+                            f"ALTER TABLE chat_sessions ADD COLUMN {column_name} {column_ddl};"
+                        )
+                    )
+
+            # Check and create index within the same transaction. On a partitioned
+            # table each of these is created on every partition as a local index.
+            indexes = inspector.get_indexes("chat_sessions")
+            index_names = [idx["name"] for idx in indexes]
+
+            if "idx_chat_sessions_api_key_hash" not in index_names:
+                print("Creating index idx_chat_sessions_api_key_hash")
+                conn.execute(
+                    text(
+                        "CREATE INDEX idx_chat_sessions_api_key_hash ON chat_sessions (api_key_hash)"
+                    )
+                )
+                print("Index created successfully")
+
+            # Covers keyset-paginated /session-ids, metadata included, so a page is
+            # served by an index-only range scan
+            if "idx_chat_sessions_api_key_hash_updated_at" not in index_names:
+                print("Creating index idx_chat_sessions_api_key_hash_updated_at")
+                conn.execute(
+                    text(
+                        "CREATE INDEX idx_chat_sessions_api_key_hash_updated_at "
+                        "ON chat_sessions (api_key_hash, updated_at DESC, session_id DESC) "
+                        "INCLUDE (created_at, message_count, last_model)"
+                    )
+                )
+
+            # Lets the session reaper skip sessions that forks still read from
+            if "idx_chat_sessions_parent_session_id" not in index_names:
+                print("Creating index idx_chat_sessions_parent_session_id")
+                conn.execute(
+                    text(
+                        "CREATE INDEX idx_chat_sessions_parent_session_id "
+                        "ON chat_sessions (parent_session_id) "
+                        "WHERE parent_session_id IS NOT NULL"
+                    )
+                )
+
+            # Keeps the startup check for compressed rows in other storage modes cheap
+            if "idx_chat_sessions_compressed" not in index_names:
+                print("Creating index idx_chat_sessions_compressed")
+                conn.execute(
+                    text(
+                        "CREATE INDEX idx_chat_sessions_compressed "
+                        "ON chat_sessions (session_id) "
+                        "WHERE chat_history_compressed IS NOT NULL"
+                    )
+                )
+
+            # Lets the session reaper find idle sessions of keys without their own TTL
+            if "idx_chat_sessions_updated_at" not in index_names:
+                print("Creating index idx_chat_sessions_updated_at")
+                conn.execute(
+                    text(
+                        "CREATE INDEX idx_chat_sessions_updated_at "
+                        "ON chat_sessions (updated_at)"
+                    )
+                )
+
+            # One row per message. The (session_id, seq) primary key doubles as the
+            # composite index used to read a conversation in order.
+            chat_messages_table = Table(
+                "chat_messages",
+                metadata_obj,
+                Column("session_id", String, primary_key=True),
+                Column("seq", Integer, primary_key=True, autoincrement=False),
+                Column("role", String, nullable=False),
+                Column("content", Text),
+                Column("extra", Text),
+                Column("content_hash", String),
+            )
+            if "chat_messages" not in inspector.get_table_names():
+                chat_messages_table.create(conn)
+                print("Created chat_messages table")
+            elif "content_hash" not in [
+                c["name"] for c in inspector.get_columns("chat_messages")
+            ]:
+                print("Adding chat_messages column content_hash")
+                conn.execute(
+                    text("ALTER TABLE chat_messages ADD COLUMN content_hash VARCHAR")
+                )
+
+            # Message contents shared by reference (CHAT_MESSAGE_DEDUPE_MIN_LENGTH).
+            # The partial index lets the session reaper find contents that no
+            # message references any more.
+            chat_message_contents_table = Table(
+                "chat_message_contents",
+                metadata_obj,
+                Column("content_hash", String, primary_key=True),
+                Column("content", Text, nullable=False),
+            )
+            if "chat_message_contents" not in inspector.get_table_names():
+                chat_message_contents_table.create(conn)
+                conn.execute(
+                    text(
+                        "CREATE INDEX IF NOT EXISTS idx_chat_messages_content_hash "
+                        "ON chat_messages (content_hash) "
+                        "WHERE content_hash IS NOT NULL"
+                    )
+                )
+                print("Created chat_message_contents table")
+
+            # Compaction summaries. covered_count is how many leading history
+            # messages the summary replaces in the prompt.
+            chat_session_summaries_table = Table(
+                "chat_session_summaries",
+                metadata_obj,
+                Column("session_id", String, primary_key=True),
+                Column("summary", Text, nullable=False),
+                Column("covered_count", Integer, nullable=False),
+            )
+            if "chat_session_summaries" not in inspector.get_table_names():
+                chat_session_summaries_table.create(conn)
+                print("Created chat_session_summaries table")
+
+        # Verify table exists after transaction commits
+        with engine.connect() as conn:
+            result = conn.execute(
+                text(
+                    "SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = 'chat_sessions')"
+                )
+            )
+            if not result.scalar():
+                raise Exception(
+                    "Table creation failed - table does not exist after create_all()"
+                )
+            print("Table verification successful")
+
+        if CHAT_HISTORY_STORAGE != "blob":
+            with engine.connect() as conn:
+                compressed = conn.execute(
+                    text(
+                        "SELECT EXISTS (SELECT 1 FROM chat_sessions "
+                        "WHERE chat_history_compressed IS NOT NULL)"
+                    )
+                ).scalar()
+            if compressed:
+                decompress_chat_histories(engine)
+
+        # Reflect again so the table object includes every column added above
+        chat_sessions_table = Table("chat_sessions", MetaData(), autoload_with=engine)
+
+        return (
+            engine,
+            chat_sessions_table,
+            chat_messages_table,
+            chat_message_contents_table,
+            chat_session_summaries_table,
+        )
+
+    except SQLAlchemyError as e:
+        print(f"Database setup error: {str(e)}")
+        raise
+    except Exception as e:
+        print(f"Database setup error: {str(e)}")
+        raise
+
+
+def create_litellm_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=LITELLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LITELLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=LITELLM_KEEPALIVE_EXPIRY,
+    )
+    print(
+        f"LiteLLM connection pool: max_connections={LITELLM_MAX_CONNECTIONS} "
+        f"max_keepalive_connections={LITELLM_MAX_KEEPALIVE_CONNECTIONS} "
+        f"keepalive_expiry={LITELLM_KEEPALIVE_EXPIRY}"
+    )
+    return httpx.AsyncClient(limits=limits, timeout=litellm_timeout("chat"))
+
+
+def litellm_timeout(route: str) -> httpx.Timeout:
+    return httpx.Timeout(
+        LITELLM_TIMEOUTS[route],
+        connect=LITELLM_CONNECT_TIMEOUT,
+        pool=LITELLM_POOL_TIMEOUT,
+    )
+
+
+class UpstreamPoolTracker:
+    """
+    Tracks in-flight requests on the shared LiteLLM pool. A request that starts while
+    every connection is busy has to wait for one, which is counted as a saturation event.
+    """
+
+    def __init__(self, max_connections: int):
+        self.max_connections = max_connections
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def acquire(self):
+        if self.in_flight >= self.max_connections:
+            metrics.incr("litellm_pool_saturated")
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        metrics.incr("litellm_requests")
+        metrics.set_gauge("litellm_pool_in_flight", self.in_flight)
+        metrics.set_gauge("litellm_pool_peak_in_flight", self.peak_in_flight)
+
+    def release(self):
+        self.in_flight -= 1
+        metrics.set_gauge("litellm_pool_in_flight", self.in_flight)
+
+
+upstream_pool = UpstreamPoolTracker(LITELLM_MAX_CONNECTIONS)
+
+
+async def litellm_request(
+    method: str, url: str, route: str, **kwargs
+) -> httpx.Response:
+    """
+    Sends a request to LiteLLM over the shared pool and reads the full response body.
+    """
+    upstream_pool.acquire()
+    try:
+        return await litellm_client.request(
+            method, url, timeout=litellm_timeout(route), **kwargs
+        )
+    except httpx.PoolTimeout:
+        metrics.incr("litellm_pool_timeouts")
+        raise
+    finally:
+        upstream_pool.release()
+
+
+async def litellm_stream(method: str, url: str, route: str, **kwargs) -> httpx.Response:
+    """
+    Sends a request to LiteLLM over the shared pool without reading the body. The caller
+    must call close_litellm_stream() once it has consumed the response.
+    """
+    upstream_pool.acquire()
+    request = litellm_client.build_request(
+        method, url, timeout=litellm_timeout(route), **kwargs
+    )
+    try:
+        return await litellm_client.send(request, stream=True)
+    except httpx.PoolTimeout:
+        metrics.incr("litellm_pool_timeouts")
+        upstream_pool.release()
+        raise
+    except Exception:
+        upstream_pool.release()
+        raise
+
+
+async def close_litellm_stream(response: httpx.Response):
+    try:
+        await response.aclose()
+    finally:
+        upstream_pool.release()
+
+
+class OpenAIClientCache:
+    """
+    Bounded LRU of AsyncOpenAI clients keyed by API key hash. Every client is built on
+    top of the shared LiteLLM connection pool, so a miss only costs the client object
+    and never a new connection. Clients idle for longer than idle_seconds are evicted.
+    """
+
+    def __init__(self, max_size: int, idle_seconds: float):
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self.clients = OrderedDict()
+
+    def get(self, api_key: str) -> AsyncOpenAI:
+        key_hash = hash_api_key(api_key)
+        now = time.monotonic()
+        self.evict_idle(now)
+
+        entry = self.clients.get(key_hash)
+        if entry is not None:
+            metrics.incr("openai_client_cache_hits")
+            self.clients.move_to_end(key_hash)
+            entry[1] = now
+            return entry[0]
+
+        metrics.incr("openai_client_cache_misses")
+        client = AsyncOpenAI(
+            api_key=api_key, base_url=LITELLM_ENDPOINT, http_client=litellm_client
+        )
+        self.clients[key_hash] = [client, now]
+        while len(self.clients) > self.max_size:
+            self.clients.popitem(last=False)
+            metrics.incr("openai_client_cache_evictions")
+        metrics.set_gauge("openai_client_cache_size", len(self.clients))
+        return client
+
+    def evict_idle(self, now: float):
+        # Entries are kept in last-used order, so idle ones are always at the front.
+        # Evicted clients are not closed because they share litellm_client.
+        while self.clients:
+            key_hash, (_, last_used) = next(iter(self.clients.items()))
+            if now - last_used < self.idle_seconds:
+                break
+            del self.clients[key_hash]
+            metrics.incr("openai_client_cache_evictions")
+        metrics.set_gauge("openai_client_cache_size", len(self.clients))
+
+    def clear(self):
+        self.clients.clear()
+
+
+openai_clients = OpenAIClientCache(OPENAI_CLIENT_CACHE_SIZE, OPENAI_CLIENT_IDLE_SECONDS)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    print(f"doing startup_event")
+    global db_engine, chat_sessions, chat_messages, chat_message_contents
+    global chat_session_summaries, session_store, history_compactor, litellm_client
+    if CHAT_HISTORY_STORAGE == "sqlite":
+        # Everything is in the SQLite database: no Postgres to set up
+        if DATABASE_REPLICA_URL:
+            raise ValueError(
+                "DATABASE_REPLICA_URL is not supported with sqlite storage"
+            )
+        async_engine = None
+    else:
+        (
+            db_engine,
+            chat_sessions,
+            chat_messages,
+            chat_message_contents,
+            chat_session_summaries,
+        ) = setup_database()
+        async_engine = create_async_db_engine(db_engine)
+    db_store = create_db_store(async_engine)
+    session_store = create_session_store(
+        db_store, create_replica_db_engine() if DATABASE_REPLICA_URL else None
+    )
+    litellm_client = create_litellm_client()
+    background_tasks = []
+    if HISTORY_COMPACTION_ENABLED:
+        print(
+            f"History compaction enabled: model={HISTORY_COMPACTION_MODEL} "
+            f"threshold_tokens={HISTORY_COMPACTION_THRESHOLD_TOKENS} "
+            f"keep_tokens={HISTORY_COMPACTION_KEEP_TOKENS}"
+        )
+        history_compactor = (
+            SqliteHistoryCompactor(db_store)
+            if CHAT_HISTORY_STORAGE == "sqlite"
+            else HistoryCompactor(async_engine, chat_session_summaries)
+        )
+        background_tasks.extend(
+            asyncio.create_task(history_compactor.run())
+            for _ in range(HISTORY_COMPACTION_CONCURRENCY)
+        )
+    if CHAT_HISTORY_STORAGE == "messages":
+        background_tasks.append(asyncio.create_task(db_store.migrate_blob_sessions()))
+    if SESSION_TTL_SECONDS > 0 or any(ttl > 0 for ttl in SESSION_TTL_BY_KEY.values()):
+        print(
+            f"Session expiry enabled: ttl_seconds={SESSION_TTL_SECONDS} "
+            f"keys_with_own_ttl={len(SESSION_TTL_BY_KEY)} "
+            f"archive_bucket={SESSION_ARCHIVE_BUCKET}"
+        )
+        reaper = (
+            SqliteSessionReaper(session_store)
+            if CHAT_HISTORY_STORAGE == "sqlite"
+            else SessionReaper(session_store, async_engine)
+        )
+        background_tasks.append(asyncio.create_task(reaper.run()))
+    yield
+    print(f"doing shutdown_event")
+    for task in background_tasks:
+        task.cancel()
+    openai_clients.clear()
+    await litellm_client.aclose()
+    await session_store.close()
+
+
+class DeferredWritesMiddleware:
+    """
+    Starts the history writes a request deferred from a Starlette BackgroundTask,
+    once the response has been sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        writes = []
+        token = deferred_writes.set(writes)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            deferred_writes.reset(token)
+            if writes:
+                await BackgroundTask(start_deferred_writes, writes)()
+
+
+async def start_deferred_writes(writes: List[Any]):
+    # A coroutine, so BackgroundTask runs it on the event loop, not in a thread
+    for start in writes:
+        start()
+
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(DeferredWritesMiddleware)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],  # Allows all origins
+    allow_credentials=True,
+    allow_methods=["*"],  # Allows all methods
+    allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Session-Id"],  # Expose the X-Session-Id header
+)
+
+
+def hash_api_key(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+def create_async_db_engine(sync_engine) -> AsyncEngine:
+    # Same middleware database as setup_database, but through the asyncpg driver
+    async_url = sync_engine.url.set(drivername="postgresql+asyncpg")
+    print(
+        f"Async database pool: pool_size={DATABASE_POOL_SIZE} "
+        f"max_overflow={DATABASE_MAX_OVERFLOW}"
+    )
+    return create_pooled_async_engine(async_url)
+
+
+def create_replica_db_engine() -> AsyncEngine:
+    # The middleware database on the replica's server, as setup_database does
+    url_parts = DATABASE_REPLICA_URL.rsplit("/", 1)
+    replica_url = make_url(f"{url_parts[0]}/middleware").set(
+        drivername="postgresql+asyncpg"
+    )
+    print(f"Read replica enabled: {replica_url.host}:{replica_url.port}")
+    return create_pooled_async_engine(replica_url)
+
+
+def create_pooled_async_engine(async_url) -> AsyncEngine:
+    return create_async_engine(
+        async_url,
+        pool_size=DATABASE_POOL_SIZE,
+        max_overflow=DATABASE_MAX_OVERFLOW,
+        pool_timeout=DATABASE_POOL_TIMEOUT,
+        pool_recycle=DATABASE_POOL_RECYCLE,
+        pool_pre_ping=True,
+    )
+
+
+def estimate_message_tokens(message: Dict[str, Any]) -> int:
+    # About four characters per token plus a few tokens of per-message overhead.
+    # The window only needs a consistent bound, not the provider's exact count.
+    content = message.get("content")
+    if isinstance(content, list):
+        length = sum(
+            len(part.get("text") or "") if isinstance(part, dict) else len(str(part))
+            for part in content
+        )
+    else:
+        length = len(content or "")
+    return length // 4 + 4
+
+
+def count_message_tokens(messages: List[Dict[str, Any]]):
+    for message in messages:
+        if TOKEN_COUNT_KEY not in message:
+            message[TOKEN_COUNT_KEY] = estimate_message_tokens(message)
+
+
+def strip_stored_fields(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [
+        {k: v for k, v in message.items() if k not in STORED_ONLY_KEYS}
+        for message in messages
+    ]
+
+
+def history_token_budget(requested, api_key_hash: str) -> int:
+    budget = requested
+    if budget is None:
+        budget = MAX_HISTORY_TOKENS_BY_KEY.get(api_key_hash, MAX_HISTORY_TOKENS)
+    try:
+        return int(budget)
+    except (TypeError, ValueError):
+        raise HTTPException(
+            status_code=400,
+            detail={"error": "max_history_tokens must be an integer"},
+        )
+
+
+def history_window(
+    chat_history: List[Dict[str, Any]], max_tokens: int
+) -> List[Dict[str, Any]]:
+    """
+    The messages sent upstream for a history-enabled turn: every system message
+    plus the newest messages that fit in max_tokens. The newest message is always
+    sent, even on its own it is over the budget.
+    """
+    if max_tokens <= 0:
+        return strip_stored_fields(chat_history)
+    count_message_tokens(chat_history)
+
+    remaining = max_tokens - sum(
+        m[TOKEN_COUNT_KEY] for m in chat_history if m.get("role") == "system"
+    )
+    start = len(chat_history)
+    for i in range(len(chat_history) - 1, -1, -1):
+        message = chat_history[i]
+        if message.get("role") == "system":
+            continue
+        if message[TOKEN_COUNT_KEY] > remaining and start < len(chat_history):
+            break
+        remaining -= message[TOKEN_COUNT_KEY]
+        start = i
+    # Don't open the window on a reply whose user turn was trimmed
+    while start < len(chat_history) - 1 and chat_history[start].get("role") in (
+        "assistant",
+        "tool",
+        "system",
+    ):
+        start += 1
+
+    window = [
+        m for i, m in enumerate(chat_history) if i >= start or m.get("role") == "system"
+    ]
+    if len(window) < len(chat_history):
+        metrics.incr("history_window_trimmed")
+    return strip_stored_fields(window)
+
+
+def create_history_codec() -> HistoryCodec:
+    dictionary = None
+    if CHAT_HISTORY_COMPRESSION_DICTIONARY:
+        with open(CHAT_HISTORY_COMPRESSION_DICTIONARY, "rb") as f:
+            dictionary = f.read()
+    return HistoryCodec(
+        CHAT_HISTORY_COMPRESSION_MIN_BYTES, CHAT_HISTORY_COMPRESSION_LEVEL, dictionary
+    )
+
+
+def create_db_store(engine: Optional[AsyncEngine]) -> DatabaseStoreProtocol:
+    fetch_sizes = dict(
+        fetch_size=HISTORY_STREAM_FETCH_SIZE,
+        export_fetch_size=SESSION_EXPORT_FETCH_SIZE,
+    )
+    if CHAT_HISTORY_STORAGE == "messages":
+        return MessageTableSessionStore(
+            engine,
+            chat_sessions,
+            chat_messages,
+            chat_message_contents,
+            dedupe_min_length=CHAT_MESSAGE_DEDUPE_MIN_LENGTH,
+            migration_batch_size=CHAT_HISTORY_MIGRATION_BATCH_SIZE,
+            **fetch_sizes,
+        )
+    elif CHAT_HISTORY_STORAGE == "jsonb":
+        return JsonbSessionStore(engine, chat_sessions, **fetch_sizes)
+    elif CHAT_HISTORY_STORAGE == "blob":
+        return SessionStore(
+            engine, chat_sessions, create_history_codec(), **fetch_sizes
+        )
+    elif CHAT_HISTORY_STORAGE == "sqlite":
+        print(
+            f"SQLite session database: {SQLITE_DATABASE_PATH} "
+            f"max_batch_size={SQLITE_WRITE_MAX_BATCH_SIZE} "
+            f"read_threads={SQLITE_READ_THREADS}"
+        )
+        return SqliteSessionStore(
+            SQLITE_DATABASE_PATH,
+            SQLITE_WRITE_MAX_BATCH_SIZE,
+            SQLITE_READ_THREADS,
+            busy_timeout_ms=SQLITE_BUSY_TIMEOUT_MS,
+            **fetch_sizes,
+        )
+    raise ValueError(f"Unsupported CHAT_HISTORY_STORAGE: {CHAT_HISTORY_STORAGE}")
+
+
+def create_session_store(
+    db_store: DatabaseStoreProtocol, replica_engine: Optional[AsyncEngine] = None
+) -> SessionStoreProtocol:
+    """
+    Stacks the tiers the settings enable in front of db_store, a store from
+    create_db_store.
+    """
+    print(f"CHAT_HISTORY_STORAGE: {CHAT_HISTORY_STORAGE}")
+    if CHAT_HISTORY_STORAGE == "blob" and CHAT_HISTORY_COMPRESSION_MIN_BYTES > 0:
+        print(
+            f"History compression enabled: min_bytes={CHAT_HISTORY_COMPRESSION_MIN_BYTES} "
+            f"level={CHAT_HISTORY_COMPRESSION_LEVEL} "
+            f"dictionary={CHAT_HISTORY_COMPRESSION_DICTIONARY}"
+        )
+    store = db_store
+    if replica_engine is not None:
+        store = ReplicaRoutingStore(
+            store,
+            create_db_store(replica_engine),
+            REPLICA_TRACKED_SESSIONS,
+            REPLICA_LSN_REFRESH_SECONDS,
+        )
+    if HISTORY_DURABILITY not in ("sync", "after-response", "async-batched"):
+        raise ValueError(f"Unsupported HISTORY_DURABILITY: {HISTORY_DURABILITY}")
+    if HISTORY_DURABILITY != "sync" and not (
+        SESSION_REDIS_ENABLED or HISTORY_SESSION_AFFINITY
+    ):
+        raise ValueError(
+            f"HISTORY_DURABILITY={HISTORY_DURABILITY} needs SESSION_REDIS_ENABLED=true, "
+            "or HISTORY_SESSION_AFFINITY=true if every turn of a session is served "
+            "by the same worker"
+        )
+
+    if HISTORY_GROUP_COMMIT_ENABLED or HISTORY_DURABILITY == "async-batched":
+        print(
+            f"History group commit enabled: max_batch_size={HISTORY_WRITE_MAX_BATCH_SIZE} "
+            f"max_delay_ms={HISTORY_WRITE_MAX_DELAY_MS}"
+        )
+        writer = HistoryWriter(
+            store, HISTORY_WRITE_MAX_BATCH_SIZE, HISTORY_WRITE_MAX_DELAY_MS
+        )
+        writer.start()
+        store = BatchingSessionStore(store, writer)
+
+    redis_client = None
+    if SESSION_REDIS_ENABLED:
+        import redis.asyncio as redis
+
+        print(f"Redis session tier enabled: {REDIS_HOST}:{REDIS_PORT} ssl={REDIS_SSL}")
+        redis_client = redis.Redis(
+            host=REDIS_HOST,
+            port=REDIS_PORT,
+            password=REDIS_PASSWORD,
+            ssl=REDIS_SSL,
+            decode_responses=True,
+        )
+        store = RedisSessionStore(
+            store,
+            redis_client,
+            ttl=SESSION_REDIS_TTL_SECONDS,
+            flush_interval=SESSION_REDIS_FLUSH_INTERVAL,
+            flush_batch_size=SESSION_REDIS_FLUSH_BATCH_SIZE,
+            fetch_size=HISTORY_STREAM_FETCH_SIZE,
+        )
+        store.start()
+
+    if SESSION_CACHE_MAX_BYTES > 0:
+        print(
+            f"Session cache enabled: max_bytes={SESSION_CACHE_MAX_BYTES} "
+            f"ttl_seconds={SESSION_CACHE_TTL_SECONDS}"
+        )
+        cache = SessionCache(SESSION_CACHE_MAX_BYTES, SESSION_CACHE_TTL_SECONDS)
+        store = CachedSessionStore(store, cache)
+
+    if HISTORY_DURABILITY != "sync":
+        print(
+            f"History durability: {HISTORY_DURABILITY} "
+            f"max_pending={HISTORY_DEFERRED_MAX_PENDING} "
+            f"max_retries={HISTORY_WRITE_MAX_RETRIES}"
+        )
+        store = DeferredHistoryStore(
+            store,
+            HISTORY_DEFERRED_MAX_PENDING,
+            HISTORY_WRITE_MAX_RETRIES,
+            redis_client,
+            HISTORY_PENDING_WAIT_SECONDS,
+        )
+    return store
+
+
+async def get_session_data(session_id: str) -> Optional[Dict[str, Any]]:
+    return await session_store.get_session(session_id)
+
+
+async def get_session_messages(
+    session_id: str, offset: int, limit: Optional[int]
+) -> Optional[Dict[str, Any]]:
+    return await session_store.get_messages(session_id, offset, limit)
+
+
+async def get_session_version(session_id: str) -> Optional[Dict[str, Any]]:
+    return await session_store.get_version(session_id)
+
+
+async def fork_chat_session(
+    session_id: str, new_session_id: str, message_count: Optional[int]
+) -> Optional[int]:
+    return await session_store.fork_session(session_id, new_session_id, message_count)
+
+
+def should_stream_history(session_version: Dict[str, Any]) -> bool:
+    # Sessions last written before message_count existed have no count; stream them
+    message_count = session_version.get("message_count")
+    return message_count is None or message_count >= HISTORY_STREAM_MIN_MESSAGES
+
+
+async def stream_history_json(session_id: str, bedrock: bool) -> AsyncGenerator:
+    """
+    Encodes a full-history response body incrementally, in chunks of about
+    HISTORY_STREAM_CHUNK_BYTES, with the same shape as the buffered responses.
+    Memory use stays flat however long the session is.
+    """
+    system_messages = []
+    chunk = [b'{"messages": [']
+    chunk_bytes = 0
+    separator = b""
+    async for message in session_store.stream_messages(session_id):
+        if bedrock:
+            converted = convert_openai_to_bedrock_history([message])
+            system_messages.extend(converted["system"])
+            if not converted["messages"]:
+                continue
+            item = converted["messages"][0]
+        else:
+            item = strip_stored_fields([message])[0]
+        encoded = separator + json.dumps(item).encode("utf-8")
+        separator = b", "
+        chunk.append(encoded)
+        chunk_bytes += len(encoded)
+        if chunk_bytes >= HISTORY_STREAM_CHUNK_BYTES:
+            yield b"".join(chunk)
+            chunk, chunk_bytes = [], 0
+    chunk.append(b"]")
+    if bedrock:
+        chunk.append(b', "system": ' + json.dumps(system_messages).encode("utf-8"))
+    chunk.append(b"}")
+    yield b"".join(chunk)
+
+
+async def stream_history_ndjson(
+    session_ids: List[str], api_key_hash: str, bedrock: bool
+) -> AsyncGenerator:
+    found = set()
+    async for session_id, chat_history in session_store.stream_sessions(
+        session_ids, api_key_hash
+    ):
+        found.add(session_id)
+        if bedrock:
+            line = {
+                "session_id": session_id,
+                **convert_openai_to_bedrock_history(chat_history),
+            }
+        else:
+            line = {
+                "session_id": session_id,
+                "messages": strip_stored_fields(chat_history),
+            }
+        yield json.dumps(line).encode("utf-8") + b"\n"
+    for session_id in session_ids:
+        if session_id not in found:
+            line = {
+                "session_id": session_id,
+                "error": "Session not found or not owned by this API key",
+            }
+            yield json.dumps(line).encode("utf-8") + b"\n"
+
+
+def require_master_key(request: Request):
+    # The session export/import and metrics endpoints see every key's data, so only
+    # the LiteLLM master key may call them
+    auth_header = request.headers.get("Authorization")
+    if auth_header and auth_header.startswith("Bearer "):
+        api_key = auth_header[len("Bearer ") :]
+    else:
+        api_key = ""
+    if not MASTER_KEY or not hmac.compare_digest(
+        api_key.encode("utf-8"), MASTER_KEY.encode("utf-8")
+    ):
+        raise HTTPException(
+            status_code=401, detail={"error": "This endpoint requires the master key"}
+        )
+
+
+def session_ndjson_line(session: Dict[str, Any]) -> bytes:
+    # The history is already JSON text, so it is spliced in rather than re-encoded
+    metadata = {k: v for k, v in session.items() if k != "chat_history"}
+    return (
+        json.dumps(metadata, default=datetime.isoformat)[:-1].encode("utf-8")
+        + b', "chat_history": '
+        + session["chat_history"].encode("utf-8")
+        + b"}\n"
+    )
+
+
+async def export_sessions_ndjson() -> AsyncGenerator:
+    chunk = bytearray()
+    async for session in session_store.export_sessions():
+        chunk += session_ndjson_line(session)
+        if len(chunk) >= HISTORY_STREAM_CHUNK_BYTES:
+            yield bytes(chunk)
+            chunk.clear()
+    if chunk:
+        yield bytes(chunk)
+
+
+class ExportBuffer(io.RawIOBase):
+    """
+    Write-only file that the Parquet writer writes to. The export drains it after
+    each row group, so at most one row group is buffered.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def drain(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def session_export_schema():
+    # pyarrow is only imported once a Parquet export or import is requested
+    import pyarrow as pa
+
+    return pa.schema(
+        [
+            ("session_id", pa.string()),
+            ("api_key_hash", pa.string()),
+            ("created_at", pa.timestamp("us", tz="UTC")),
+            ("updated_at", pa.timestamp("us", tz="UTC")),
+            ("message_count", pa.int32()),
+            ("last_model", pa.string()),
+            ("version", pa.int64()),
+            # Messages are free-form, so the history is kept as its JSON text
+            ("chat_history", pa.string()),
+        ]
+    )
+
+
+async def export_sessions_parquet() -> AsyncGenerator:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = session_export_schema()
+    sink = ExportBuffer()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    sessions = []
+    async for session in session_store.export_sessions():
+        sessions.append(session)
+        if len(sessions) >= SESSION_EXPORT_FETCH_SIZE:
+            row_group = pa.Table.from_pylist(sessions, schema)
+            await to_thread.run_sync(writer.write_table, row_group)
+            sessions = []
+            yield sink.drain()
+    if sessions:
+        row_group = pa.Table.from_pylist(sessions, schema)
+        await to_thread.run_sync(writer.write_table, row_group)
+    writer.close()
+    yield sink.drain()
+
+
+def parse_export_timestamp(value) -> Optional[datetime]:
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+def import_session_record(session: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Validates one exported session, an NDJSON line or a Parquet row, and fills in
+    what an older or hand-written export may lack. Raises ValueError if it is unusable.
+    """
+    if not isinstance(session, dict) or not session.get("session_id"):
+        raise ValueError("session_id is required")
+    chat_history = session.get("chat_history") or []
+    if isinstance(chat_history, str):
+        chat_history = json.loads(chat_history)
+    if not isinstance(chat_history, list):
+        raise ValueError("chat_history must be a list of messages")
+    now = datetime.now(timezone.utc)
+    return {
+        "session_id": str(session["session_id"]),
+        "api_key_hash": session.get("api_key_hash"),
+        "created_at": parse_export_timestamp(session.get("created_at")) or now,
+        "updated_at": parse_export_timestamp(session.get("updated_at")) or now,
+        "message_count": len(chat_history),
+        "last_model": session.get("last_model") or last_model(chat_history),
+        "version": int(session.get("version") or 0),
+        "chat_history": chat_history,
+    }
+
+
+async def read_ndjson_sessions(chunks) -> AsyncGenerator:
+    # Yields lists of up to SESSION_IMPORT_BATCH_SIZE sessions as lines arrive
+    pending = bytearray()
+    batch = []
+    line_number = 0
+    async for chunk in chunks:
+        pending += chunk
+        if b"\n" not in chunk:
+            continue
+        *lines, rest = pending.split(b"\n")
+        pending = bytearray(rest)
+        for line in lines:
+            line_number += 1
+            if not line.strip():
+                continue
+            try:
+                batch.append(import_session_record(json.loads(line)))
+            except ValueError as e:
+                raise ValueError(f"line {line_number}: {e}")
+            if len(batch) >= SESSION_IMPORT_BATCH_SIZE:
+                yield batch
+                batch = []
+    if pending.strip():
+        try:
+            batch.append(import_session_record(json.loads(pending)))
+        except ValueError as e:
+            raise ValueError(f"line {line_number + 1}: {e}")
+    if batch:
+        yield batch
+
+
+async def read_parquet_sessions(chunks) -> AsyncGenerator:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    with tempfile.SpooledTemporaryFile(max_size=SESSION_IMPORT_SPOOL_BYTES) as spool:
+        async for chunk in chunks:
+            await to_thread.run_sync(spool.write, chunk)
+        spool.seek(0)
+        try:
+            parquet_file = await to_thread.run_sync(pq.ParquetFile, spool)
+        except pa.ArrowException as e:
+            raise ValueError(f"not a Parquet file: {e}")
+        record_batches = parquet_file.iter_batches(batch_size=SESSION_IMPORT_BATCH_SIZE)
+        while True:
+            record_batch = await to_thread.run_sync(next, record_batches, None)
+            if record_batch is None:
+                break
+            yield [import_session_record(row) for row in record_batch.to_pylist()]
+
+
+def history_etag(version: str, requested_range: Optional[tuple]) -> str:
+    # Strong ETag: one session version, one representation per requested range
+    if requested_range is None:
+        return f'"{version}"'
+    offset, limit = requested_range
+    return f'"{version}:{offset}:{"" if limit is None else limit}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("If-None-Match")
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+def history_range(body: Dict[str, Any]) -> Optional[tuple]:
+    """
+    (offset, limit) from the optional offset/limit/since_seq history parameters, or
+    None when the whole history was asked for. since_seq is the seq (0-based
+    position) of the last message the client already has.
+    """
+    if all(body.get(k) is None for k in ("offset", "limit", "since_seq")):
+        return None
+    try:
+        limit = None if body.get("limit") is None else int(body["limit"])
+        if body.get("since_seq") is not None:
+            offset = int(body["since_seq"]) + 1
+            if offset < 0:
+                raise ValueError
+        else:
+            offset = int(body.get("offset") or 0)
+    except (TypeError, ValueError):
+        raise HTTPException(
+            status_code=400,
+            detail={"error": "offset, limit and since_seq must be integers"},
+        )
+    if limit is not None and limit < 0:
+        raise HTTPException(
+            status_code=400, detail={"error": "limit must not be negative"}
+        )
+    return offset, limit
+
 
-            if "idx_chat_sessions_api_key_hash" not in index_names:
-                print("Creating index idx_chat_sessions_api_key_hash")
-                conn.execute(
-                    text(
-                        "CREATE INDEX idx_chat_sessions_api_key_hash ON chat_sessions (api_key_hash)"
-                    )
-                )
-                print("Index created successfully")
+async def create_chat_history(session_id: str, api_key_hash: str) -> "ChatHistory":
+    # A new session row starts at version 0
+    chat_history = ChatHistory(version=0, api_key_hash=api_key_hash)
+    await session_store.create_session(session_id, chat_history, api_key_hash)
+    return chat_history
 
-        # Verify table exists after transaction commits
-        with engine.connect() as conn:
-            result = conn.execute(
-                text(
-                    "SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = 'chat_sessions')"
-                )
+
+async def update_chat_history(
+    session_id: str, chat_history: List[Dict[str, str]], model: Optional[str] = None
+):
+    new_messages = chat_history[stored_message_count(chat_history) :]
+    count_message_tokens(new_messages)
+    if model:
+        for message in new_messages:
+            if message.get("role") == "assistant":
+                message.setdefault(MODEL_KEY, model)
+    await session_store.update_chat_history(session_id, chat_history)
+
+
+COMPACTION_PROMPT = (
+    "Summarize the conversation below so it can replace it as context for the rest "
+    "of the conversation. Keep facts, decisions, names, numbers, instructions the "
+    "user gave and open questions. Leave out small talk. Write plain prose."
+)
+
+
+def message_text(message: Dict[str, Any]) -> str:
+    content = message.get("content")
+    if isinstance(content, list):
+        return " ".join(
+            part.get("text", "") for part in content if isinstance(part, dict)
+        )
+    return content or ""
+
+
+class HistoryCompactor:
+    """
+    Summarizes the older part of long sessions in the background. Requests only
+    ever enqueue a session and read the latest finished summary, so a turn never
+    waits on the summarization call. The raw messages stay in the stored history,
+    which remains the full record returned by /chat-history.
+    """
+
+    def __init__(self, engine: AsyncEngine, table: Table):
+        self.engine = engine
+        self.table = table
+        self.queue = asyncio.Queue(maxsize=HISTORY_COMPACTION_MAX_QUEUE)
+        # Sessions queued or being compacted by this worker
+        self.pending = set()
+
+    async def get_summary(self, session_id: str) -> Optional[Dict[str, Any]]:
+        async with self.engine.connect() as conn:
+            stmt = select(self.table.c.summary, self.table.c.covered_count).where(
+                self.table.c.session_id == session_id
             )
-            if not result.scalar():
-                raise Exception(
-                    "Table creation failed - table does not exist after create_all()"
-                )
-            print("Table verification successful")
+            result = (await conn.execute(stmt)).fetchone()
+        if result is None:
+            return None
+        return {"summary": result[0], "covered_count": result[1]}
+
+    def request(self, session_id: str, api_key: str):
+        if session_id in self.pending:
+            return
+        try:
+            self.queue.put_nowait((session_id, api_key))
+        except asyncio.QueueFull:
+            metrics.incr("history_compaction_dropped")
+            return
+        self.pending.add(session_id)
+
+    async def run(self):
+        while True:
+            session_id, api_key = await self.queue.get()
+            try:
+                await self.compact(session_id, api_key)
+            except Exception as e:
+                print(f"History compaction failed for {session_id}: {str(e)}")
+                metrics.incr("history_compaction_failed")
+            finally:
+                self.pending.discard(session_id)
+
+    @staticmethod
+    def split_point(chat_history: List[Dict[str, Any]]) -> int:
+        # Keep the newest HISTORY_COMPACTION_KEEP_TOKENS raw, starting on a user turn
+        kept = 0
+        split = len(chat_history)
+        for i in range(len(chat_history) - 1, -1, -1):
+            kept += chat_history[i][TOKEN_COUNT_KEY]
+            if kept > HISTORY_COMPACTION_KEEP_TOKENS:
+                break
+            split = i
+        while split < len(chat_history) and chat_history[split].get("role") != "user":
+            split += 1
+        return split
+
+    async def compact(self, session_id: str, api_key: str):
+        session_data = await session_store.get_session(session_id)
+        if session_data is None or not session_data["chat_history"]:
+            return
+        chat_history = session_data["chat_history"]
+        count_message_tokens(chat_history)
+        previous = await self.get_summary(session_id)
+        covered = previous["covered_count"] if previous else 0
+        split = self.split_point(chat_history)
+        if split <= covered:
+            return
+
+        transcript = "\n\n".join(
+            f"{m.get('role')}: {message_text(m)}"
+            for m in chat_history[covered:split]
+            if m.get("role") != "system"
+        )
+        if previous:
+            transcript = (
+                f"Summary of the earlier conversation: {previous['summary']}"
+                f"\n\n{transcript}"
+            )
+        start = time.perf_counter()
+        response = await litellm_request(
+            "POST",
+            LITELLM_CHAT,
+            "compaction",
+            json={
+                "model": HISTORY_COMPACTION_MODEL,
+                "messages": [
+                    {"role": "system", "content": COMPACTION_PROMPT},
+                    {"role": "user", "content": transcript},
+                ],
+            },
+            headers={
+                "Authorization": f"Bearer {HISTORY_COMPACTION_API_KEY or api_key}",
+                "Content-Type": "application/json",
+            },
+        )
+        if response.status_code != 200:
+            raise Exception(f"Error from LiteLLM endpoint: {response.text}")
+        summary = response.json()["choices"][0]["message"]["content"]
+        await self.save_summary(session_id, summary, split)
+        metrics.incr("history_compactions")
+        metrics.observe(
+            "history_compaction_latency_ms",
+            (time.perf_counter() - start) * 1000,
+            LATENCY_MS_BUCKETS,
+        )
 
-        return engine, chat_sessions_table
+    async def save_summary(self, session_id: str, summary: str, covered_count: int):
+        # Never replace a summary that already covers more of the session
+        stmt = (
+            pg_insert(self.table)
+            .values(session_id=session_id, summary=summary, covered_count=covered_count)
+            .on_conflict_do_update(
+                index_elements=[self.table.c.session_id],
+                set_={"summary": summary, "covered_count": covered_count},
+                where=self.table.c.covered_count < covered_count,
+            )
+        )
+        async with self.engine.begin() as conn:
+            await conn.execute(stmt)
 
-    except SQLAlchemyError as e:
-        print(f"Database setup error: {str(e)}")
-        raise
-    except Exception as e:
-        print(f"Database setup error: {str(e)}")
-        raise
 
+class SqliteHistoryCompactor(HistoryCompactor):
+    # Summaries are kept in the SQLite database, next to the sessions
+    def __init__(self, store: "SqliteSessionStore"):
+        super().__init__(None, None)
+        self.store = store
 
-@app.on_event("startup")
-async def startup_event():
-    print(f"doing startup_event")
-    global db_engine, chat_sessions
-    db_engine, chat_sessions = setup_database()
+    async def get_summary(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return await self.store.get_summary(session_id)
 
+    async def save_summary(self, session_id: str, summary: str, covered_count: int):
+        await self.store.save_summary(session_id, summary, covered_count)
 
-def hash_api_key(api_key: str) -> str:
-    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
 
+class SessionReaper:
+    """
+    Deletes sessions idle for longer than their TTL, SESSION_REAPER_BATCH_SIZE at a
+    time. A batch is picked without locking anything, archived, then deleted in one
+    short transaction that skips the sessions written to in the meantime, so a turn
+    never waits on the reaper and a session that got a new turn is kept. With
+    SESSION_ARCHIVE_BUCKET set, each batch is first uploaded as one gzipped NDJSON
+    object in the /middleware/sessions/export format, and kept if the upload fails.
+    Shared message contents that only the reaped sessions referenced go with them.
+    Sessions that forks still read messages from are kept until the forks go. A
+    Postgres advisory lock lets only one worker reap at a time, so no batch is
+    archived twice.
+    """
 
-def get_session_data(session_id: str) -> Optional[Dict[str, Any]]:
-    with db_engine.connect() as conn:
-        stmt = select(chat_sessions.c.chat_history, chat_sessions.c.api_key_hash).where(
-            chat_sessions.c.session_id == session_id
+    LOCK_KEY = 0x5EA9E7
+
+    def __init__(
+        self, store: SessionStoreProtocol, engine: Optional[AsyncEngine] = None
+    ):
+        self.store = store
+        self.engine = engine
+        self.s3 = (
+            boto3.client("s3", endpoint_url=SESSION_ARCHIVE_ENDPOINT_URL or None)
+            if SESSION_ARCHIVE_BUCKET
+            else None
         )
-        result = conn.execute(stmt).fetchone()
-        if result:
-            return {
-                "chat_history": json.loads(result[0]) if result[0] else None,
-                "api_key_hash": result[1],
-            }
-    return None
 
+    @staticmethod
+    def policies():
+        # (condition, params) per TTL: each key with its own TTL, then all the rest
+        for api_key_hash, ttl in SESSION_TTL_BY_KEY.items():
+            if ttl > 0:
+                yield "api_key_hash = :api_key_hash", {
+                    "api_key_hash": api_key_hash,
+                    "ttl": ttl,
+                }
+        if SESSION_TTL_SECONDS > 0:
+            yield "(api_key_hash IS NULL OR NOT api_key_hash = ANY(:own_ttl_keys))", {
+                "own_ttl_keys": list(SESSION_TTL_BY_KEY),
+                "ttl": SESSION_TTL_SECONDS,
+            }
 
-def create_chat_history(
-    session_id: str, chat_history: List[Dict[str, str]], api_key_hash: str
-):
-    with db_engine.connect() as conn:
-        stmt = insert(chat_sessions).values(
-            session_id=session_id,
-            chat_history=json.dumps(chat_history),
-            api_key_hash=api_key_hash,
+    @asynccontextmanager
+    async def lease(self):
+        # A session-level lock, so no transaction stays open while the batches
+        # are archived. It goes with the connection if the worker dies.
+        if self.engine is None:
+            yield True
+            return
+        async with self.engine.connect() as conn:
+            leased = (
+                await conn.execute(
+                    text("SELECT pg_try_advisory_lock(:key)"), {"key": self.LOCK_KEY}
+                )
+            ).scalar()
+            await conn.commit()
+            try:
+                yield leased
+            finally:
+                if leased:
+                    await conn.execute(
+                        text("SELECT pg_advisory_unlock(:key)"), {"key": self.LOCK_KEY}
+                    )
+                    await conn.commit()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.sleep(SESSION_REAPER_INTERVAL_SECONDS)
+                async with self.lease() as leased:
+                    if not leased:
+                        continue
+                    for policy, params in self.policies():
+                        while (
+                            await self.reap_batch(policy, params)
+                            == SESSION_REAPER_BATCH_SIZE
+                        ):
+                            await asyncio.sleep(SESSION_REAPER_BATCH_PAUSE_SECONDS)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Session reaper error: {str(e)}")
+                metrics.incr("session_reaper_errors")
+
+    async def reap_batch(self, policy: str, params: Dict[str, Any]) -> int:
+        sessions = await self.store.idle_sessions(
+            policy, params, SESSION_REAPER_BATCH_SIZE
+        )
+        if not sessions:
+            return 0
+        if self.s3 is not None:
+            await self.archive([session_id for session_id, _ in sessions])
+        deleted = await self.store.delete_idle_sessions(sessions)
+        metrics.incr("sessions_expired", len(deleted))
+        return len(sessions)
+
+    async def archive(self, session_ids: List[str]):
+        lines = [
+            session_ndjson_line(session)
+            async for session in self.store.export_sessions(session_ids)
+        ]
+        body = await to_thread.run_sync(gzip.compress, b"".join(lines))
+        now = datetime.now(timezone.utc)
+        key = (
+            f"{SESSION_ARCHIVE_PREFIX}{now:%Y/%m/%d}/"
+            f"{now:%Y%m%dT%H%M%S}-{uuid.uuid4().hex}.ndjson.gz"
+        )
+        await to_thread.run_sync(
+            lambda: self.s3.put_object(
+                Bucket=SESSION_ARCHIVE_BUCKET,
+                Key=key,
+                Body=body,
+                ContentType="application/x-ndjson",
+                ContentEncoding="gzip",
+            )
         )
-        conn.execute(stmt)
-        conn.commit()
+        metrics.incr("sessions_archived", len(lines))
 
 
-def update_chat_history(session_id: str, chat_history: List[Dict[str, str]]):
-    with db_engine.connect() as conn:
-        stmt = (
-            update(chat_sessions)
-            .where(chat_sessions.c.session_id == session_id)
-            .values(chat_history=json.dumps(chat_history))
-        )
-        conn.execute(stmt)
-        conn.commit()
+class SqliteSessionReaper(SessionReaper):
+    """
+    SessionReaper for the SQLite session store, whose policies are written for
+    SQLite. Forks there have their own copy of the messages, so parents are reaped
+    like any other session. The workers of the node take turns through a lock file
+    next to the database.
+    """
+
+    @asynccontextmanager
+    async def lease(self):
+        with open(f"{SQLITE_DATABASE_PATH}.reaper-lock", "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def policies():
+        for policy, params in SessionReaper.policies():
+            if "own_ttl_keys" in params:
+                policy = (
+                    "(api_key_hash IS NULL OR api_key_hash NOT IN "
+                    "(SELECT value FROM json_each(:own_ttl_keys)))"
+                )
+                params = {**params, "own_ttl_keys": json.dumps(params["own_ttl_keys"])}
+            yield policy, params
+
+
+async def build_history_prompt(
+    session_id: str,
+    chat_history: List[Dict[str, Any]],
+    max_tokens: int,
+    api_key: str,
+) -> List[Dict[str, Any]]:
+    """
+    The messages to send upstream for a history-enabled turn: the history, with
+    its older turns replaced by their compaction summary when one is ready, trimmed
+    to max_tokens.
+    """
+    if history_compactor is None:
+        return history_window(chat_history, max_tokens)
+    count_message_tokens(chat_history)
+    if sum(m[TOKEN_COUNT_KEY] for m in chat_history) <= (
+        HISTORY_COMPACTION_THRESHOLD_TOKENS
+    ):
+        return history_window(chat_history, max_tokens)
+
+    summary = await history_compactor.get_summary(session_id)
+    covered = summary["covered_count"] if summary else 0
+    # Ask for a new summary once the raw tail has grown past the threshold again
+    if (
+        sum(m[TOKEN_COUNT_KEY] for m in chat_history[covered:])
+        > HISTORY_COMPACTION_THRESHOLD_TOKENS
+    ):
+        history_compactor.request(session_id, api_key)
+    if summary is None or covered > len(chat_history):
+        return history_window(chat_history, max_tokens)
+
+    compacted = [m for m in chat_history[:covered] if m.get("role") == "system"]
+    compacted.append(
+        {
+            "role": "system",
+            "content": f"Summary of the earlier conversation: {summary['summary']}",
+        }
+    )
+    compacted.extend(chat_history[covered:])
+    return history_window(compacted, max_tokens)
 
 
 class CustomEventStream:
@@ -330,7 +2013,7 @@ async def convert_bedrock_to_openai(
         additional_fields = {
             key: value
             for key, value in bedrock_request["additionalModelRequestFields"].items()
-            if key != "session_id" and key != "enable_history"
+            if key not in ("session_id", "enable_history", "max_history_tokens")
         }
         completion_params.update(additional_fields)
 
@@ -426,18 +2109,15 @@ def construct_prompt_text_from_variables(template_text: str, variables: dict) ->
 @app.get("/bedrock/health/liveliness")
 async def health_check():
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{LITELLM_ENDPOINT}/health/liveliness", timeout=5.0
+        response = await litellm_request(
+            "GET", f"{LITELLM_ENDPOINT}/health/liveliness", "health"
+        )
+        if response.status_code == 200:
+            return JSONResponse(content={"status": "healthy", "litellm": "connected"})
+        else:
+            return JSONResponse(
+                status_code=503, content={"status": "unhealthy", "litellm": "error"}
             )
-            if response.status_code == 200:
-                return JSONResponse(
-                    content={"status": "healthy", "litellm": "connected"}
-                )
-            else:
-                return JSONResponse(
-                    status_code=503, content={"status": "unhealthy", "litellm": "error"}
-                )
     except Exception as e:
         return JSONResponse(
             status_code=503,
@@ -445,6 +2125,70 @@ async def health_check():
         )
 
 
+@app.get("/middleware/metrics")
+async def get_middleware_metrics(request: Request):
+    # Counters cover every key's traffic, so only the master key may read them
+    require_master_key(request)
+    return metrics.snapshot()
+
+
+@app.get("/middleware/sessions/export")
+async def export_sessions(request: Request, format: str = "ndjson"):
+    """
+    Streams every session in chat_sessions, whatever key owns it, as NDJSON (one
+    session per line) or as a Parquet file. Requires the master key.
+    """
+    require_master_key(request)
+    replica_reads_allowed.set(True)
+    if format == "ndjson":
+        return StreamingResponse(
+            export_sessions_ndjson(), media_type="application/x-ndjson"
+        )
+    if format == "parquet":
+        return StreamingResponse(
+            export_sessions_parquet(),
+            media_type="application/vnd.apache.parquet",
+            headers={
+                "Content-Disposition": 'attachment; filename="chat_sessions.parquet"'
+            },
+        )
+    raise HTTPException(
+        status_code=400, detail={"error": "format must be ndjson or parquet"}
+    )
+
+
+@app.post("/middleware/sessions/import")
+async def import_sessions(request: Request, format: str = "ndjson"):
+    """
+    Restores sessions from a /middleware/sessions/export body, in batches of
+    SESSION_IMPORT_BATCH_SIZE, each one COPY and one transaction. Sessions whose ID
+    already exists are skipped. Requires the master key.
+    """
+    require_master_key(request)
+    if format == "ndjson":
+        batches = read_ndjson_sessions(request.stream())
+    elif format == "parquet":
+        batches = read_parquet_sessions(request.stream())
+    else:
+        raise HTTPException(
+            status_code=400, detail={"error": "format must be ndjson or parquet"}
+        )
+
+    imported = skipped = 0
+    try:
+        async for batch in batches:
+            inserted = await session_store.import_sessions(batch)
+            imported += inserted
+            skipped += len(batch) - inserted
+    except ValueError as e:
+        # Batches before the bad one are already committed
+        raise HTTPException(
+            status_code=400,
+            detail={"error": str(e), "imported": imported, "skipped": skipped},
+        )
+    return {"imported": imported, "skipped": skipped}
+
+
 async def process_chat_request(
     model_id: str, request: Request
 ) -> (Dict[str, Any], str):
@@ -453,6 +2197,7 @@ async def process_chat_request(
 
     session_id = additional_fields.get("session_id", None)
     enable_history = additional_fields.get("enable_history", False)
+    max_history_tokens = additional_fields.get("max_history_tokens", None)
 
     # print(f"session_id: {session_id}")
     # print(f"enable_history: {enable_history}")
@@ -474,7 +2219,7 @@ async def process_chat_request(
 
     if history_enabled:
         if session_id is not None:
-            session_data = get_session_data(session_id)
+            session_data = await get_session_data(session_id)
             # print(f"session_data: {session_data}")
             if session_data is not None:
                 # Verify API key hash matches
@@ -493,13 +2238,11 @@ async def process_chat_request(
 
             else:
                 # print(f"creating chat history and session_id is not None")
-                chat_history = []
-                create_chat_history(session_id, chat_history, provided_hash)
+                chat_history = await create_chat_history(session_id, provided_hash)
         else:
             # print(f"creating chat history and session_id is None")
             session_id = str(uuid.uuid4())
-            chat_history = []
-            create_chat_history(session_id, chat_history, provided_hash)
+            chat_history = await create_chat_history(session_id, provided_hash)
     else:
         chat_history = []
 
@@ -514,28 +2257,33 @@ async def process_chat_request(
         if user_messages_this_round:
             chat_history.append(user_messages_this_round[-1])
 
-        # Replace openai_format["messages"] with the full chat_history
-        openai_format["messages"] = chat_history
-
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            LITELLM_CHAT,
-            json=openai_format,
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-            },
-            timeout=155.0,
+        # Replace openai_format["messages"] with the chat_history window
+        openai_format["messages"] = await build_history_prompt(
+            session_id,
+            chat_history,
+            history_token_budget(max_history_tokens, provided_hash),
+            api_key,
         )
 
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=response.status_code,
-                detail={"error": f"Error from LiteLLM endpoint: {response.text}"},
-            )
+    response = await litellm_request(
+        "POST",
+        LITELLM_CHAT,
+        "converse",
+        json=openai_format,
+        headers={
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        },
+    )
+
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail={"error": f"Error from LiteLLM endpoint: {response.text}"},
+        )
 
-        openai_response = response.json()
-        bedrock_response = await convert_openai_to_bedrock(openai_response)
+    openai_response = response.json()
+    bedrock_response = await convert_openai_to_bedrock(openai_response)
 
     # Append assistant's response to history
     if history_enabled:
@@ -543,7 +2291,11 @@ async def process_chat_request(
         chat_history.append(
             {"role": "assistant", "content": assistant_message["content"]}
         )
-        update_chat_history(session_id, chat_history)
+        await update_chat_history(
+            session_id,
+            chat_history,
+            openai_response.get("model") or openai_format.get("model"),
+        )
         bedrock_response["session_id"] = session_id
 
     return bedrock_response, session_id
@@ -565,12 +2317,13 @@ async def process_streaming_chat_request(
     additional_fields = body.get("additionalModelRequestFields", {})
     session_id = additional_fields.get("session_id", None)
     enable_history = additional_fields.get("enable_history", False)
+    max_history_tokens = additional_fields.get("max_history_tokens", None)
 
     history_enabled = (session_id is not None) or enable_history
 
     if history_enabled:
         if session_id is not None:
-            session_data = get_session_data(session_id)
+            session_data = await get_session_data(session_id)
             if session_data is not None:
                 if session_data["api_key_hash"] != provided_hash:
                     raise HTTPException(
@@ -581,12 +2334,10 @@ async def process_streaming_chat_request(
                     session_data["chat_history"] if session_data["chat_history"] else []
                 )
             else:
-                chat_history = []
-                create_chat_history(session_id, chat_history, provided_hash)
+                chat_history = await create_chat_history(session_id, provided_hash)
         else:
             session_id = str(uuid.uuid4())
-            chat_history = []
-            create_chat_history(session_id, chat_history, provided_hash)
+            chat_history = await create_chat_history(session_id, provided_hash)
     else:
         chat_history = []
 
@@ -600,11 +2351,16 @@ async def process_streaming_chat_request(
         if user_messages_this_round:
             chat_history.append(user_messages_this_round[-1])
 
-        openai_params["messages"] = chat_history
+        openai_params["messages"] = await build_history_prompt(
+            session_id,
+            chat_history,
+            history_token_budget(max_history_tokens, provided_hash),
+            api_key,
+        )
 
     # print(f'final message sent to llm: {openai_params["messages"]}')
 
-    client = AsyncOpenAI(api_key=api_key, base_url=LITELLM_ENDPOINT)
+    client = openai_clients.get(api_key)
     stream = await client.chat.completions.create(**openai_params)
 
     assistant_content_parts = []
@@ -648,13 +2404,14 @@ async def finalize_streaming_chat_history(
     session_id: str,
     chat_history: List[Dict[str, str]],
     assistant_content_parts: List[str],
+    model: Optional[str] = None,
 ):
     assistant_message = {
         "role": "assistant",
         "content": "".join(assistant_content_parts),
     }
     chat_history.append(assistant_message)
-    update_chat_history(session_id, chat_history)
+    await update_chat_history(session_id, chat_history, model)
 
 
 @app.post("/bedrock/model/{prompt_arn_prefix}/{prompt_id}/converse-stream")
@@ -681,7 +2438,7 @@ async def handle_bedrock_streaming_request(model_id: str, request: Request):
                 yield event
             if history_enabled:
                 await finalize_streaming_chat_history(
-                    session_id, chat_history, assistant_content_parts
+                    session_id, chat_history, assistant_content_parts, model_id
                 )
 
         response = StreamingResponse(
@@ -742,6 +2499,18 @@ async def handle_bedrock_request(model_id: str, request: Request):
         )
 
 
+# Hop-by-hop or irrelevant headers that are not copied from LiteLLM responses
+EXCLUDED_UPSTREAM_HEADERS = {
+    "content-length",
+    "transfer-encoding",
+    "content-encoding",
+    "connection",
+    "keep-alive",
+    "server",
+    "date",
+}
+
+
 async def get_chat_stream(
     api_key: str,
     data: dict,
@@ -751,39 +2520,23 @@ async def get_chat_stream(
 ):
     """
     Returns a StreamingResponse that continuously yields messages from the LLM endpoint
-    using aiohttp, and also returns the upstream headers in the response.
+    over the shared LiteLLM connection pool, and also returns the upstream headers in
+    the response.
     """
 
-    # Semgrep incorrectly marks this method as unused
-    # nosemgrep
-    async def read_linewise(aiohttp_body, chunk_size=1024):
-        """
-        Reads raw chunks from the aiohttp response body and yields complete lines.
-        """
-        buffer = ""
-        async for chunk in aiohttp_body.iter_chunked(chunk_size):
-            buffer += chunk.decode("utf-8")
-            while "\n" in buffer:
-                line, buffer = buffer.split("\n", 1)
-                yield line
-        # If anything remains in the buffer, yield it as a final line
-        if buffer:
-            yield buffer
-
-    # We create our session manually (instead of `async with`) so that we can
-    # keep it open for the entire duration of the stream and close it later.
-    session = aiohttp.ClientSession()
-
     # Make the POST request up front (so we can capture headers right away).
+    # The response stays open for the entire duration of the stream and is closed
+    # (returning its connection to the pool) once streaming is done.
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {api_key}",
     }
-    response = await session.post(
-        f"{LITELLM_ENDPOINT}/v1/chat/completions",
+    response = await litellm_stream(
+        "POST",
+        LITELLM_CHAT,
+        "stream",
         json=data,
         headers=headers,
-        timeout=None,  # or aiohttp.ClientTimeout(...)
     )
 
     # Extract upstream headers
@@ -796,7 +2549,7 @@ async def get_chat_stream(
 
         try:
             # Read the response line by line
-            async for line in read_linewise(response.content):
+            async for line in response.aiter_lines():
                 line = line.strip()
                 if not line:
                     continue
@@ -842,29 +2595,18 @@ async def get_chat_stream(
                     "content": "".join(assistant_content_parts),
                 }
                 chat_history.append(assistant_message)
-                update_chat_history(session_id, chat_history)
+                await update_chat_history(session_id, chat_history, data.get("model"))
 
         finally:
-            # Very important: Close the session once we're done streaming.
-            await session.close()
+            # Very important: Release the connection once we're done streaming.
+            await close_litellm_stream(response)
 
     # Build the StreamingResponse using our generator
     sresponse = StreamingResponse(stream_events(), media_type="text/event-stream")
 
-    # Exclude certain hop-by-hop or irrelevant headers
-    excluded_headers = {
-        "content-length",
-        "transfer-encoding",
-        "content-encoding",
-        "connection",
-        "keep-alive",
-        "server",
-        "date",
-    }
-
     # Attach upstream headers to our outgoing response
     for k, v in response_headers.items():
-        if k.lower() not in excluded_headers:
+        if k.lower() not in EXCLUDED_UPSTREAM_HEADERS:
             sresponse.headers[k] = v
 
     return sresponse
@@ -881,6 +2623,7 @@ async def proxy_request(request: Request):
 
         enable_history = data.pop("enable_history", False)
         session_id = data.pop("session_id", None)
+        max_history_tokens = data.pop("max_history_tokens", None)
         history_enabled = (session_id is not None) or enable_history
 
         # Get API key from headers
@@ -896,7 +2639,7 @@ async def proxy_request(request: Request):
         if history_enabled:
             if session_id is not None:
                 # Retrieve or verify existing session
-                session_data = get_session_data(session_id)
+                session_data = await get_session_data(session_id)
                 if session_data is not None:
                     if session_data["api_key_hash"] != provided_hash:
                         raise HTTPException(
@@ -907,13 +2650,11 @@ async def proxy_request(request: Request):
                         )
                     chat_history = session_data["chat_history"] or []
                 else:
-                    chat_history = []
-                    create_chat_history(session_id, chat_history, provided_hash)
+                    chat_history = await create_chat_history(session_id, provided_hash)
             else:
                 # No session_id but enable_history = True, so create a new session
                 session_id = str(uuid.uuid4())
-                chat_history = []
-                create_chat_history(session_id, chat_history, provided_hash)
+                chat_history = await create_chat_history(session_id, provided_hash)
         else:
             # History not enabled: start with empty
             chat_history = []
@@ -923,8 +2664,17 @@ async def proxy_request(request: Request):
         for msg in new_messages:
             chat_history.append(msg)
 
-        # Now data["messages"] should be the entire conversation the model sees
-        data["messages"] = chat_history
+        # Now data["messages"] should be the conversation the model sees, trimmed
+        # to the history token budget
+        if history_enabled:
+            data["messages"] = await build_history_prompt(
+                session_id,
+                chat_history,
+                history_token_budget(max_history_tokens, provided_hash),
+                api_key,
+            )
+        else:
+            data["messages"] = chat_history
 
         # ---------------------------------------------------------------------
         # Handle optional "Bedrock Prompt" logic (unchanged from your snippet):
@@ -969,16 +2719,16 @@ async def proxy_request(request: Request):
                 "Content-Type": "application/json",
                 "Authorization": f"Bearer {api_key}",
             }
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{LITELLM_ENDPOINT}/v1/chat/completions",
-                    headers=headers,
-                    json=data,
-                ) as resp:
-                    response_headers = dict(resp.headers)
-                    # Avoid passing through invalid content-length
-                    response_headers.pop("Content-Length", None)
-                    response_dict = await resp.json()
+            resp = await litellm_request(
+                "POST", LITELLM_CHAT, "chat", headers=headers, json=data
+            )
+            # Avoid passing through invalid content-length and encoding headers
+            response_headers = {
+                k: v
+                for k, v in resp.headers.items()
+                if k.lower() not in EXCLUDED_UPSTREAM_HEADERS
+            }
+            response_dict = resp.json()
 
             # If there's a response from the assistant, save it to history
             if response_dict.get("choices"):
@@ -987,7 +2737,11 @@ async def proxy_request(request: Request):
                     chat_history.append(
                         {"role": "assistant", "content": assistant_message["content"]}
                     )
-                    update_chat_history(session_id, chat_history)
+                    await update_chat_history(
+                        session_id,
+                        chat_history,
+                        response_dict.get("model") or data.get("model"),
+                    )
 
             # Return session_id in the response if we have one
             if session_id:
@@ -1034,6 +2788,7 @@ def convert_openai_to_bedrock_history(
 
 @app.post("/bedrock/chat-history")
 async def get_bedrock_chat_history(request: Request):
+    replica_reads_allowed.set(True)
     body = await request.json()
     session_id = body.get("session_id")
     if not session_id:
@@ -1049,7 +2804,37 @@ async def get_bedrock_chat_history(request: Request):
         )
     provided_hash = hash_api_key(api_key)
 
-    session_data = get_session_data(session_id)
+    requested_range = history_range(body)
+    session_version = await get_session_version(session_id)
+    if not session_version or session_version["api_key_hash"] != provided_hash:
+        raise HTTPException(
+            status_code=401,
+            detail={"error": "Unauthorized: API key does not match session owner"},
+        )
+    etag = history_etag(session_version["version"], requested_range)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    if requested_range is not None:
+        page = await get_session_messages(session_id, *requested_range)
+        if not page or page["api_key_hash"] != provided_hash:
+            raise HTTPException(
+                status_code=401,
+                detail={"error": "Unauthorized: API key does not match session owner"},
+            )
+        bedrock_format = convert_openai_to_bedrock_history(page["messages"])
+        bedrock_format["offset"] = page["offset"]
+        bedrock_format["total"] = page["total"]
+        return JSONResponse(content=bedrock_format, headers={"ETag": etag})
+
+    if should_stream_history(session_version):
+        return StreamingResponse(
+            stream_history_json(session_id, bedrock=True),
+            media_type="application/json",
+            headers={"ETag": etag},
+        )
+
+    session_data = await get_session_data(session_id)
     if not session_data or session_data["api_key_hash"] != provided_hash:
         raise HTTPException(
             status_code=401,
@@ -1058,13 +2843,15 @@ async def get_bedrock_chat_history(request: Request):
 
     chat_history = session_data["chat_history"]
     if chat_history is None:
-        return {"messages": [], "system": []}
-    bedrock_format = convert_openai_to_bedrock_history(chat_history)
-    return bedrock_format
+        bedrock_format = {"messages": [], "system": []}
+    else:
+        bedrock_format = convert_openai_to_bedrock_history(chat_history)
+    return JSONResponse(content=bedrock_format, headers={"ETag": etag})
 
 
 @app.post("/chat-history")
 async def get_openai_chat_history(request: Request):
+    replica_reads_allowed.set(True)
     body = await request.json()
     session_id = body.get("session_id")
     if not session_id:
@@ -1080,7 +2867,41 @@ async def get_openai_chat_history(request: Request):
         )
     provided_hash = hash_api_key(api_key)
 
-    session_data = get_session_data(session_id)
+    requested_range = history_range(body)
+    session_version = await get_session_version(session_id)
+    if not session_version or session_version["api_key_hash"] != provided_hash:
+        raise HTTPException(
+            status_code=401,
+            detail={"error": "Unauthorized: API key does not match session owner"},
+        )
+    etag = history_etag(session_version["version"], requested_range)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    if requested_range is not None:
+        page = await get_session_messages(session_id, *requested_range)
+        if not page or page["api_key_hash"] != provided_hash:
+            raise HTTPException(
+                status_code=401,
+                detail={"error": "Unauthorized: API key does not match session owner"},
+            )
+        return JSONResponse(
+            content={
+                "messages": strip_stored_fields(page["messages"]),
+                "offset": page["offset"],
+                "total": page["total"],
+            },
+            headers={"ETag": etag},
+        )
+
+    if should_stream_history(session_version):
+        return StreamingResponse(
+            stream_history_json(session_id, bedrock=False),
+            media_type="application/json",
+            headers={"ETag": etag},
+        )
+
+    session_data = await get_session_data(session_id)
     if not session_data or session_data["api_key_hash"] != provided_hash:
         raise HTTPException(
             status_code=401,
@@ -1090,11 +2911,117 @@ async def get_openai_chat_history(request: Request):
     chat_history = session_data["chat_history"]
     if chat_history is None:
         chat_history = []
-    return {"messages": chat_history}
+    return JSONResponse(
+        content={"messages": strip_stored_fields(chat_history)},
+        headers={"ETag": etag},
+    )
+
+
+@app.post("/chat-history/fork")
+async def fork_chat_history(request: Request):
+    """
+    Starts a new session from the first message_count messages of session_id (all
+    of them if omitted), so a conversation can branch without resending its
+    history. The new session belongs to the same key; the original is unchanged.
+    """
+    body = await request.json()
+    session_id = body.get("session_id")
+    if not session_id:
+        raise HTTPException(status_code=400, detail="session_id is required")
+    message_count = body.get("message_count")
+    if message_count is not None and (
+        not isinstance(message_count, int)
+        or isinstance(message_count, bool)
+        or message_count < 0
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail={"error": "message_count must be a non-negative integer"},
+        )
+
+    # Verify the API key
+    auth_header = request.headers.get("Authorization")
+    if auth_header and auth_header.startswith("Bearer "):
+        api_key = auth_header[len("Bearer ") :]
+    else:
+        raise HTTPException(
+            status_code=401, detail={"error": "Missing or invalid Authorization header"}
+        )
+    provided_hash = hash_api_key(api_key)
+
+    session_version = await get_session_version(session_id)
+    if not session_version or session_version["api_key_hash"] != provided_hash:
+        raise HTTPException(
+            status_code=401,
+            detail={"error": "Unauthorized: API key does not match session owner"},
+        )
+
+    new_session_id = str(uuid.uuid4())
+    forked_count = await fork_chat_session(session_id, new_session_id, message_count)
+    if forked_count is None:
+        raise HTTPException(
+            status_code=400,
+            detail={"error": "message_count is more than the session has"},
+        )
+    return JSONResponse(
+        content={
+            "session_id": new_session_id,
+            "parent_session_id": session_id,
+            "message_count": forked_count,
+        }
+    )
+
+
+@app.post("/chat-history/batch")
+async def get_chat_history_batch(request: Request):
+    """
+    History for many sessions in one call, streamed as NDJSON: one
+    {"session_id", "messages"} line per session owned by the caller's key, then one
+    {"session_id", "error"} line per ID that doesn't exist or belongs to another
+    key. "format": "bedrock" returns Bedrock-style messages and system instead.
+    """
+    replica_reads_allowed.set(True)
+    body = await request.json()
+    session_ids = body.get("session_ids")
+    if (
+        not isinstance(session_ids, list)
+        or not session_ids
+        or not all(isinstance(s, str) for s in session_ids)
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail={"error": "session_ids must be a non-empty list of strings"},
+        )
+    session_ids = list(dict.fromkeys(session_ids))
+    if len(session_ids) > HISTORY_BATCH_MAX_SESSIONS:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "error": f"At most {HISTORY_BATCH_MAX_SESSIONS} session_ids per call"
+            },
+        )
+
+    # Verify the API key
+    auth_header = request.headers.get("Authorization")
+    if auth_header and auth_header.startswith("Bearer "):
+        api_key = auth_header[len("Bearer ") :]
+    else:
+        raise HTTPException(
+            status_code=401, detail={"error": "Missing or invalid Authorization header"}
+        )
+    provided_hash = hash_api_key(api_key)
+
+    return StreamingResponse(
+        stream_history_ndjson(
+            session_ids, provided_hash, bedrock=body.get("format") == "bedrock"
+        ),
+        media_type="application/x-ndjson",
+    )
 
 
 @app.post("/session-ids")
 async def list_session_ids_for_api_key(request: Request):
+    replica_reads_allowed.set(True)
     # Verify the API key
     auth_header = request.headers.get("Authorization")
     if auth_header and auth_header.startswith("Bearer "):
@@ -1106,32 +3033,59 @@ async def list_session_ids_for_api_key(request: Request):
 
     provided_hash = hash_api_key(api_key)
 
-    # Query all session_ids for this api_key_hash
-    with db_engine.connect() as conn:
-        stmt = select(chat_sessions.c.session_id).where(
-            chat_sessions.c.api_key_hash == provided_hash
-        )
-        results = conn.execute(stmt).fetchall()
+    # Optional paging parameters: {"limit", "cursor", "include_metadata"}
+    body = await request.body()
+    params = json.loads(body) if body else {}
+    if not any(name in params for name in ("limit", "cursor", "include_metadata")):
+        # Callers that don't page get every session_id, as before paging existed
+        session_ids = []
+        cursor = None
+        while True:
+            sessions, cursor = await session_store.list_sessions(
+                provided_hash, SESSION_LIST_MAX_LIMIT, cursor, False
+            )
+            session_ids.extend(session["session_id"] for session in sessions)
+            if cursor is None:
+                return {"session_ids": session_ids}
+    try:
+        limit = int(params.get("limit") or SESSION_LIST_DEFAULT_LIMIT)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail={"error": "Invalid limit"})
+    limit = max(1, min(limit, SESSION_LIST_MAX_LIMIT))
+    include_metadata = bool(params.get("include_metadata", False))
 
-    session_ids = [row[0] for row in results]
+    # One page of session_ids for this api_key_hash
+    try:
+        sessions, next_cursor = await session_store.list_sessions(
+            provided_hash, limit, params.get("cursor"), include_metadata
+        )
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail={"error": "Invalid cursor"})
 
-    return {"session_ids": session_ids}
+    response = {
+        "session_ids": [session["session_id"] for session in sessions],
+        "next_cursor": next_cursor,
+    }
+    if include_metadata:
+        response["sessions"] = sessions
+    return response
 
 
 # ToDo: Enforce that a non-admin user can only create keys for themself if this bug isn't fixed in a timely manner https://github.com/BerriAI/litellm/issues/7336
 @app.post("/key/generate")
 async def forward_key_generate(request: Request):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{LITELLM_ENDPOINT}/key/generate",
-            content=await request.body(),
-            headers=request.headers,
-        )
-        return Response(
-            content=response.content,
-            status_code=response.status_code,
-            headers=response.headers,
-        )
+    response = await litellm_request(
+        "POST",
+        f"{LITELLM_ENDPOINT}/key/generate",
+        "management",
+        content=await request.body(),
+        headers=request.headers,
+    )
+    return Response(
+        content=response.content,
+        status_code=response.status_code,
+        headers=response.headers,
+    )
 
 
 @app.post("/user/new")
@@ -1187,17 +3141,18 @@ async def forward_user_new(request: Request):
 
     print(f"final_headers: {final_headers}")
     print(f"request_body: {request_body}")
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{LITELLM_ENDPOINT}/user/new",
-            content=request_body,
-            headers=final_headers,
-        )
-        return Response(
-            content=response.content,
-            status_code=response.status_code,
-            headers=response.headers,
-        )
+    response = await litellm_request(
+        "POST",
+        f"{LITELLM_ENDPOINT}/user/new",
+        "management",
+        content=request_body,
+        headers=final_headers,
+    )
+    return Response(
+        content=response.content,
+        status_code=response.status_code,
+        headers=response.headers,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,60 @@
+"""
+In-process metrics of a middleware worker, shared by the app and the session stores.
+"""
+
+from collections import defaultdict
+from typing import Any, Dict, List
+
+
+class MiddlewareMetrics:
+    """
+    In-process counters and histograms for this worker, served by /middleware/metrics.
+    Each uvicorn worker keeps its own copy.
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.histograms = {}
+
+    def incr(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def set_gauge(self, name: str, value):
+        self.gauges[name] = value
+
+    def observe(self, name: str, value: float, buckets: List[float]):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = {
+                "count": 0,
+                "sum": 0.0,
+                "buckets": {str(bound): 0 for bound in buckets} | {"+Inf": 0},
+            }
+            self.histograms[name] = histogram
+        histogram["count"] += 1
+        histogram["sum"] += value
+        # Cumulative buckets, as in Prometheus
+        for bound in buckets:
+            if value <= bound:
+                histogram["buckets"][str(bound)] += 1
+        histogram["buckets"]["+Inf"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "histograms": {
+                name: {**h, "buckets": dict(h["buckets"])}
+                for name, h in self.histograms.items()
+            },
+        }
+
+
+LATENCY_MS_BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+
+BATCH_SIZE_BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+
+metrics = MiddlewareMetrics()
@@ -0,0 +1,33 @@
+"""
+Chat session storage: the database stores behind CHAT_HISTORY_STORAGE and the tiers
+create_session_store stacks in front of them. All of them implement
+SessionStoreProtocol.
+"""
+
+from session_store.base import (
+    MODEL_KEY,
+    SESSION_EXPORT_COLUMNS,
+    ChatHistory,
+    DatabaseStoreProtocol,
+    InvalidCursor,
+    SessionStoreProtocol,
+    estimate_history_bytes,
+    history_owner,
+    last_model,
+    mark_written,
+    rebase_history,
+    stored_message_count,
+    stored_version,
+)
+from session_store.batching import BatchingSessionStore, HistoryWriter
+from session_store.cache import CachedSessionStore, SessionCache
+from session_store.codec import HistoryCodec
+from session_store.deferred import DeferredHistoryStore, deferred_writes
+from session_store.postgres import (
+    JsonbSessionStore,
+    MessageTableSessionStore,
+    SessionStore,
+)
+from session_store.redis_tier import RedisSessionStore
+from session_store.replica import ReplicaRoutingStore, replica_reads_allowed
+from session_store.sqlite import SqliteSessionStore
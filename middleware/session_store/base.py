@@ -0,0 +1,255 @@
+"""
+Chat history as the session stores load and write it, helpers shared by the store
+backends, and the store interface every backend and tier implements.
+"""
+
+import base64
+import json
+from abc import abstractmethod
+from datetime import datetime
+from typing import Any, AsyncGenerator, Dict, List, Optional, Protocol, Tuple
+
+from middleware_metrics import metrics
+
+# Stored with assistant messages: the model that produced the reply
+MODEL_KEY = "model"
+
+# Columns of an exported session, besides chat_history
+SESSION_EXPORT_COLUMNS = (
+    "session_id",
+    "api_key_hash",
+    "created_at",
+    "updated_at",
+    "message_count",
+    "last_model",
+    "version",
+)
+
+
+class ChatHistory(list):
+    """
+    A conversation loaded from the session store. stored_count is the number of
+    messages already persisted, so the store can tell which messages a turn appended.
+    A plain list is treated as having nothing stored yet. version is the
+    chat_sessions.version the conversation was read at, if the store tracks it; a
+    write only applies while the session is still at that version. api_key_hash is
+    the owner, where known, so a tier that lost the session can still create it.
+    """
+
+    def __init__(
+        self,
+        messages=(),
+        stored_count: int = 0,
+        version: Optional[int] = None,
+        api_key_hash: Optional[str] = None,
+    ):
+        super().__init__(messages)
+        self.stored_count = stored_count
+        self.version = version
+        self.api_key_hash = api_key_hash
+
+
+def stored_message_count(chat_history: List[Dict[str, Any]]) -> int:
+    return getattr(chat_history, "stored_count", 0)
+
+
+def stored_version(chat_history: List[Dict[str, Any]]) -> Optional[int]:
+    return getattr(chat_history, "version", None)
+
+
+def history_owner(chat_history: List[Dict[str, Any]]) -> Optional[str]:
+    return getattr(chat_history, "api_key_hash", None)
+
+
+def rebase_history(
+    chat_history: "ChatHistory", stored: List[Dict[str, Any]], version: int
+):
+    # Another turn was written to the session after chat_history was read: put the
+    # messages this turn appended after everything that is stored now
+    new_messages = chat_history[chat_history.stored_count :]
+    chat_history[:] = list(stored) + new_messages
+    chat_history.stored_count = len(stored)
+    chat_history.version = version
+    metrics.incr("history_write_conflicts")
+
+
+def mark_written(chat_history: List[Dict[str, Any]], version: Optional[int]):
+    if isinstance(chat_history, ChatHistory):
+        chat_history.stored_count = len(chat_history)
+        chat_history.version = version
+
+
+def message_to_row(message: Dict[str, Any]) -> Dict[str, Any]:
+    # Plain text content gets its own column. Anything else (content parts, tool
+    # calls, names) is kept as JSON in "extra" so the message round-trips unchanged.
+    extra = {k: v for k, v in message.items() if k not in ("role", "content")}
+    content = message.get("content")
+    if "content" in message and not isinstance(content, str):
+        extra["content"] = content
+        content = None
+    return {
+        "role": message.get("role"),
+        "content": content,
+        "extra": json.dumps(extra) if extra else None,
+    }
+
+
+def row_to_message(role: str, content: Optional[str], extra: Optional[str]):
+    message = {"role": role}
+    if content is not None:
+        message["content"] = content
+    if extra:
+        message.update(json.loads(extra))
+    return message
+
+
+def last_model(messages: List[Dict[str, Any]]) -> Optional[str]:
+    for message in reversed(messages):
+        if message.get(MODEL_KEY):
+            return message[MODEL_KEY]
+    return None
+
+
+class InvalidCursor(ValueError):
+    """A list_sessions cursor that no list_sessions call returned."""
+
+
+def encode_session_cursor(updated_at: datetime, session_id: str) -> str:
+    raw = json.dumps([updated_at.isoformat(), session_id])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_session_cursor(cursor: str) -> (datetime, str):
+    try:
+        updated_at, session_id = json.loads(base64.urlsafe_b64decode(cursor))
+        return datetime.fromisoformat(updated_at), session_id
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+
+
+def resolve_range(total: int, offset: int, limit: Optional[int]) -> (int, int):
+    # A negative offset counts back from the end of the conversation
+    start = max(total + offset, 0) if offset < 0 else min(offset, total)
+    end = total if limit is None else min(start + limit, total)
+    return start, end
+
+
+def estimate_history_bytes(chat_history: List[Dict[str, Any]]) -> int:
+    # Cheap approximation of the in-memory size: text length plus a fixed overhead
+    # per message, so sizing an entry never has to serialize it
+    size = 0
+    for message in chat_history:
+        content = message.get("content")
+        size += 100 + (len(content) if isinstance(content, str) else len(str(content)))
+    return size
+
+
+class SessionStoreProtocol(Protocol):
+    """
+    The session store API the app uses. Every database store and every tier that
+    wraps one (cache, Redis, group commit, deferred writes, replica routing)
+    implements all of it, so the tiers stack in any order.
+    """
+
+    @abstractmethod
+    async def get_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """The session's chat_history (a ChatHistory) and api_key_hash, or None."""
+
+    @abstractmethod
+    async def create_session(
+        self, session_id: str, chat_history: List[Dict[str, str]], api_key_hash: str
+    ):
+        """Creates the session, owned by api_key_hash, with chat_history."""
+
+    @abstractmethod
+    async def update_chat_history(
+        self, session_id: str, chat_history: List[Dict[str, str]]
+    ):
+        """
+        Persists the messages appended to chat_history since it was loaded. A turn
+        written concurrently is kept: this turn's messages go after it.
+        """
+
+    @abstractmethod
+    async def get_version(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """
+        The session's owner and an opaque version that changes on every history
+        write, or None if there is no session.
+        """
+
+    @abstractmethod
+    async def get_messages(
+        self, session_id: str, offset: int = 0, limit: Optional[int] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Messages [offset, offset + limit) of a session, negative offsets counting
+        from the end, with the owner, the resolved start and the total count.
+        """
+
+    @abstractmethod
+    def stream_messages(self, session_id: str) -> AsyncGenerator:
+        """Yields a session's messages in order."""
+
+    @abstractmethod
+    def stream_sessions(
+        self, session_ids: List[str], api_key_hash: str
+    ) -> AsyncGenerator:
+        """Yields (session_id, chat_history) for those of session_ids the key owns."""
+
+    @abstractmethod
+    async def fork_session(
+        self, session_id: str, new_session_id: str, message_count: Optional[int]
+    ) -> Optional[int]:
+        """
+        Copies the first message_count messages (all if None) of session_id to
+        new_session_id. Returns the new message count, or None if there weren't
+        that many.
+        """
+
+    @abstractmethod
+    async def list_sessions(
+        self,
+        api_key_hash: str,
+        limit: int,
+        cursor: Optional[str] = None,
+        include_metadata: bool = False,
+    ) -> (List[Dict[str, Any]], Optional[str]):
+        """
+        One page of the key's sessions, most recently updated first, and the
+        cursor of the next page. Raises InvalidCursor for a cursor it didn't issue.
+        """
+
+    @abstractmethod
+    def export_sessions(
+        self, session_ids: Optional[List[str]] = None
+    ) -> AsyncGenerator:
+        """Yields every session (or those in session_ids) as an export record."""
+
+    @abstractmethod
+    async def import_sessions(self, sessions: List[Dict[str, Any]]) -> int:
+        """Inserts export records, skipping existing IDs. Returns how many."""
+
+    @abstractmethod
+    async def idle_sessions(
+        self, policy: str, params: Dict[str, Any], limit: int
+    ) -> List[Tuple[str, int]]:
+        """(session_id, version) of sessions the expiry policy selects."""
+
+    @abstractmethod
+    async def delete_idle_sessions(self, sessions: List[Tuple[str, int]]) -> List[str]:
+        """
+        Deletes those of idle_sessions' (session_id, version) pairs that are still at
+        that version. Returns the deleted session IDs.
+        """
+
+    @abstractmethod
+    async def close(self):
+        """Finishes outstanding writes and releases connections."""
+
+
+class DatabaseStoreProtocol(SessionStoreProtocol, Protocol):
+    """A store on a database, which HistoryWriter commits batches of writes to."""
+
+    @abstractmethod
+    async def write_batch(self, batch: Dict[str, "ChatHistory"]):
+        """Writes the histories of several sessions (session_id -> ChatHistory)."""
@@ -0,0 +1,241 @@
+"""
+Group commit: concurrent history writes share a transaction.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+from middleware_metrics import BATCH_SIZE_BUCKETS, LATENCY_MS_BUCKETS, metrics
+from session_store.base import (
+    ChatHistory,
+    DatabaseStoreProtocol,
+    SessionStoreProtocol,
+    history_owner,
+    mark_written,
+    stored_message_count,
+    stored_version,
+)
+
+
+class HistoryWriter:
+    """
+    Group-commit writer for chat history. Requests hand their write to submit() and
+    wait on the returned future. A single task per worker collects pending writes,
+    coalesces several writes to the same session into one, and commits up to
+    max_batch_size sessions per transaction with the store's write_batch().
+    """
+
+    def __init__(
+        self, store: DatabaseStoreProtocol, max_batch_size: int, max_delay_ms: float
+    ):
+        self.store = store
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000
+        # session_id -> (ChatHistory to write, futures waiting on it)
+        self.pending = OrderedDict()
+        self.has_pending = asyncio.Event()
+        self.batch_full = asyncio.Event()
+        self.closing = False
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def submit(self, session_id: str, chat_history: List[Dict[str, Any]]):
+        if self.closing:
+            raise RuntimeError("History writer is shut down")
+        future = asyncio.get_running_loop().create_future()
+        incoming = ChatHistory(
+            chat_history,
+            stored_message_count(chat_history),
+            stored_version(chat_history),
+        )
+        if session_id in self.pending:
+            queued, futures = self.pending[session_id]
+            self.pending[session_id] = (
+                self.merge(queued, incoming),
+                futures + [future],
+            )
+            metrics.incr("history_writer_coalesced")
+        else:
+            self.pending[session_id] = (incoming, [future])
+        self.has_pending.set()
+        if len(self.pending) >= self.max_batch_size:
+            self.batch_full.set()
+        return future
+
+    @staticmethod
+    def merge(queued: "ChatHistory", incoming: "ChatHistory") -> "ChatHistory":
+        # The merged write starts from what the queued one read, version included
+        if incoming.stored_count >= len(queued) and incoming.version == queued.version:
+            # The newer turn already includes everything queued for this session
+            return ChatHistory(
+                incoming, queued.stored_count, queued.version, history_owner(queued)
+            )
+        # Concurrent turns on the same session: keep the new messages of both
+        return ChatHistory(
+            list(queued) + incoming[incoming.stored_count :],
+            queued.stored_count,
+            queued.version,
+            history_owner(queued),
+        )
+
+    async def run(self):
+        while True:
+            await self.has_pending.wait()
+            if not self.closing and len(self.pending) < self.max_batch_size:
+                try:
+                    await asyncio.wait_for(self.batch_full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            await self.flush_once()
+            if self.closing and not self.pending:
+                return
+
+    async def flush_once(self):
+        batch = {}
+        while self.pending and len(batch) < self.max_batch_size:
+            session_id, entry = self.pending.popitem(last=False)
+            batch[session_id] = entry
+        if not self.pending:
+            self.has_pending.clear()
+        if len(self.pending) < self.max_batch_size:
+            self.batch_full.clear()
+        if not batch:
+            return
+
+        start = time.perf_counter()
+        try:
+            await self.store.write_batch(
+                {session_id: entry[0] for session_id, entry in batch.items()}
+            )
+        except Exception as e:
+            print(f"History writer batch failed: {str(e)}")
+            metrics.incr("history_writer_failed_batches")
+            # Retry each session on its own so one bad write does not fail the others
+            for session_id, (chat_history, futures) in batch.items():
+                try:
+                    await self.store.update_chat_history(session_id, chat_history)
+                except Exception as session_error:
+                    self.resolve(futures, error=session_error)
+                else:
+                    self.resolve(futures, chat_history)
+            return
+        metrics.observe(
+            "history_writer_flush_latency_ms",
+            (time.perf_counter() - start) * 1000,
+            LATENCY_MS_BUCKETS,
+        )
+        metrics.observe("history_writer_batch_size", len(batch), BATCH_SIZE_BUCKETS)
+        for chat_history, futures in batch.values():
+            self.resolve(futures, chat_history)
+
+    @staticmethod
+    def resolve(
+        futures: List[asyncio.Future],
+        written: Optional["ChatHistory"] = None,
+        error: Optional[Exception] = None,
+    ):
+        # Waiters get the history as written, which includes the messages of every
+        # turn merged into the same write
+        for future in futures:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(written)
+            else:
+                future.set_exception(error)
+
+    async def close(self):
+        # Stop taking new writes and commit everything still pending
+        self.closing = True
+        self.has_pending.set()
+        if self.task is not None:
+            await self.task
+
+
+class BatchingSessionStore(SessionStoreProtocol):
+    """
+    Sends update_chat_history through a HistoryWriter. The call still returns only
+    once the write is committed, but commits are shared between concurrent requests.
+    """
+
+    def __init__(self, store: DatabaseStoreProtocol, writer: HistoryWriter):
+        self.store = store
+        self.writer = writer
+
+    # Only update_chat_history goes through the writer
+    async def get_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return await self.store.get_session(session_id)
+
+    async def create_session(
+        self, session_id: str, chat_history: List[Dict[str, str]], api_key_hash: str
+    ):
+        await self.store.create_session(session_id, chat_history, api_key_hash)
+
+    async def get_version(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return await self.store.get_version(session_id)
+
+    async def get_messages(
+        self, session_id: str, offset: int = 0, limit: Optional[int] = None
+    ) -> Optional[Dict[str, Any]]:
+        return await self.store.get_messages(session_id, offset, limit)
+
+    async def stream_messages(self, session_id: str) -> AsyncGenerator:
+        async for message in self.store.stream_messages(session_id):
+            yield message
+
+    async def stream_sessions(
+        self, session_ids: List[str], api_key_hash: str
+    ) -> AsyncGenerator:
+        async for item in self.store.stream_sessions(session_ids, api_key_hash):
+            yield item
+
+    async def fork_session(
+        self, session_id: str, new_session_id: str, message_count: Optional[int]
+    ) -> Optional[int]:
+        return await self.store.fork_session(session_id, new_session_id, message_count)
+
+    async def list_sessions(
+        self,
+        api_key_hash: str,
+        limit: int,
+        cursor: Optional[str] = None,
+        include_metadata: bool = False,
+    ) -> (List[Dict[str, Any]], Optional[str]):
+        return await self.store.list_sessions(
+            api_key_hash, limit, cursor, include_metadata
+        )
+
+    async def export_sessions(
+        self, session_ids: Optional[List[str]] = None
+    ) -> AsyncGenerator:
+        async for session in self.store.export_sessions(session_ids):
+            yield session
+
+    async def import_sessions(self, sessions: List[Dict[str, Any]]) -> int:
+        return await self.store.import_sessions(sessions)
+
+    async def idle_sessions(
+        self, policy: str, params: Dict[str, Any], limit: int
+    ) -> List[Tuple[str, int]]:
+        return await self.store.idle_sessions(policy, params, limit)
+
+    async def delete_idle_sessions(self, sessions: List[Tuple[str, int]]) -> List[str]:
+        return await self.store.delete_idle_sessions(sessions)
+
+    async def update_chat_history(
+        self, session_id: str, chat_history: List[Dict[str, str]]
+    ):
+        if len(chat_history) <= stored_message_count(chat_history):
+            return
+        written = await self.writer.submit(session_id, chat_history)
+        if isinstance(chat_history, ChatHistory):
+            chat_history[:] = written
+            mark_written(chat_history, written.version)
+
+    async def close(self):
+        await self.writer.close()
+        await self.store.close()
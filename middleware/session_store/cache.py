@@ -0,0 +1,210 @@
+"""
+In-process LRU cache of recently used sessions, in front of a session store.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+from middleware_metrics import metrics
+from session_store.base import (
+    ChatHistory,
+    SessionStoreProtocol,
+    estimate_history_bytes,
+    stored_version,
+)
+
+
+class SessionCache:
+    """
+    LRU + TTL cache of deserialized sessions for this worker, bounded by the
+    approximate number of bytes held rather than by entry count.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        entry = self.entries.get(session_id)
+        if entry is not None and entry["expires_at"] <= time.monotonic():
+            self.invalidate(session_id)
+            metrics.incr("session_cache_expirations")
+            entry = None
+        if entry is None:
+            self.misses += 1
+            metrics.incr("session_cache_misses")
+            self.update_gauges()
+            return None
+
+        self.hits += 1
+        metrics.incr("session_cache_hits")
+        self.entries.move_to_end(session_id)
+        self.update_gauges()
+        # Handlers append to the list they get back, so hand out a copy
+        return {
+            "chat_history": ChatHistory(
+                entry["chat_history"],
+                entry["stored_count"],
+                entry["version"],
+                entry["api_key_hash"],
+            ),
+            "api_key_hash": entry["api_key_hash"],
+        }
+
+    def put(
+        self,
+        session_id: str,
+        chat_history: List[Dict[str, Any]],
+        api_key_hash: str,
+    ):
+        self.invalidate(session_id)
+        size = estimate_history_bytes(chat_history)
+        if size > self.max_bytes:
+            return
+        self.entries[session_id] = {
+            "chat_history": list(chat_history),
+            "stored_count": len(chat_history),
+            "version": stored_version(chat_history),
+            "api_key_hash": api_key_hash,
+            "size": size,
+            "expires_at": time.monotonic() + self.ttl_seconds,
+        }
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            evicted_id = next(iter(self.entries))
+            self.invalidate(evicted_id)
+            metrics.incr("session_cache_evictions")
+        self.update_gauges()
+
+    def invalidate(self, session_id: str):
+        entry = self.entries.pop(session_id, None)
+        if entry is not None:
+            self.current_bytes -= entry["size"]
+
+    def clear(self):
+        self.entries.clear()
+        self.current_bytes = 0
+        self.update_gauges()
+
+    def update_gauges(self):
+        lookups = self.hits + self.misses
+        metrics.set_gauge("session_cache_entries", len(self.entries))
+        metrics.set_gauge("session_cache_bytes", self.current_bytes)
+        metrics.set_gauge(
+            "session_cache_hit_ratio", self.hits / lookups if lookups else 0.0
+        )
+        metrics.set_gauge(
+            "session_cache_miss_ratio", self.misses / lookups if lookups else 0.0
+        )
+
+
+class CachedSessionStore(SessionStoreProtocol):
+    """
+    Write-through SessionCache in front of a session store. Reads of a cached
+    session skip the SELECT and the json.loads; writes go to the database first and
+    only then update the cache, and a failed write invalidates the entry.
+    """
+
+    def __init__(self, store: SessionStoreProtocol, cache: SessionCache):
+        self.store = store
+        self.cache = cache
+
+    # Only whole sessions are cached: everything else goes to the store
+    async def get_version(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return await self.store.get_version(session_id)
+
+    async def get_messages(
+        self, session_id: str, offset: int = 0, limit: Optional[int] = None
+    ) -> Optional[Dict[str, Any]]:
+        return await self.store.get_messages(session_id, offset, limit)
+
+    async def stream_messages(self, session_id: str) -> AsyncGenerator:
+        async for message in self.store.stream_messages(session_id):
+            yield message
+
+    async def stream_sessions(
+        self, session_ids: List[str], api_key_hash: str
+    ) -> AsyncGenerator:
+        async for item in self.store.stream_sessions(session_ids, api_key_hash):
+            yield item
+
+    async def fork_session(
+        self, session_id: str, new_session_id: str, message_count: Optional[int]
+    ) -> Optional[int]:
+        return await self.store.fork_session(session_id, new_session_id, message_count)
+
+    async def list_sessions(
+        self,
+        api_key_hash: str,
+        limit: int,
+        cursor: Optional[str] = None,
+        include_metadata: bool = False,
+    ) -> (List[Dict[str, Any]], Optional[str]):
+        return await self.store.list_sessions(
+            api_key_hash, limit, cursor, include_metadata
+        )
+
+    async def export_sessions(
+        self, session_ids: Optional[List[str]] = None
+    ) -> AsyncGenerator:
+        async for session in self.store.export_sessions(session_ids):
+            yield session
+
+    async def import_sessions(self, sessions: List[Dict[str, Any]]) -> int:
+        return await self.store.import_sessions(sessions)
+
+    async def idle_sessions(
+        self, policy: str, params: Dict[str, Any], limit: int
+    ) -> List[Tuple[str, int]]:
+        return await self.store.idle_sessions(policy, params, limit)
+
+    async def get_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        session_data = self.cache.get(session_id)
+        if session_data is not None:
+            return session_data
+        session_data = await self.store.get_session(session_id)
+        if session_data is not None:
+            self.cache.put(
+                session_id,
+                session_data["chat_history"] or [],
+                session_data["api_key_hash"],
+            )
+        return session_data
+
+    async def create_session(
+        self, session_id: str, chat_history: List[Dict[str, str]], api_key_hash: str
+    ):
+        # Not cached until it is read: only the store knows the version a new
+        # session starts at, and a turn written without it would skip the check
+        await self.store.create_session(session_id, chat_history, api_key_hash)
+        self.cache.invalidate(session_id)
+
+    async def update_chat_history(
+        self, session_id: str, chat_history: List[Dict[str, str]]
+    ):
+        entry = self.cache.entries.get(session_id)
+        try:
+            await self.store.update_chat_history(session_id, chat_history)
+        except Exception:
+            self.cache.invalidate(session_id)
+            raise
+        if entry is not None:
+            self.cache.put(session_id, chat_history, entry["api_key_hash"])
+
+    async def delete_idle_sessions(self, sessions: List[Tuple[str, int]]) -> List[str]:
+        deleted = await self.store.delete_idle_sessions(sessions)
+        for session_id in deleted:
+            self.cache.invalidate(session_id)
+        return deleted
+
+    def invalidate(self, session_id: str):
+        self.cache.invalidate(session_id)
+
+    async def close(self):
+        self.cache.clear()
+        await self.store.close()
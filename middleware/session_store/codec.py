@@ -0,0 +1,118 @@
+"""
+Storage format of chat_history in "blob" mode.
+"""
+
+import json
+import threading
+from typing import Any, Dict, List, Optional
+
+from anyio import to_thread
+
+from middleware_metrics import metrics
+from session_store.base import estimate_history_bytes
+
+
+class HistoryCodec:
+    """
+    Storage format of chat_history in "blob" mode. A history whose JSON is at least
+    min_bytes long is written to chat_history_compressed as a flag byte followed by
+    a zstd frame, with chat_history left NULL. Shorter ones stay plain JSON text in
+    chat_history, like every row written before compression was enabled. The flag
+    byte says how the frame was compressed. Large histories are encoded and decoded
+    in a worker thread, so the event loop doesn't spend its time on them. zstandard
+    is only imported once something is compressed or decompressed.
+    """
+
+    ZSTD = 1
+    ZSTD_DICTIONARY = 2
+
+    def __init__(
+        self, min_bytes: int = 0, level: int = 3, dictionary: Optional[bytes] = None
+    ):
+        self.min_bytes = min_bytes
+        self.level = level
+        self.dictionary_bytes = dictionary or None
+        self.dictionary = None
+        # zstd compressors and decompressors can't be shared between threads
+        self.local = threading.local()
+
+    def compression_dictionary(self):
+        import zstandard
+
+        if self.dictionary is None and self.dictionary_bytes is not None:
+            self.dictionary = zstandard.ZstdCompressionDict(self.dictionary_bytes)
+        return self.dictionary
+
+    def compressor(self):
+        import zstandard
+
+        compressor = getattr(self.local, "compressor", None)
+        if compressor is None:
+            compressor = self.local.compressor = zstandard.ZstdCompressor(
+                level=self.level, dict_data=self.compression_dictionary()
+            )
+        return compressor
+
+    def decompressor(self, flag: int):
+        import zstandard
+
+        decompressors = getattr(self.local, "decompressors", None)
+        if decompressors is None:
+            decompressors = self.local.decompressors = {}
+        if flag not in decompressors:
+            if flag == self.ZSTD:
+                decompressors[flag] = zstandard.ZstdDecompressor()
+            elif flag == self.ZSTD_DICTIONARY and self.dictionary_bytes is not None:
+                decompressors[flag] = zstandard.ZstdDecompressor(
+                    dict_data=self.compression_dictionary()
+                )
+            elif flag == self.ZSTD_DICTIONARY:
+                raise ValueError(
+                    "chat history was compressed with a dictionary, but "
+                    "CHAT_HISTORY_COMPRESSION_DICTIONARY is not set"
+                )
+            else:
+                raise ValueError(f"Unknown chat history compression flag: {flag}")
+        return decompressors[flag]
+
+    def compress(self, data: str) -> Optional[bytes]:
+        # None if data is too short to be worth compressing
+        if not self.min_bytes or len(data) < self.min_bytes:
+            return None
+        flag = self.ZSTD if self.dictionary_bytes is None else self.ZSTD_DICTIONARY
+        return bytes([flag]) + self.compressor().compress(data.encode("utf-8"))
+
+    def decompress(self, compressed: bytes) -> str:
+        # psycopg2 returns BYTEA as a memoryview
+        compressed = bytes(compressed)
+        return (
+            self.decompressor(compressed[0]).decompress(compressed[1:]).decode("utf-8")
+        )
+
+    def encode_sync(self, chat_history: List[Dict[str, Any]]):
+        data = json.dumps(chat_history)
+        compressed = self.compress(data)
+        if compressed is None:
+            return data, None
+        return None, compressed
+
+    async def encode(self, chat_history: List[Dict[str, Any]]):
+        """
+        (chat_history, chat_history_compressed) column values for a history; one
+        of them is None.
+        """
+        if not self.min_bytes or estimate_history_bytes(chat_history) < self.min_bytes:
+            return json.dumps(chat_history), None
+        data, compressed = await to_thread.run_sync(self.encode_sync, chat_history)
+        if compressed is not None:
+            metrics.incr("chat_history_compressed_writes")
+        return data, compressed
+
+    async def decode(
+        self, data: Optional[str], compressed: Optional[bytes]
+    ) -> Optional[List[Dict[str, Any]]]:
+        if compressed is not None:
+            return await to_thread.run_sync(
+                lambda: json.loads(self.decompress(compressed))
+            )
+        return json.loads(data) if data else None
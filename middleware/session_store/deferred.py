@@ -0,0 +1,260 @@
+"""
+History writes deferred past the response (HISTORY_DURABILITY).
+"""
+
+import asyncio
+import time
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+from middleware_metrics import metrics
+from session_store.base import (
+    ChatHistory,
+    SessionStoreProtocol,
+    history_owner,
+    stored_message_count,
+    stored_version,
+)
+from session_store.batching import HistoryWriter
+from session_store.redis_tier import RedisSessionStore
+
+# The deferred history writes of the request being served, started once its
+# response is sent. None outside a request.
+deferred_writes = ContextVar("deferred_writes", default=None)
+
+
+class DeferredHistoryStore(SessionStoreProtocol):
+    """
+    Returns from update_chat_history without waiting for the write, which starts
+    once the response is sent. Each session has at most one writer task, which
+    writes its queued history in order and retries failures with backoff. Writes
+    queued while one is in flight are merged. Once max_pending sessions have writes
+    outstanding, new writes are done inline. With a Redis client, a session with
+    writes outstanding is marked in Redis until they land, so reads on every worker
+    wait for them.
+    """
+
+    PENDING_KEY_TTL_SECONDS = 60
+
+    def __init__(
+        self,
+        store: SessionStoreProtocol,
+        max_pending: int,
+        max_retries: int,
+        redis_client=None,
+        pending_wait_seconds: float = 5.0,
+    ):
+        self.store = store
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.redis = redis_client
+        # How long a read waits for another worker's writes to the session
+        self.pending_wait_seconds = pending_wait_seconds
+        # session_id -> ChatHistory waiting to be written
+        self.queued = {}
+        # session_id -> task writing that session
+        self.tasks = {}
+        # Sessions whose writer starts once the current response is sent
+        self.unstarted = set()
+
+    # A new session is written inline, so the next turn finds it
+    async def create_session(
+        self, session_id: str, chat_history: List[Dict[str, str]], api_key_hash: str
+    ):
+        await self.store.create_session(session_id, chat_history, api_key_hash)
+
+    async def list_sessions(
+        self,
+        api_key_hash: str,
+        limit: int,
+        cursor: Optional[str] = None,
+        include_metadata: bool = False,
+    ) -> (List[Dict[str, Any]], Optional[str]):
+        return await self.store.list_sessions(
+            api_key_hash, limit, cursor, include_metadata
+        )
+
+    async def export_sessions(
+        self, session_ids: Optional[List[str]] = None
+    ) -> AsyncGenerator:
+        async for session in self.store.export_sessions(session_ids):
+            yield session
+
+    async def import_sessions(self, sessions: List[Dict[str, Any]]) -> int:
+        return await self.store.import_sessions(sessions)
+
+    async def idle_sessions(
+        self, policy: str, params: Dict[str, Any], limit: int
+    ) -> List[Tuple[str, int]]:
+        return await self.store.idle_sessions(policy, params, limit)
+
+    def pending_key(self, session_id: str) -> str:
+        return f"{RedisSessionStore.KEY_PREFIX}{session_id}:pending"
+
+    async def wait_for(self, session_id: str):
+        await self.wait_for_all([session_id])
+
+    async def wait_for_all(self, session_ids: List[str]):
+        for session_id in session_ids:
+            # Read-your-writes on this worker: a write deferred to the end of a
+            # response that hasn't finished yet starts now
+            if session_id in self.unstarted:
+                self.start(session_id)
+            task = self.tasks.get(session_id)
+            if task is not None:
+                await asyncio.shield(task)
+        if self.redis is not None and session_ids:
+            await self.wait_for_other_workers(session_ids)
+
+    async def wait_for_other_workers(self, session_ids: List[str]):
+        keys = [self.pending_key(session_id) for session_id in session_ids]
+        deadline = time.monotonic() + self.pending_wait_seconds
+        delay = 0.005
+        while any(int(count or 0) > 0 for count in await self.redis.mget(keys)):
+            if time.monotonic() >= deadline:
+                metrics.incr("deferred_history_wait_timeouts")
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+    async def get_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        # Read-your-writes: the previous turn must be persisted before we load
+        await self.wait_for(session_id)
+        return await self.store.get_session(session_id)
+
+    async def get_messages(
+        self, session_id: str, offset: int = 0, limit: Optional[int] = None
+    ) -> Optional[Dict[str, Any]]:
+        await self.wait_for(session_id)
+        return await self.store.get_messages(session_id, offset, limit)
+
+    async def get_version(self, session_id: str) -> Optional[Dict[str, Any]]:
+        await self.wait_for(session_id)
+        return await self.store.get_version(session_id)
+
+    async def stream_messages(self, session_id: str) -> AsyncGenerator:
+        await self.wait_for(session_id)
+        async for message in self.store.stream_messages(session_id):
+            yield message
+
+    async def stream_sessions(
+        self, session_ids: List[str], api_key_hash: str
+    ) -> AsyncGenerator:
+        await self.wait_for_all(session_ids)
+        async for item in self.store.stream_sessions(session_ids, api_key_hash):
+            yield item
+
+    async def fork_session(
+        self, session_id: str, new_session_id: str, message_count: Optional[int]
+    ) -> Optional[int]:
+        await self.wait_for(session_id)
+        return await self.store.fork_session(session_id, new_session_id, message_count)
+
+    async def delete_idle_sessions(self, sessions: List[Tuple[str, int]]) -> List[str]:
+        # A queued write changes the version once it lands, which keeps the session
+        await self.wait_for_all([session_id for session_id, _ in sessions])
+        return await self.store.delete_idle_sessions(sessions)
+
+    async def update_chat_history(
+        self, session_id: str, chat_history: List[Dict[str, str]]
+    ):
+        if len(chat_history) <= stored_message_count(chat_history):
+            return
+        scheduled = session_id in self.tasks or session_id in self.unstarted
+        if not scheduled and len(self.tasks) + len(self.unstarted) >= self.max_pending:
+            metrics.incr("deferred_history_backpressure")
+            await self.store.update_chat_history(session_id, chat_history)
+            return
+
+        if not scheduled and self.redis is not None:
+            # Marked before the response goes out, so the next turn waits for it
+            # on whichever worker it lands
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.incr(self.pending_key(session_id))
+            pipe.expire(self.pending_key(session_id), self.PENDING_KEY_TTL_SECONDS)
+            await pipe.execute()
+        snapshot = ChatHistory(
+            chat_history,
+            stored_message_count(chat_history),
+            stored_version(chat_history),
+            history_owner(chat_history),
+        )
+        queued = self.queued.get(session_id)
+        self.queued[session_id] = (
+            snapshot if queued is None else HistoryWriter.merge(queued, snapshot)
+        )
+        if isinstance(chat_history, ChatHistory):
+            chat_history.stored_count = len(chat_history)
+        metrics.set_gauge("deferred_history_pending_sessions", len(self.queued))
+        if scheduled:
+            return
+        writes = deferred_writes.get()
+        if writes is None:
+            self.start(session_id)
+        else:
+            self.unstarted.add(session_id)
+            writes.append(lambda: self.start(session_id))
+
+    def start(self, session_id: str):
+        self.unstarted.discard(session_id)
+        if session_id not in self.tasks and session_id in self.queued:
+            self.tasks[session_id] = asyncio.create_task(self.write_session(session_id))
+
+    async def write_session(self, session_id: str):
+        try:
+            while session_id in self.queued:
+                chat_history = self.queued.pop(session_id)
+                if await self.write_with_retry(session_id, chat_history):
+                    self.rebase_queued(session_id, chat_history)
+        finally:
+            del self.tasks[session_id]
+            metrics.set_gauge("deferred_history_pending_sessions", len(self.queued))
+            if self.redis is not None:
+                await self.clear_pending(session_id)
+
+    async def clear_pending(self, session_id: str):
+        try:
+            await self.redis.decr(self.pending_key(session_id))
+        except Exception as e:
+            # The marker expires on its own
+            print(f"Error clearing pending write marker of {session_id}: {str(e)}")
+
+    def rebase_queued(self, session_id: str, written: "ChatHistory"):
+        # A write queued by a concurrent turn was loaded before `written` landed, so
+        # its new messages now go after everything that was just persisted
+        queued = self.queued.get(session_id)
+        if queued is None or queued.stored_count >= len(written):
+            return
+        self.queued[session_id] = ChatHistory(
+            list(written) + queued[queued.stored_count :],
+            len(written),
+            written.version,
+            history_owner(written),
+        )
+
+    async def write_with_retry(
+        self, session_id: str, chat_history: "ChatHistory"
+    ) -> bool:
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.store.update_chat_history(session_id, chat_history)
+                metrics.incr("deferred_history_writes")
+                return True
+            except Exception as e:
+                if attempt == self.max_retries:
+                    print(
+                        f"Dropping history write for {session_id} after "
+                        f"{attempt + 1} attempts: {str(e)}"
+                    )
+                    metrics.incr("deferred_history_dropped")
+                    return False
+                metrics.incr("deferred_history_retries")
+                await asyncio.sleep(0.1 * 2**attempt)
+
+    async def close(self):
+        # Finish every outstanding write before the store goes away
+        for session_id in list(self.unstarted):
+            self.start(session_id)
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks.values()), return_exceptions=True)
+        await self.store.close()
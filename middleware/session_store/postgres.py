@@ -0,0 +1,1641 @@
+"""
+Session stores on the middleware's Postgres database: chat_history as a blob
+("blob"), one row per message ("messages") or a JSONB array ("jsonb").
+"""
+
+import asyncio
+import hashlib
+import json
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+from anyio import to_thread
+from sqlalchemy import (
+    any_,
+    bindparam,
+    BigInteger,
+    Integer,
+    LargeBinary,
+    String,
+    Table,
+    Text,
+    column,
+    or_,
+    true,
+    text,
+    tuple_,
+    values,
+)
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.sql import select, insert, update, func, cast, case, and_, null
+
+from middleware_metrics import metrics
+from session_store.base import (
+    SESSION_EXPORT_COLUMNS,
+    ChatHistory,
+    DatabaseStoreProtocol,
+    decode_session_cursor,
+    encode_session_cursor,
+    last_model,
+    mark_written,
+    message_to_row,
+    rebase_history,
+    resolve_range,
+    row_to_message,
+    stored_message_count,
+    stored_version,
+)
+from session_store.codec import HistoryCodec
+
+
+def session_id_in(session_id_column, session_ids: List[str]):
+    # session_id = ANY(:session_ids): one array parameter however many IDs there are
+    return session_id_column == any_(
+        bindparam("session_ids", session_ids, type_=ARRAY(String))
+    )
+
+
+async def copy_to_temp_table(conn, table_name: str, records: List[Dict[str, Any]]):
+    """
+    COPYs records into {table_name}_import, a temporary table shaped like table_name
+    and dropped when conn's transaction commits.
+    """
+    temp_table = f"{table_name}_import"
+    # Through SQLAlchemy, which is what opens the transaction on the connection
+    await conn.execute(
+        text(
+            f"CREATE TEMP TABLE {temp_table} (LIKE {table_name} INCLUDING DEFAULTS) "
+            "ON COMMIT DROP"
+        )
+    )
+    if records:
+        columns = list(records[0])
+        # COPY itself needs the asyncpg connection underneath
+        connection = (await conn.get_raw_connection()).driver_connection
+        await connection.copy_records_to_table(
+            temp_table,
+            records=[tuple(record[c] for c in columns) for record in records],
+            columns=columns,
+        )
+
+
+class SessionStore(DatabaseStoreProtocol):
+    """
+    Async access to the chat_sessions table. All chat history reads and writes made
+    while serving a request go through this class, so a Postgres round trip never
+    blocks the event loop of the uvicorn worker.
+    """
+
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        table: Table,
+        codec: Optional[HistoryCodec] = None,
+        fetch_size: int = 100,
+        export_fetch_size: int = 1000,
+    ):
+        self.engine = engine
+        self.table = table
+        # Without a codec nothing new is compressed, but compressed rows still read
+        self.codec = codec or HistoryCodec()
+        # Rows per round trip of the server-side cursors of streamed reads
+        self.fetch_size = fetch_size
+        self.export_fetch_size = export_fetch_size
+
+    async def get_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        async with self.engine.connect() as conn:
+            stmt = select(
+                self.table.c.chat_history,
+                self.table.c.api_key_hash,
+                self.table.c.version,
+                self.table.c.chat_history_compressed,
+            ).where(self.table.c.session_id == session_id)
+            result = (await conn.execute(stmt)).fetchone()
+        if result:
+            chat_history = await self.codec.decode(result[0], result[3])
+            return {
+                "chat_history": (
+                    ChatHistory(chat_history, len(chat_history), result[2])
+                    if chat_history is not None
+                    else None
+                ),
+                "api_key_hash": result[1],
+            }
+        return None
+
+    async def create_session(
+        self, session_id: str, chat_history: List[Dict[str, str]], api_key_hash: str
+    ):
+        data, compressed = await self.codec.encode(chat_history)
+        async with self.engine.begin() as conn:
+            stmt = insert(self.table).values(
+                session_id=session_id,
+                chat_history=data,
+                chat_history_compressed=compressed,
+                api_key_hash=api_key_hash,
+                message_count=len(chat_history),
+                last_model=last_model(chat_history),
+            )
+            await conn.execute(stmt)
+
+    async def update_chat_history(
+        self, session_id: str, chat_history: List[Dict[str, str]]
+    ):
+        """
+        Compare-and-swap on the session version. If another turn was written since
+        chat_history was read, the row is locked, this turn's messages are moved
+        after the stored ones, and the write is retried in the same transaction.
+        """
+        async with self.engine.begin() as conn:
+            version = await self.write_history(conn, session_id, chat_history)
+            if version is None and await self.rebase(conn, session_id, chat_history):
+                version = await self.write_history(conn, session_id, chat_history)
+        mark_written(chat_history, version)
+
+    async def write_history(
+        self, conn, session_id: str, chat_history: List[Dict[str, Any]]
+    ) -> Optional[int]:
+        data, compressed = await self.codec.encode(chat_history)
+        stmt = (
+            update(self.table)
+            .where(
+                self.table.c.session_id == session_id,
+                self.version_matches(chat_history),
+            )
+            .values(
+                chat_history=data,
+                chat_history_compressed=compressed,
+                **self.listing_values(chat_history),
+            )
+            .returning(self.table.c.version)
+        )
+        return (await conn.execute(stmt)).scalar()
+
+    async def rebase(self, conn, session_id: str, chat_history: "ChatHistory") -> bool:
+        # False if the session no longer exists
+        stmt = (
+            select(
+                self.table.c.chat_history,
+                self.table.c.version,
+                self.table.c.chat_history_compressed,
+            )
+            .where(self.table.c.session_id == session_id)
+            .with_for_update()
+        )
+        row = (await conn.execute(stmt)).fetchone()
+        if row is None:
+            return False
+        stored = await self.codec.decode(row[0], row[2])
+        rebase_history(chat_history, stored or [], row[1])
+        return True
+
+    def version_matches(self, chat_history: List[Dict[str, Any]]):
+        # A plain list, like the Redis tier's flush, writes unconditionally
+        version = stored_version(chat_history)
+        if version is None:
+            return true()
+        return self.table.c.version == version
+
+    def listing_values(self, chat_history: List[Dict[str, Any]]) -> Dict[str, Any]:
+        # Session metadata for /session-ids and the history ETag, kept current by
+        # every history write
+        listing = {
+            "updated_at": func.now(),
+            "message_count": len(chat_history),
+            "version": self.table.c.version + 1,
+        }
+        model = last_model(chat_history[stored_message_count(chat_history) :])
+        if model is not None:
+            listing["last_model"] = model
+        return listing
+
+    async def write_batch(self, batch: Dict[str, "ChatHistory"]):
+        """
+        Writes the histories of several sessions with one UPDATE ... FROM (VALUES ...)
+        statement in a single transaction.
+        """
+        encoded = await asyncio.gather(
+            *(self.codec.encode(chat_history) for chat_history in batch.values())
+        )
+        batch_values = values(
+            column("session_id", String),
+            column("chat_history", Text),
+            column("chat_history_compressed", LargeBinary),
+            column("message_count", Integer),
+            column("last_model", String),
+            column("version", BigInteger),
+            name="batch",
+        ).data(
+            [
+                (
+                    session_id,
+                    data,
+                    compressed,
+                    len(chat_history),
+                    last_model(chat_history[stored_message_count(chat_history) :]),
+                    stored_version(chat_history),
+                )
+                for (session_id, chat_history), (data, compressed) in zip(
+                    batch.items(), encoded
+                )
+            ]
+        )
+        async with self.engine.begin() as conn:
+            stmt = (
+                update(self.table)
+                .where(
+                    self.table.c.session_id == batch_values.c.session_id,
+                    self.batch_version_matches(batch_values),
+                )
+                .values(
+                    chat_history=batch_values.c.chat_history,
+                    chat_history_compressed=cast(
+                        batch_values.c.chat_history_compressed, LargeBinary
+                    ),
+                    updated_at=func.now(),
+                    version=self.table.c.version + 1,
+                    message_count=batch_values.c.message_count,
+                    last_model=func.coalesce(
+                        batch_values.c.last_model, self.table.c.last_model
+                    ),
+                )
+                .returning(self.table.c.session_id, self.table.c.version)
+            )
+            written = dict((await conn.execute(stmt)).fetchall())
+        await self.finish_batch(batch, written)
+
+    def batch_version_matches(self, batch_values):
+        # Parameters in a VALUES list are sent untyped, so the cast is needed
+        version = cast(batch_values.c.version, BigInteger)
+        return or_(version.is_(None), self.table.c.version == version)
+
+    async def finish_batch(
+        self, batch: Dict[str, "ChatHistory"], written: Dict[str, int]
+    ):
+        # Sessions that failed the version check were written to by another turn in
+        # the meantime; those are rebased and written one by one
+        for session_id, chat_history in batch.items():
+            if session_id in written:
+                mark_written(chat_history, written[session_id])
+            else:
+                await self.update_chat_history(session_id, chat_history)
+
+    async def get_version(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """
+        The session's owner and an opaque version that changes on every history
+        write. Reads neither the history nor anything derived from it.
+        """
+        async with self.engine.connect() as conn:
+            stmt = select(
+                self.table.c.api_key_hash,
+                self.table.c.version,
+                self.table.c.message_count,
+            ).where(self.table.c.session_id == session_id)
+            result = (await conn.execute(stmt)).fetchone()
+        if result is None:
+            return None
+        return {
+            "api_key_hash": result[0],
+            "version": str(result[1]),
+            "message_count": result[2],
+        }
+
+    STREAM_SQL = """
+        SELECT element
+        FROM chat_sessions,
+            jsonb_array_elements({history}) WITH ORDINALITY AS elements(element, position)
+        WHERE session_id = :session_id
+        ORDER BY position
+        """
+
+    async def stream_messages(self, session_id: str) -> AsyncGenerator:
+        """
+        Yields a session's messages in order through a server-side cursor, holding
+        at most fetch_size of them in memory at a time.
+        """
+        streamed = False
+        async with self.engine.connect() as conn:
+            result = await conn.stream(
+                text(self.STREAM_SQL.format(history=self.HISTORY_SQL)),
+                {"session_id": session_id},
+            )
+            async for partition in result.partitions(self.fetch_size):
+                for row in partition:
+                    streamed = True
+                    yield json.loads(row[0]) if isinstance(row[0], str) else row[0]
+            if streamed:
+                return
+            # Postgres can't look inside a compressed history; decode all of it here
+            stmt = select(self.table.c.chat_history_compressed).where(
+                self.table.c.session_id == session_id
+            )
+            compressed = (await conn.execute(stmt)).scalar()
+        if compressed is not None:
+            for message in await self.codec.decode(None, compressed):
+                yield message
+
+    BATCH_SQL = """
+        SELECT session_id, {history}, chat_history_compressed
+        FROM chat_sessions
+        WHERE session_id = ANY(:session_ids) AND api_key_hash = :api_key_hash
+        """
+
+    async def stream_sessions(
+        self, session_ids: List[str], api_key_hash: str
+    ) -> AsyncGenerator:
+        """
+        Yields (session_id, chat_history) for each of session_ids owned by
+        api_key_hash, checking ownership for all of them in the same query. Sessions
+        that don't exist or belong to another key are left out.
+        """
+        async with self.engine.connect() as conn:
+            result = await conn.stream(
+                text(self.BATCH_SQL.format(history=self.HISTORY_SQL)),
+                {"session_ids": session_ids, "api_key_hash": api_key_hash},
+            )
+            async for partition in result.partitions(self.fetch_size):
+                for session_id, chat_history, compressed in partition:
+                    if compressed is not None:
+                        chat_history = await self.codec.decode(None, compressed)
+                    elif isinstance(chat_history, str):
+                        chat_history = json.loads(chat_history)
+                    yield session_id, chat_history or []
+
+    # The compressed history, or the history as JSON text, for exports
+    EXPORT_HISTORY_SQL = "chat_history_compressed, chat_history"
+
+    EXPORT_SQL = """
+        SELECT
+            session_id, api_key_hash, created_at, updated_at, message_count,
+            last_model, version, {history}
+        FROM chat_sessions
+        """
+
+    def export_query(self, session_ids: Optional[List[str]]):
+        sql = self.EXPORT_SQL.format(history=self.EXPORT_HISTORY_SQL)
+        if session_ids is None:
+            return text(sql), {}
+        return text(f"{sql} WHERE session_id = ANY(:session_ids)"), {
+            "session_ids": session_ids
+        }
+
+    async def export_sessions(
+        self, session_ids: Optional[List[str]] = None
+    ) -> AsyncGenerator:
+        """
+        Yields every session (or those in session_ids) as a dict of
+        SESSION_EXPORT_COLUMNS plus chat_history as JSON text, read through a
+        server-side cursor export_fetch_size rows at a time. Reads the
+        database only: with Redis enabled, turns not flushed yet are not included.
+        """
+        async with self.engine.connect() as conn:
+            result = await conn.stream(*self.export_query(session_ids))
+            async for partition in result.partitions(self.export_fetch_size):
+                for row in partition:
+                    session = dict(zip(SESSION_EXPORT_COLUMNS, row))
+                    if row[-2] is not None:
+                        session["chat_history"] = await to_thread.run_sync(
+                            self.codec.decompress, row[-2]
+                        )
+                    else:
+                        session["chat_history"] = row[-1] or "[]"
+                    yield session
+
+    IMPORT_SQL = """
+        WITH inserted AS (
+            INSERT INTO chat_sessions
+            SELECT * FROM chat_sessions_import
+            ON CONFLICT (session_id) DO NOTHING
+            RETURNING session_id
+        )
+        SELECT count(*) FROM inserted
+        """
+
+    def import_history_columns(
+        self, chat_history: List[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        return {"chat_history": json.dumps(chat_history)}
+
+    async def import_sessions(self, sessions: List[Dict[str, Any]]) -> int:
+        """
+        Inserts a batch of sessions as returned by import_session_record: COPY into a
+        temporary table, then one INSERT ... SELECT that skips session IDs that
+        already exist. Returns how many sessions were inserted.
+        """
+        records = [
+            {
+                **{c: session[c] for c in SESSION_EXPORT_COLUMNS},
+                **self.import_history_columns(session["chat_history"]),
+            }
+            for session in sessions
+        ]
+        async with self.engine.begin() as conn:
+            await copy_to_temp_table(conn, "chat_sessions", records)
+            return (await conn.execute(text(self.IMPORT_SQL))).scalar()
+
+    # The history as JSONB, so Postgres can slice it without sending all of it
+    HISTORY_SQL = "CAST(chat_history AS JSONB)"
+
+    SLICE_SQL = """
+        WITH session AS (
+            SELECT
+                api_key_hash,
+                history,
+                chat_history_compressed,
+                COALESCE(jsonb_array_length(history), 0) AS total
+            FROM (
+                SELECT api_key_hash, {history} AS history, chat_history_compressed
+                FROM chat_sessions
+                WHERE session_id = :session_id
+            ) AS row
+        ), bounds AS (
+            SELECT
+                session.*,
+                CASE
+                    WHEN :offset < 0 THEN GREATEST(total + :offset, 0)
+                    ELSE LEAST(:offset, total)
+                END AS start
+            FROM session
+        )
+        SELECT
+            api_key_hash,
+            total,
+            start,
+            (
+                SELECT COALESCE(jsonb_agg(element ORDER BY position), '[]'::jsonb)
+                FROM jsonb_array_elements(history)
+                    WITH ORDINALITY AS elements(element, position)
+                WHERE position > start
+                    AND (
+                        CAST(:limit AS INTEGER) IS NULL
+                        OR position <= start + CAST(:limit AS INTEGER)
+                    )
+            ),
+            chat_history_compressed
+        FROM bounds
+        """
+
+    async def get_messages(
+        self, session_id: str, offset: int = 0, limit: Optional[int] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        A slice of a session's history: messages [offset, offset + limit), with
+        negative offsets counting from the end. Returns the owner, the slice, its
+        resolved start and the total message count, or None if there is no session.
+        """
+        async with self.engine.connect() as conn:
+            result = await conn.execute(
+                text(self.SLICE_SQL.format(history=self.HISTORY_SQL)),
+                {"session_id": session_id, "offset": offset, "limit": limit},
+            )
+            row = result.fetchone()
+        if row is None:
+            return None
+        if row[4] is not None:
+            # Compressed: Postgres can't slice it, so the whole history is decoded
+            chat_history = await self.codec.decode(None, row[4])
+            start, end = resolve_range(len(chat_history), offset, limit)
+            return {
+                "api_key_hash": row[0],
+                "messages": chat_history[start:end],
+                "offset": start,
+                "total": len(chat_history),
+            }
+        messages = json.loads(row[3]) if isinstance(row[3], str) else row[3]
+        return {
+            "api_key_hash": row[0],
+            "messages": messages,
+            "offset": row[2],
+            "total": row[1],
+        }
+
+    FORK_SQL = """
+        WITH parent AS (
+            SELECT api_key_hash, last_model, COALESCE({history}, '[]'::jsonb) AS history
+            FROM chat_sessions
+            WHERE session_id = :session_id AND chat_history_compressed IS NULL
+        ), forked AS (
+            SELECT
+                api_key_hash,
+                last_model,
+                (
+                    SELECT COALESCE(jsonb_agg(element ORDER BY position), '[]'::jsonb)
+                    FROM jsonb_array_elements(history)
+                        WITH ORDINALITY AS elements(element, position)
+                    WHERE CAST(:message_count AS INTEGER) IS NULL
+                        OR position <= CAST(:message_count AS INTEGER)
+                ) AS history
+            FROM parent
+            WHERE CAST(:message_count AS INTEGER) IS NULL
+                OR CAST(:message_count AS INTEGER) <= jsonb_array_length(history)
+        )
+        INSERT INTO chat_sessions (
+            session_id, {column}, api_key_hash, message_count, last_model
+        )
+        SELECT :new_session_id, {value}, api_key_hash, jsonb_array_length(history),
+            last_model
+        FROM forked
+        RETURNING message_count
+        """
+
+    # Column the forked history is written to, and how
+    FORK_COLUMN_SQL = ("chat_history", "CAST(history AS TEXT)")
+
+    async def fork_session(
+        self, session_id: str, new_session_id: str, message_count: Optional[int]
+    ) -> Optional[int]:
+        """
+        Creates new_session_id, owned by the same key, with the first message_count
+        messages of session_id (all of them if None). Returns the new session's
+        message count, or None if session_id doesn't exist or has fewer messages.
+        The history is copied inside the database, not through the middleware.
+        """
+        column, value = self.FORK_COLUMN_SQL
+        async with self.engine.begin() as conn:
+            result = await conn.execute(
+                text(
+                    self.FORK_SQL.format(
+                        history=self.HISTORY_SQL, column=column, value=value
+                    )
+                ),
+                {
+                    "session_id": session_id,
+                    "new_session_id": new_session_id,
+                    "message_count": message_count,
+                },
+            )
+            forked = result.scalar()
+            if forked is None:
+                forked = await self.fork_compressed(
+                    conn, session_id, new_session_id, message_count
+                )
+        if forked is not None:
+            metrics.incr("sessions_forked")
+        return forked
+
+    async def fork_compressed(
+        self,
+        conn,
+        session_id: str,
+        new_session_id: str,
+        message_count: Optional[int],
+    ) -> Optional[int]:
+        # FORK_SQL skips compressed parents, whose prefix is sliced here instead
+        stmt = select(
+            self.table.c.api_key_hash,
+            self.table.c.last_model,
+            self.table.c.chat_history_compressed,
+        ).where(
+            self.table.c.session_id == session_id,
+            self.table.c.chat_history_compressed.is_not(None),
+        )
+        row = (await conn.execute(stmt)).fetchone()
+        if row is None:
+            return None
+        chat_history = await self.codec.decode(None, row[2])
+        if message_count is not None and message_count > len(chat_history):
+            return None
+        chat_history = chat_history[:message_count]
+        data, compressed = await self.codec.encode(chat_history)
+        await conn.execute(
+            insert(self.table).values(
+                session_id=new_session_id,
+                chat_history=data,
+                chat_history_compressed=compressed,
+                api_key_hash=row[0],
+                message_count=len(chat_history),
+                last_model=row[1],
+            )
+        )
+        return len(chat_history)
+
+    async def list_sessions(
+        self,
+        api_key_hash: str,
+        limit: int,
+        cursor: Optional[str] = None,
+        include_metadata: bool = False,
+    ) -> (List[Dict[str, Any]], Optional[str]):
+        """
+        One page of the key's sessions, most recently updated first. Returns the page
+        and the cursor for the next one (None on the last page).
+        """
+        columns = [self.table.c.session_id, self.table.c.updated_at]
+        if include_metadata:
+            columns += [
+                self.table.c.created_at,
+                self.table.c.message_count,
+                self.table.c.last_model,
+            ]
+        stmt = (
+            select(*columns)
+            .where(self.table.c.api_key_hash == api_key_hash)
+            .order_by(self.table.c.updated_at.desc(), self.table.c.session_id.desc())
+            .limit(limit + 1)
+        )
+        if cursor is not None:
+            stmt = stmt.where(
+                tuple_(self.table.c.updated_at, self.table.c.session_id)
+                < tuple_(*decode_session_cursor(cursor))
+            )
+        async with self.engine.connect() as conn:
+            rows = (await conn.execute(stmt)).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_session_cursor(
+                rows[-1].updated_at, rows[-1].session_id
+            )
+        if not include_metadata:
+            return [{"session_id": row.session_id} for row in rows], next_cursor
+        return [
+            {
+                "session_id": row.session_id,
+                "created_at": row.created_at.isoformat(),
+                "updated_at": row.updated_at.isoformat(),
+                "message_count": row.message_count,
+                "last_model": row.last_model,
+            }
+            for row in rows
+        ], next_cursor
+
+    IDLE_SESSIONS_SQL = """
+        SELECT session_id, version
+        FROM chat_sessions
+        WHERE {policy}
+            AND updated_at < now() - make_interval(secs => CAST(:ttl AS DOUBLE PRECISION))
+            AND NOT EXISTS (
+                SELECT 1
+                FROM chat_sessions AS fork
+                WHERE fork.parent_session_id = chat_sessions.session_id
+            )
+        ORDER BY updated_at
+        LIMIT :limit
+        """
+
+    async def idle_sessions(
+        self, policy: str, params: Dict[str, Any], limit: int
+    ) -> List[Tuple[str, int]]:
+        # The reaper's candidates: (session_id, version) of the sessions matching
+        # policy not updated for params["ttl"] seconds. Nothing is locked.
+        async with self.engine.connect() as conn:
+            result = await conn.execute(
+                text(self.IDLE_SESSIONS_SQL.format(policy=policy)),
+                {**params, "limit": limit},
+            )
+            return [(row[0], row[1]) for row in result.fetchall()]
+
+    # A session written to since it was picked has a new version and is kept, as
+    # is one forked in the meantime
+    DELETE_IDLE_SESSIONS_SQL = """
+        DELETE FROM chat_sessions
+        USING unnest(CAST(:session_ids AS TEXT[]), CAST(:versions AS BIGINT[]))
+            AS idle(session_id, version)
+        WHERE chat_sessions.session_id = idle.session_id
+            AND chat_sessions.version = idle.version
+            AND NOT EXISTS (
+                SELECT 1
+                FROM chat_sessions AS fork
+                WHERE fork.parent_session_id = chat_sessions.session_id
+            )
+        RETURNING chat_sessions.session_id
+        """
+
+    REFERENCED_CONTENTS_SQL = """
+        SELECT DISTINCT content_hash
+        FROM chat_messages
+        WHERE session_id = ANY(:session_ids) AND content_hash IS NOT NULL
+        """
+
+    # Contents a writer is about to reference are KEY SHARE locked by it, so SKIP
+    # LOCKED leaves them alone
+    DELETE_UNREFERENCED_CONTENTS_SQL = """
+        DELETE FROM chat_message_contents
+        WHERE content_hash IN (
+            SELECT content_hash
+            FROM chat_message_contents
+            WHERE content_hash = ANY(:content_hashes)
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM chat_messages
+                    WHERE chat_messages.content_hash
+                        = chat_message_contents.content_hash
+                )
+            FOR UPDATE SKIP LOCKED
+        )
+        """
+
+    async def delete_idle_sessions(self, sessions: List[Tuple[str, int]]) -> List[str]:
+        """
+        Deletes those of the (session_id, version) pairs idle_sessions returned that
+        are still at that version, with their messages, summaries and the shared
+        message contents nothing else references. Returns the deleted session IDs.
+        """
+        async with self.engine.begin() as conn:
+            result = await conn.execute(
+                text(self.DELETE_IDLE_SESSIONS_SQL),
+                {
+                    "session_ids": [session_id for session_id, _ in sessions],
+                    "versions": [version for _, version in sessions],
+                },
+            )
+            session_ids = [row[0] for row in result.fetchall()]
+            if not session_ids:
+                return []
+            content_hashes = (
+                (
+                    await conn.execute(
+                        text(self.REFERENCED_CONTENTS_SQL), {"session_ids": session_ids}
+                    )
+                )
+                .scalars()
+                .all()
+            )
+            for table_name in ("chat_messages", "chat_session_summaries"):
+                await conn.execute(
+                    text(
+                        f"DELETE FROM {table_name} WHERE session_id = ANY(:session_ids)"
+                    ),
+                    {"session_ids": session_ids},
+                )
+            if content_hashes:
+                await conn.execute(
+                    text(self.DELETE_UNREFERENCED_CONTENTS_SQL),
+                    {"content_hashes": content_hashes},
+                )
+        return session_ids
+
+    async def close(self):
+        await self.engine.dispose()
+
+
+class MessageTableSessionStore(SessionStore):
+    """
+    Session store that keeps one chat_messages row per message. A turn only inserts
+    the messages it appended, so the bytes written per turn no longer grow with the
+    length of the conversation. chat_sessions keeps the session row (owner) and, for
+    sessions written before this mode was enabled, the legacy chat_history blob until
+    it is migrated. Long contents can be shared between sessions through
+    chat_message_contents (dedupe_min_length). A forked session
+    references the first parent_message_count messages of its parent_session_id and
+    only has rows of its own from that seq on.
+    """
+
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        table: Table,
+        messages_table: Table,
+        contents_table: Table,
+        dedupe_min_length: int = 0,
+        migration_batch_size: int = 100,
+        **kwargs,
+    ):
+        super().__init__(engine, table, **kwargs)
+        self.messages_table = messages_table
+        self.contents_table = contents_table
+        self.dedupe_min_length = dedupe_min_length
+        self.migration_batch_size = migration_batch_size
+
+    def content_column(self):
+        # A shared content is only looked up for the rows that reference one
+        return case(
+            (
+                self.messages_table.c.content_hash.is_(None),
+                self.messages_table.c.content,
+            ),
+            else_=select(self.contents_table.c.content)
+            .where(
+                self.contents_table.c.content_hash == self.messages_table.c.content_hash
+            )
+            .scalar_subquery(),
+        )
+
+    def history_query(self, root_condition):
+        """
+        (root_id, seq, role, content, extra) of every message of the sessions
+        matching root_condition, including the ones inherited from the sessions they
+        were forked from. Each ancestor contributes its rows below the smallest seq
+        at which the sessions under it were forked, so the ranges never overlap and
+        seq orders them.
+        """
+        sessions = self.table
+        lineage = (
+            select(
+                sessions.c.session_id.label("root_id"),
+                sessions.c.session_id,
+                sessions.c.parent_session_id,
+                sessions.c.parent_message_count,
+                cast(null(), Integer).label("below"),
+            )
+            .where(root_condition)
+            .cte("lineage", recursive=True)
+        )
+        parent = sessions.alias("parent")
+        lineage = lineage.union_all(
+            select(
+                lineage.c.root_id,
+                parent.c.session_id,
+                parent.c.parent_session_id,
+                parent.c.parent_message_count,
+                func.least(lineage.c.below, lineage.c.parent_message_count),
+            ).where(parent.c.session_id == lineage.c.parent_session_id)
+        )
+        messages = self.messages_table
+        return select(
+            lineage.c.root_id,
+            messages.c.seq,
+            messages.c.role,
+            self.content_column().label("content"),
+            messages.c.extra,
+        ).select_from(
+            messages.join(
+                lineage,
+                and_(
+                    messages.c.session_id == lineage.c.session_id,
+                    or_(lineage.c.below.is_(None), messages.c.seq < lineage.c.below),
+                ),
+            )
+        )
+
+    async def store_shared_contents(self, conn, rows: List[Dict[str, Any]]):
+        """
+        Moves the contents of at least dedupe_min_length characters out
+        of message rows about to be inserted on conn into chat_message_contents, and
+        points the rows at them by hash.
+        """
+        if self.dedupe_min_length <= 0:
+            return
+        contents = {}
+        for row in rows:
+            content, content_hash = row["content"], None
+            if content is not None and len(content) >= self.dedupe_min_length:
+                content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+                contents[content_hash] = content
+                row["content"] = None
+            row["content_hash"] = content_hash
+        if not contents:
+            return
+
+        # KEY SHARE on the contents that already exist keeps the session reaper from
+        # deleting one before the rows referencing it are committed
+        stmt = (
+            select(self.contents_table.c.content_hash)
+            .where(self.contents_table.c.content_hash.in_(list(contents)))
+            .with_for_update(read=True, key_share=True)
+        )
+        existing = set((await conn.execute(stmt)).scalars())
+        # Sorted, so concurrent writers of the same new contents can't deadlock
+        missing = [
+            {"content_hash": content_hash, "content": contents[content_hash]}
+            for content_hash in sorted(contents)
+            if content_hash not in existing
+        ]
+        if missing:
+            await conn.execute(
+                pg_insert(self.contents_table).values(missing).on_conflict_do_nothing()
+            )
+        metrics.incr("chat_message_contents_shared", len(contents) - len(missing))
+
+    async def get_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        history = self.history_query(self.table.c.session_id == session_id).subquery()
+        async with self.engine.connect() as conn:
+            stmt = (
+                select(
+                    self.table.c.api_key_hash,
+                    self.table.c.chat_history,
+                    self.table.c.version,
+                    history.c.role,
+                    history.c.content,
+                    history.c.extra,
+                )
+                .select_from(
+                    self.table.outerjoin(
+                        history, history.c.root_id == self.table.c.session_id
+                    )
+                )
+                .where(self.table.c.session_id == session_id)
+                .order_by(history.c.seq)
+            )
+            rows = (await conn.execute(stmt)).fetchall()
+        if not rows:
+            return None
+
+        api_key_hash, legacy_blob, version = rows[0][0], rows[0][1], rows[0][2]
+        if legacy_blob is not None:
+            chat_history = await self.migrate_blob_session(session_id)
+        else:
+            chat_history = [
+                row_to_message(role, content, extra)
+                for _, _, _, role, content, extra in rows
+                if role is not None
+            ]
+        return {
+            "chat_history": ChatHistory(chat_history, len(chat_history), version),
+            "api_key_hash": api_key_hash,
+        }
+
+    async def stream_messages(self, session_id: str) -> AsyncGenerator:
+        async with self.engine.connect() as conn:
+            stmt = select(self.table.c.chat_history).where(
+                self.table.c.session_id == session_id
+            )
+            legacy_blob = (await conn.execute(stmt)).scalar()
+            if legacy_blob is None:
+                history = self.history_query(
+                    self.table.c.session_id == session_id
+                ).subquery()
+                stmt = select(
+                    history.c.role, history.c.content, history.c.extra
+                ).order_by(history.c.seq)
+                result = await conn.stream(stmt)
+                async for partition in result.partitions(self.fetch_size):
+                    for row in partition:
+                        yield row_to_message(*row)
+                return
+
+        # Not migrated yet: the whole blob is read to migrate it anyway
+        for message in await self.migrate_blob_session(session_id):
+            yield message
+
+    async def stream_sessions(
+        self, session_ids: List[str], api_key_hash: str
+    ) -> AsyncGenerator:
+        async with self.engine.connect() as conn:
+            stmt = select(
+                self.table.c.session_id, self.table.c.chat_history.is_not(None)
+            ).where(
+                session_id_in(self.table.c.session_id, session_ids),
+                self.table.c.api_key_hash == api_key_hash,
+            )
+            owned = (await conn.execute(stmt)).fetchall()
+        for session_id, has_legacy_blob in owned:
+            if has_legacy_blob:
+                yield session_id, await self.migrate_blob_session(session_id)
+        migrated = [session_id for session_id, legacy in owned if not legacy]
+        if not migrated:
+            return
+
+        # One ordered scan over all sessions' rows, grouped as they arrive
+        yielded = set()
+        history = self.history_query(
+            session_id_in(self.table.c.session_id, migrated)
+        ).subquery()
+        async with self.engine.connect() as conn:
+            stmt = select(
+                history.c.root_id, history.c.role, history.c.content, history.c.extra
+            ).order_by(history.c.root_id, history.c.seq)
+            result = await conn.stream(stmt)
+            current_id, messages = None, []
+            async for partition in result.partitions(self.fetch_size):
+                for session_id, role, content, extra in partition:
+                    if session_id != current_id:
+                        if current_id is not None:
+                            yielded.add(current_id)
+                            yield current_id, messages
+                        current_id, messages = session_id, []
+                    messages.append(row_to_message(role, content, extra))
+            if current_id is not None:
+                yielded.add(current_id)
+                yield current_id, messages
+        for session_id in migrated:
+            if session_id not in yielded:
+                yield session_id, []
+
+    # Legacy blob, or the session's rows as [role, content, extra] arrays, inherited
+    # ones included, so a fork is exported as a session of its own
+    EXPORT_HISTORY_SQL = """
+        chat_history,
+        (
+            WITH RECURSIVE lineage AS (
+                SELECT
+                    chat_sessions.session_id,
+                    chat_sessions.parent_session_id,
+                    chat_sessions.parent_message_count,
+                    CAST(NULL AS INTEGER) AS below
+                UNION ALL
+                SELECT
+                    parent.session_id,
+                    parent.parent_session_id,
+                    parent.parent_message_count,
+                    LEAST(lineage.below, lineage.parent_message_count)
+                FROM chat_sessions AS parent
+                JOIN lineage ON parent.session_id = lineage.parent_session_id
+            )
+            SELECT json_agg(
+                json_build_array(
+                    role,
+                    CASE
+                        WHEN chat_messages.content_hash IS NULL
+                        THEN chat_messages.content
+                        ELSE (
+                            SELECT chat_message_contents.content
+                            FROM chat_message_contents
+                            WHERE chat_message_contents.content_hash
+                                = chat_messages.content_hash
+                        )
+                    END,
+                    extra
+                )
+                ORDER BY seq
+            )
+            FROM chat_messages
+            JOIN lineage ON chat_messages.session_id = lineage.session_id
+                AND (lineage.below IS NULL OR chat_messages.seq < lineage.below)
+        )
+        """
+
+    async def export_sessions(
+        self, session_ids: Optional[List[str]] = None
+    ) -> AsyncGenerator:
+        async with self.engine.connect() as conn:
+            result = await conn.stream(*self.export_query(session_ids))
+            async for partition in result.partitions(self.export_fetch_size):
+                for row in partition:
+                    session = dict(zip(SESSION_EXPORT_COLUMNS, row))
+                    legacy_blob, message_rows = row[-2], row[-1] or []
+                    if isinstance(message_rows, str):
+                        message_rows = json.loads(message_rows)
+                    if legacy_blob is not None:
+                        session["chat_history"] = legacy_blob
+                    else:
+                        session["chat_history"] = json.dumps(
+                            [
+                                row_to_message(*message_row)
+                                for message_row in message_rows
+                            ]
+                        )
+                    yield session
+
+    IMPORT_SQL = """
+        WITH inserted AS (
+            INSERT INTO chat_sessions
+            SELECT * FROM chat_sessions_import
+            ON CONFLICT (session_id) DO NOTHING
+            RETURNING session_id
+        ), inserted_messages AS (
+            INSERT INTO chat_messages
+            SELECT chat_messages_import.*
+            FROM chat_messages_import JOIN inserted USING (session_id)
+        )
+        SELECT count(*) FROM inserted
+        """
+
+    def import_history_columns(
+        self, chat_history: List[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        return {}
+
+    async def import_sessions(self, sessions: List[Dict[str, Any]]) -> int:
+        records = [
+            {c: session[c] for c in SESSION_EXPORT_COLUMNS} for session in sessions
+        ]
+        message_records = [
+            {"session_id": session["session_id"], "seq": seq, **message_to_row(message)}
+            for session in sessions
+            for seq, message in enumerate(session["chat_history"])
+        ]
+        async with self.engine.begin() as conn:
+            await self.store_shared_contents(conn, message_records)
+            await copy_to_temp_table(conn, "chat_sessions", records)
+            await copy_to_temp_table(conn, "chat_messages", message_records)
+            return (await conn.execute(text(self.IMPORT_SQL))).scalar()
+
+    async def get_messages(
+        self, session_id: str, offset: int = 0, limit: Optional[int] = None
+    ) -> Optional[Dict[str, Any]]:
+        # The (session_id, seq) primary key serves both the count and the range
+        async with self.engine.connect() as conn:
+            last_seq = (
+                select(func.max(self.messages_table.c.seq))
+                .where(self.messages_table.c.session_id == session_id)
+                .scalar_subquery()
+            )
+            stmt = select(
+                self.table.c.api_key_hash,
+                self.table.c.chat_history,
+                last_seq,
+                self.table.c.parent_message_count,
+            ).where(self.table.c.session_id == session_id)
+            head = (await conn.execute(stmt)).fetchone()
+            if head is None:
+                return None
+            api_key_hash, legacy_blob, max_seq, parent_message_count = head
+            if legacy_blob is None:
+                # A fork without messages of its own yet has its parent's prefix
+                total = (
+                    max_seq + 1 if max_seq is not None else parent_message_count or 0
+                )
+                start, end = resolve_range(total, offset, limit)
+                history = self.history_query(
+                    self.table.c.session_id == session_id
+                ).subquery()
+                stmt = (
+                    select(history.c.role, history.c.content, history.c.extra)
+                    .where(history.c.seq >= start, history.c.seq < end)
+                    .order_by(history.c.seq)
+                )
+                rows = (await conn.execute(stmt)).fetchall()
+                return {
+                    "api_key_hash": api_key_hash,
+                    "messages": [row_to_message(*row) for row in rows],
+                    "offset": start,
+                    "total": total,
+                }
+
+        # Not migrated yet: read (and migrate) the whole session, then slice it
+        chat_history = await self.migrate_blob_session(session_id)
+        start, end = resolve_range(len(chat_history), offset, limit)
+        return {
+            "api_key_hash": api_key_hash,
+            "messages": chat_history[start:end],
+            "offset": start,
+            "total": len(chat_history),
+        }
+
+    async def create_session(
+        self, session_id: str, chat_history: List[Dict[str, str]], api_key_hash: str
+    ):
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                insert(self.table).values(
+                    session_id=session_id,
+                    api_key_hash=api_key_hash,
+                    message_count=len(chat_history),
+                    last_model=last_model(chat_history),
+                )
+            )
+            await self.insert_messages(conn, session_id, 0, chat_history)
+
+    async def update_chat_history(
+        self, session_id: str, chat_history: List[Dict[str, str]]
+    ):
+        stored_count = stored_message_count(chat_history)
+        new_messages = chat_history[stored_count:]
+        if not new_messages:
+            return
+        async with self.engine.begin() as conn:
+            # The listing update goes first: it checks the version and takes the
+            # row lock before any message is inserted
+            version = await self.write_history(conn, session_id, chat_history)
+            if version is None:
+                if not await self.rebase(conn, session_id, chat_history):
+                    return
+                version = await self.write_history(conn, session_id, chat_history)
+            first_seq = stored_message_count(chat_history)
+            await self.insert_messages(
+                conn, session_id, first_seq, chat_history[first_seq:]
+            )
+        mark_written(chat_history, version)
+
+    async def write_history(
+        self, conn, session_id: str, chat_history: List[Dict[str, Any]]
+    ) -> Optional[int]:
+        stmt = (
+            update(self.table)
+            .where(
+                self.table.c.session_id == session_id,
+                self.version_matches(chat_history),
+            )
+            .values(**self.listing_values(chat_history))
+            .returning(self.table.c.version)
+        )
+        return (await conn.execute(stmt)).scalar()
+
+    async def rebase(self, conn, session_id: str, chat_history: "ChatHistory") -> bool:
+        stmt = (
+            select(self.table.c.version)
+            .where(self.table.c.session_id == session_id)
+            .with_for_update()
+        )
+        version = (await conn.execute(stmt)).scalar()
+        if version is None:
+            return False
+        # Messages are append-only, so only the ones after what this turn read
+        # can be missing
+        stmt = (
+            select(
+                self.messages_table.c.role,
+                self.content_column(),
+                self.messages_table.c.extra,
+            )
+            .where(
+                self.messages_table.c.session_id == session_id,
+                self.messages_table.c.seq >= chat_history.stored_count,
+            )
+            .order_by(self.messages_table.c.seq)
+        )
+        rows = (await conn.execute(stmt)).fetchall()
+        rebase_history(
+            chat_history,
+            chat_history[: chat_history.stored_count]
+            + [row_to_message(*row) for row in rows],
+            version,
+        )
+        return True
+
+    async def write_batch(self, batch: Dict[str, "ChatHistory"]):
+        batch = {
+            session_id: chat_history
+            for session_id, chat_history in batch.items()
+            if len(chat_history) > stored_message_count(chat_history)
+        }
+        if not batch:
+            return
+        listing_values = values(
+            column("session_id", String),
+            column("message_count", Integer),
+            column("last_model", String),
+            column("version", BigInteger),
+            name="batch",
+        ).data(
+            [
+                (
+                    session_id,
+                    len(chat_history),
+                    last_model(chat_history[stored_message_count(chat_history) :]),
+                    stored_version(chat_history),
+                )
+                for session_id, chat_history in batch.items()
+            ]
+        )
+        # Version check and row locks first, as in update_chat_history
+        stmt = (
+            update(self.table)
+            .where(
+                self.table.c.session_id == listing_values.c.session_id,
+                self.batch_version_matches(listing_values),
+            )
+            .values(
+                updated_at=func.now(),
+                version=self.table.c.version + 1,
+                message_count=listing_values.c.message_count,
+                last_model=func.coalesce(
+                    listing_values.c.last_model, self.table.c.last_model
+                ),
+            )
+            .returning(self.table.c.session_id, self.table.c.version)
+        )
+        async with self.engine.begin() as conn:
+            written = dict((await conn.execute(stmt)).fetchall())
+            # All new messages of every written session, in one multi-row INSERT
+            rows = []
+            for session_id in written:
+                chat_history = batch[session_id]
+                stored_count = stored_message_count(chat_history)
+                for i, message in enumerate(chat_history[stored_count:]):
+                    rows.append(
+                        {
+                            "session_id": session_id,
+                            "seq": stored_count + i,
+                            **message_to_row(message),
+                        }
+                    )
+            if rows:
+                await self.store_shared_contents(conn, rows)
+                await conn.execute(insert(self.messages_table).values(rows))
+        await self.finish_batch(batch, written)
+
+    async def fork_session(
+        self, session_id: str, new_session_id: str, message_count: Optional[int]
+    ) -> Optional[int]:
+        """
+        Copy-on-write fork: the new session references the parent's first
+        message_count messages instead of copying them, so forking takes the same
+        time however long the parent's history is.
+        """
+        async with self.engine.begin() as conn:
+            # KEY SHARE keeps the session reaper from deleting the parent under us
+            stmt = (
+                select(
+                    self.table.c.api_key_hash,
+                    self.table.c.chat_history.is_not(None),
+                    self.table.c.last_model,
+                    self.table.c.parent_message_count,
+                )
+                .where(self.table.c.session_id == session_id)
+                .with_for_update(read=True, key_share=True)
+            )
+            head = (await conn.execute(stmt)).fetchone()
+            if head is None:
+                return None
+            api_key_hash, has_legacy_blob, model, parent_message_count = head
+            if not has_legacy_blob:
+                stmt = select(func.max(self.messages_table.c.seq)).where(
+                    self.messages_table.c.session_id == session_id
+                )
+                max_seq = (await conn.execute(stmt)).scalar()
+                total = (
+                    max_seq + 1 if max_seq is not None else parent_message_count or 0
+                )
+                if message_count is None:
+                    message_count = total
+                if message_count > total:
+                    return None
+                await conn.execute(
+                    insert(self.table).values(
+                        session_id=new_session_id,
+                        api_key_hash=api_key_hash,
+                        message_count=message_count,
+                        last_model=model,
+                        parent_session_id=session_id if message_count else None,
+                        parent_message_count=message_count or None,
+                    )
+                )
+                metrics.incr("sessions_forked")
+                return message_count
+
+        # Only migrated sessions can be referenced
+        await self.migrate_blob_session(session_id)
+        return await self.fork_session(session_id, new_session_id, message_count)
+
+    async def insert_messages(
+        self,
+        conn,
+        session_id: str,
+        first_seq: int,
+        messages: List[Dict[str, Any]],
+    ):
+        if not messages:
+            return
+        rows = [
+            {"session_id": session_id, "seq": first_seq + i, **message_to_row(message)}
+            for i, message in enumerate(messages)
+        ]
+        await self.store_shared_contents(conn, rows)
+        await conn.execute(insert(self.messages_table), rows)
+
+    async def migrate_blob_session(self, session_id: str) -> List[Dict[str, Any]]:
+        """
+        Moves one session's legacy chat_history blob into chat_messages. The session
+        row is locked so two workers can't migrate the same session twice.
+        """
+        async with self.engine.begin() as conn:
+            stmt = (
+                select(self.table.c.chat_history)
+                .where(self.table.c.session_id == session_id)
+                .with_for_update()
+            )
+            legacy_blob = (await conn.execute(stmt)).scalar()
+            if legacy_blob is None:
+                # Another worker finished the migration first
+                stmt = (
+                    select(
+                        self.messages_table.c.role,
+                        self.content_column(),
+                        self.messages_table.c.extra,
+                    )
+                    .where(self.messages_table.c.session_id == session_id)
+                    .order_by(self.messages_table.c.seq)
+                )
+                rows = (await conn.execute(stmt)).fetchall()
+                return [row_to_message(*row) for row in rows]
+
+            chat_history = json.loads(legacy_blob) or []
+            await self.insert_messages(conn, session_id, 0, chat_history)
+            await conn.execute(
+                update(self.table)
+                .where(self.table.c.session_id == session_id)
+                .values(chat_history=None)
+            )
+        metrics.incr("chat_history_sessions_migrated")
+        return chat_history
+
+    async def migrate_blob_sessions(self):
+        """
+        Background migration of every remaining legacy blob, a batch at a time.
+        SKIP LOCKED lets all workers run this concurrently without blocking each
+        other or the request path.
+        """
+        try:
+            while True:
+                async with self.engine.begin() as conn:
+                    stmt = (
+                        select(self.table.c.session_id, self.table.c.chat_history)
+                        .where(self.table.c.chat_history.is_not(None))
+                        .limit(self.migration_batch_size)
+                        .with_for_update(skip_locked=True)
+                    )
+                    rows = (await conn.execute(stmt)).fetchall()
+                    for session_id, legacy_blob in rows:
+                        chat_history = json.loads(legacy_blob) or []
+                        await self.insert_messages(conn, session_id, 0, chat_history)
+                    if rows:
+                        await conn.execute(
+                            update(self.table)
+                            .where(self.table.c.session_id.in_([r[0] for r in rows]))
+                            .values(chat_history=None)
+                        )
+                metrics.incr("chat_history_sessions_migrated", len(rows))
+                if len(rows) < self.migration_batch_size:
+                    print("chat_history blob migration complete")
+                    return
+                await asyncio.sleep(0.1)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"chat_history blob migration error: {str(e)}")
+
+
+class JsonbSessionStore(SessionStore):
+    """
+    Session store that keeps the conversation in the chat_history_jsonb column and
+    appends each turn with a single UPDATE ... SET chat_history_jsonb =
+    chat_history_jsonb || :new. The middleware only sends the new messages. The
+    append checks the session version like the other modes, so a turn that raced
+    another one is rebased onto it and its caller sees both.
+    """
+
+    APPEND_SQL = text("""
+        UPDATE chat_sessions
+        SET chat_history_jsonb = COALESCE(
+                chat_history_jsonb, CAST(chat_history AS JSONB), '[]'::jsonb
+            ) || CAST(:new_messages AS JSONB),
+            chat_history = NULL,
+            updated_at = now(),
+            version = version + 1,
+            message_count = jsonb_array_length(COALESCE(
+                chat_history_jsonb, CAST(chat_history AS JSONB), '[]'::jsonb
+            )) + jsonb_array_length(CAST(:new_messages AS JSONB)),
+            last_model = COALESCE(CAST(:last_model AS VARCHAR), last_model)
+        WHERE session_id = :session_id
+            AND (CAST(:version AS BIGINT) IS NULL OR version = CAST(:version AS BIGINT))
+        RETURNING
+            version,
+            jsonb_array_length(chat_history_jsonb),
+            (
+                SELECT COALESCE(jsonb_agg(element ORDER BY position), '[]'::jsonb)
+                FROM jsonb_array_elements(chat_history_jsonb)
+                    WITH ORDINALITY AS elements(element, position)
+                WHERE position > jsonb_array_length(chat_history_jsonb) - :tail
+            )
+        """)
+
+    HISTORY_SQL = "COALESCE(chat_history_jsonb, CAST(chat_history AS JSONB))"
+
+    FORK_COLUMN_SQL = ("chat_history_jsonb", "history")
+
+    EXPORT_HISTORY_SQL = "chat_history_compressed, COALESCE(CAST(chat_history_jsonb AS TEXT), chat_history)"
+
+    def import_history_columns(
+        self, chat_history: List[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        return {"chat_history_jsonb": json.dumps(chat_history)}
+
+    def history_column(self):
+        # Sessions written in blob mode still have a Text chat_history until their
+        # first append in this mode, which converts them
+        return func.coalesce(
+            self.table.c.chat_history_jsonb, cast(self.table.c.chat_history, JSONB)
+        )
+
+    async def get_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        async with self.engine.connect() as conn:
+            stmt = select(
+                self.history_column(),
+                self.table.c.api_key_hash,
+                self.table.c.version,
+            ).where(self.table.c.session_id == session_id)
+            result = (await conn.execute(stmt)).fetchone()
+        if result:
+            chat_history = result[0]
+            return {
+                "chat_history": (
+                    ChatHistory(chat_history, len(chat_history), result[2])
+                    if chat_history is not None
+                    else None
+                ),
+                "api_key_hash": result[1],
+            }
+        return None
+
+    async def create_session(
+        self, session_id: str, chat_history: List[Dict[str, str]], api_key_hash: str
+    ):
+        async with self.engine.begin() as conn:
+            stmt = insert(self.table).values(
+                session_id=session_id,
+                chat_history_jsonb=chat_history,
+                api_key_hash=api_key_hash,
+                message_count=len(chat_history),
+                last_model=last_model(chat_history),
+            )
+            await conn.execute(stmt)
+
+    async def update_chat_history(
+        self, session_id: str, chat_history: List[Dict[str, str]]
+    ):
+        """
+        Appends the messages this turn added if the session is still at the version
+        chat_history was read at. Otherwise the row is locked, chat_history is
+        rebased onto what is stored, and the append is retried in the same
+        transaction.
+        """
+        if not chat_history[stored_message_count(chat_history) :]:
+            return
+        async with self.engine.begin() as conn:
+            version = await self.write_history(conn, session_id, chat_history)
+            if version is None and await self.rebase(conn, session_id, chat_history):
+                version = await self.write_history(conn, session_id, chat_history)
+        mark_written(chat_history, version)
+
+    async def write_history(
+        self, conn, session_id: str, chat_history: List[Dict[str, Any]]
+    ) -> Optional[int]:
+        new_messages = chat_history[stored_message_count(chat_history) :]
+        result = await conn.execute(
+            self.APPEND_SQL,
+            {
+                "session_id": session_id,
+                "new_messages": json.dumps(new_messages),
+                "last_model": last_model(new_messages),
+                "version": stored_version(chat_history),
+                "tail": 0,
+            },
+        )
+        row = result.fetchone()
+        return row[0] if row else None
+
+    async def rebase(self, conn, session_id: str, chat_history: "ChatHistory") -> bool:
+        # False if the session no longer exists
+        stmt = (
+            select(self.history_column(), self.table.c.version)
+            .where(self.table.c.session_id == session_id)
+            .with_for_update()
+        )
+        row = (await conn.execute(stmt)).fetchone()
+        if row is None:
+            return False
+        rebase_history(chat_history, row[0] or [], row[1])
+        return True
+
+    async def write_batch(self, batch: Dict[str, "ChatHistory"]):
+        # One UPDATE ... FROM (VALUES ...) appending each session's new messages
+        params = {}
+        value_rows = []
+        for i, (session_id, chat_history) in enumerate(batch.items()):
+            new_messages = chat_history[stored_message_count(chat_history) :]
+            if not new_messages:
+                continue
+            params[f"session_id_{i}"] = session_id
+            params[f"new_messages_{i}"] = json.dumps(new_messages)
+            params[f"last_model_{i}"] = last_model(new_messages)
+            params[f"version_{i}"] = stored_version(chat_history)
+            value_rows.append(
+                f"(:session_id_{i}, CAST(:new_messages_{i} AS JSONB), "
+                f"CAST(:last_model_{i} AS VARCHAR), CAST(:version_{i} AS BIGINT))"
+            )
+        written = {}
+        if value_rows:
+            stmt = text(f"""
+                UPDATE chat_sessions
+                SET chat_history_jsonb = COALESCE(
+                        chat_sessions.chat_history_jsonb,
+                        CAST(chat_sessions.chat_history AS JSONB),
+                        '[]'::jsonb
+                    ) || batch.new_messages,
+                    chat_history = NULL,
+                    updated_at = now(),
+                    version = chat_sessions.version + 1,
+                    message_count = jsonb_array_length(COALESCE(
+                        chat_sessions.chat_history_jsonb,
+                        CAST(chat_sessions.chat_history AS JSONB),
+                        '[]'::jsonb
+                    )) + jsonb_array_length(batch.new_messages),
+                    last_model = COALESCE(batch.last_model, chat_sessions.last_model)
+                FROM (VALUES {", ".join(value_rows)})
+                    AS batch(session_id, new_messages, last_model, version)
+                WHERE chat_sessions.session_id = batch.session_id
+                    AND (batch.version IS NULL OR chat_sessions.version = batch.version)
+                RETURNING chat_sessions.session_id, chat_sessions.version
+                """)
+            async with self.engine.begin() as conn:
+                written = dict((await conn.execute(stmt, params)).fetchall())
+        # Histories with nothing new need no write, and update_chat_history skips them
+        await self.finish_batch(batch, written)
+
+    async def append_messages(
+        self, session_id: str, new_messages: List[Dict[str, Any]], tail: int = 0
+    ) -> (int, List[Dict[str, Any]]):
+        """
+        Appends new_messages server side, whatever the session version. Returns the
+        resulting message count and the last `tail` messages, so a caller never has
+        to read the whole history back.
+        """
+        async with self.engine.begin() as conn:
+            result = await conn.execute(
+                self.APPEND_SQL,
+                {
+                    "session_id": session_id,
+                    "new_messages": json.dumps(new_messages),
+                    "last_model": last_model(new_messages),
+                    "version": None,
+                    "tail": tail,
+                },
+            )
+            row = result.fetchone()
+        if row is None:
+            return 0, []
+        tail_messages = json.loads(row[2]) if isinstance(row[2], str) else row[2]
+        return row[1], tail_messages
@@ -0,0 +1,464 @@
+"""
+Redis tier in front of a session store (SESSION_REDIS_ENABLED).
+"""
+
+import asyncio
+import json
+import uuid
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+from middleware_metrics import metrics
+from session_store.base import (
+    ChatHistory,
+    SessionStoreProtocol,
+    history_owner,
+    mark_written,
+    resolve_range,
+    stored_message_count,
+    stored_version,
+)
+
+
+class RedisSessionStore(SessionStoreProtocol):
+    """
+    Redis tier in front of a session store. An active session lives in Redis as a
+    hash (owner and number of messages already persisted) plus a list of JSON
+    messages. Reads and appends only touch Redis. Sessions with unpersisted messages
+    are tracked in a dirty set that flush_loop(), run by start(), drains into the
+    database store, so Postgres only sees one write per session per flush interval.
+    Sessions that are not yet flushed are not returned by list_sessions.
+    """
+
+    KEY_PREFIX = "middleware:chat_session:"
+    DIRTY_KEY = "middleware:chat_sessions:dirty"
+
+    # Only sessions with everything persisted have a TTL: the cluster evicts keys
+    # with one (volatile-* policies), and a dirty session must stay until flushed.
+
+    # Loads a session read from the database, unless another worker already did.
+    # A new session (persisted_count -1) is dirty, so gets no TTL.
+    LOAD_SCRIPT = """
+    if redis.call("EXISTS", KEYS[1]) == 1 then
+        return 0
+    end
+    redis.call(
+        "HSET", KEYS[1],
+        "api_key_hash", ARGV[2], "persisted_count", ARGV[3], "epoch", ARGV[4]
+    )
+    if #ARGV > 4 then
+        redis.call("RPUSH", KEYS[2], unpack(ARGV, 5))
+    end
+    if tonumber(ARGV[3]) >= 0 then
+        redis.call("EXPIRE", KEYS[1], ARGV[1])
+        redis.call("EXPIRE", KEYS[2], ARGV[1])
+    end
+    return 1
+    """
+
+    # Reads a session, keeping it from expiring while it is active
+    READ_SCRIPT = """
+    local meta = redis.call("HGETALL", KEYS[1])
+    local messages = redis.call("LRANGE", KEYS[2], 0, -1)
+    if #meta > 0 and redis.call("TTL", KEYS[1]) >= 0 then
+        redis.call("EXPIRE", KEYS[1], ARGV[1])
+        redis.call("EXPIRE", KEYS[2], ARGV[1])
+    end
+    return {meta, messages}
+    """
+
+    # Appends messages to a session that is still in Redis and marks it dirty,
+    # which keeps it from expiring until flushed. Returns -1 if the session is no
+    # longer in Redis.
+    APPEND_SCRIPT = """
+    if redis.call("EXISTS", KEYS[1]) == 0 then
+        return -1
+    end
+    local length = redis.call("RPUSH", KEYS[2], unpack(ARGV, 2))
+    redis.call("SADD", KEYS[3], ARGV[1])
+    redis.call("PERSIST", KEYS[1])
+    redis.call("PERSIST", KEYS[2])
+    return length
+    """
+
+    # Records what a flush persisted. The TTL comes back once nothing was
+    # appended in the meantime.
+    FLUSHED_SCRIPT = """
+    if redis.call("EXISTS", KEYS[1]) == 0 then
+        return 0
+    end
+    redis.call("HSET", KEYS[1], "persisted_count", ARGV[2])
+    if redis.call("LLEN", KEYS[2]) == tonumber(ARGV[2]) then
+        redis.call("EXPIRE", KEYS[1], ARGV[1])
+        redis.call("EXPIRE", KEYS[2], ARGV[1])
+    end
+    return 1
+    """
+
+    # Releases a flush lock only if this worker still holds it
+    UNLOCK_SCRIPT = """
+    if redis.call("GET", KEYS[1]) == ARGV[1] then
+        return redis.call("DEL", KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(
+        self,
+        store: SessionStoreProtocol,
+        redis_client,
+        ttl: int = 3600,
+        flush_interval: float = 1.0,
+        flush_batch_size: int = 100,
+        fetch_size: int = 100,
+    ):
+        self.store = store
+        self.redis = redis_client
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.fetch_size = fetch_size
+        self.flush_task = None
+        self.load_script = redis_client.register_script(self.LOAD_SCRIPT)
+        self.read_script = redis_client.register_script(self.READ_SCRIPT)
+        self.append_script = redis_client.register_script(self.APPEND_SCRIPT)
+        self.flushed_script = redis_client.register_script(self.FLUSHED_SCRIPT)
+        self.unlock_script = redis_client.register_script(self.UNLOCK_SCRIPT)
+        self.worker_token = str(uuid.uuid4())
+
+    # Listings and exports read the database store: sessions not flushed yet are
+    # left out. Imported sessions are loaded into Redis on their first read.
+    async def list_sessions(
+        self,
+        api_key_hash: str,
+        limit: int,
+        cursor: Optional[str] = None,
+        include_metadata: bool = False,
+    ) -> (List[Dict[str, Any]], Optional[str]):
+        return await self.store.list_sessions(
+            api_key_hash, limit, cursor, include_metadata
+        )
+
+    async def export_sessions(
+        self, session_ids: Optional[List[str]] = None
+    ) -> AsyncGenerator:
+        async for session in self.store.export_sessions(session_ids):
+            yield session
+
+    async def import_sessions(self, sessions: List[Dict[str, Any]]) -> int:
+        return await self.store.import_sessions(sessions)
+
+    def meta_key(self, session_id: str) -> str:
+        return f"{self.KEY_PREFIX}{session_id}:meta"
+
+    def messages_key(self, session_id: str) -> str:
+        return f"{self.KEY_PREFIX}{session_id}:messages"
+
+    def lock_key(self, session_id: str) -> str:
+        return f"{self.KEY_PREFIX}{session_id}:flush_lock"
+
+    async def read(self, session_id: str):
+        flat_meta, raw_messages = await self.read_script(
+            keys=[self.meta_key(session_id), self.messages_key(session_id)],
+            args=[self.ttl],
+        )
+        meta = dict(zip(flat_meta[::2], flat_meta[1::2]))
+        return meta, [json.loads(m) for m in raw_messages]
+
+    async def get_version(self, session_id: str) -> Optional[Dict[str, Any]]:
+        # The list only ever grows while the session is in Redis, so its length
+        # identifies the content. The epoch, new each time the session is loaded,
+        # keeps versions from two stays in Redis apart.
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hmget(self.meta_key(session_id), "api_key_hash", "epoch")
+        pipe.llen(self.messages_key(session_id))
+        (api_key_hash, epoch), length = await pipe.execute()
+        if api_key_hash is None:
+            return await self.store.get_version(session_id)
+        return {
+            "api_key_hash": api_key_hash,
+            "version": f"{epoch}.{length}",
+            "message_count": length,
+        }
+
+    async def stream_sessions(
+        self, session_ids: List[str], api_key_hash: str
+    ) -> AsyncGenerator:
+        # Sessions in Redis may be ahead of the database, so serve those from here
+        pipe = self.redis.pipeline(transaction=False)
+        for session_id in session_ids:
+            pipe.hget(self.meta_key(session_id), "api_key_hash")
+        owners = await pipe.execute()
+        not_in_redis = []
+        for session_id, owner in zip(session_ids, owners):
+            if owner is None:
+                not_in_redis.append(session_id)
+            elif owner == api_key_hash:
+                meta, chat_history = await self.read(session_id)
+                if meta:
+                    yield session_id, chat_history
+        if not_in_redis:
+            async for item in self.store.stream_sessions(not_in_redis, api_key_hash):
+                yield item
+
+    async def stream_messages(self, session_id: str) -> AsyncGenerator:
+        if not await self.redis.exists(self.meta_key(session_id)):
+            async for message in self.store.stream_messages(session_id):
+                yield message
+            return
+        # The list only grows, so reading it in LRANGE pages is consistent
+        start = 0
+        while True:
+            raw_messages = await self.redis.lrange(
+                self.messages_key(session_id),
+                start,
+                start + self.fetch_size - 1,
+            )
+            for raw_message in raw_messages:
+                yield json.loads(raw_message)
+            if len(raw_messages) < self.fetch_size:
+                return
+            start += self.fetch_size
+
+    async def get_messages(
+        self, session_id: str, offset: int = 0, limit: Optional[int] = None
+    ) -> Optional[Dict[str, Any]]:
+        # LRANGE only the requested slice of a session that is in Redis
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hget(self.meta_key(session_id), "api_key_hash")
+        pipe.llen(self.messages_key(session_id))
+        api_key_hash, total = await pipe.execute()
+        if api_key_hash is None:
+            metrics.incr("session_redis_misses")
+            return await self.store.get_messages(session_id, offset, limit)
+
+        metrics.incr("session_redis_hits")
+        start, end = resolve_range(total, offset, limit)
+        raw_messages = []
+        if end > start:
+            raw_messages = await self.redis.lrange(
+                self.messages_key(session_id), start, end - 1
+            )
+        return {
+            "api_key_hash": api_key_hash,
+            "messages": [json.loads(m) for m in raw_messages],
+            "offset": start,
+            "total": total,
+        }
+
+    async def get_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        # stored_count is the position in the Redis list, which is where a turn's
+        # new messages start; the database may be behind it until the next flush
+        meta, chat_history = await self.read(session_id)
+        if meta:
+            metrics.incr("session_redis_hits")
+            return {
+                "chat_history": ChatHistory(
+                    chat_history, len(chat_history), None, meta["api_key_hash"]
+                ),
+                "api_key_hash": meta["api_key_hash"],
+            }
+
+        metrics.incr("session_redis_misses")
+        session_data = await self.store.get_session(session_id)
+        if session_data is not None:
+            chat_history = session_data["chat_history"] or []
+            if isinstance(chat_history, ChatHistory):
+                chat_history.api_key_hash = session_data["api_key_hash"]
+            await self.load_script(
+                keys=[self.meta_key(session_id), self.messages_key(session_id)],
+                args=[
+                    self.ttl,
+                    session_data["api_key_hash"],
+                    len(chat_history),
+                    uuid.uuid4().hex,
+                    *[json.dumps(m) for m in chat_history],
+                ],
+            )
+        return session_data
+
+    async def create_session(
+        self, session_id: str, chat_history: List[Dict[str, str]], api_key_hash: str
+    ):
+        # persisted_count -1 tells the flusher the session row doesn't exist yet
+        created = await self.load_script(
+            keys=[self.meta_key(session_id), self.messages_key(session_id)],
+            args=[
+                self.ttl,
+                api_key_hash,
+                -1,
+                uuid.uuid4().hex,
+                *[json.dumps(m) for m in chat_history],
+            ],
+        )
+        if created:
+            await self.redis.sadd(self.DIRTY_KEY, session_id)
+
+    async def update_chat_history(
+        self, session_id: str, chat_history: List[Dict[str, str]]
+    ):
+        stored_count = stored_message_count(chat_history)
+        new_messages = chat_history[stored_count:]
+        if not new_messages:
+            return
+        length = await self.append_script(
+            keys=[
+                self.meta_key(session_id),
+                self.messages_key(session_id),
+                self.DIRTY_KEY,
+            ],
+            args=[session_id, *[json.dumps(m) for m in new_messages]],
+        )
+        if length == -1:
+            # The session left Redis after it was read; write it directly
+            metrics.incr("session_redis_write_fallbacks")
+            await self.write_evicted(session_id, chat_history)
+            return
+        if isinstance(chat_history, ChatHistory):
+            chat_history.stored_count = len(chat_history)
+
+    async def write_evicted(self, session_id: str, chat_history: List[Dict[str, str]]):
+        """
+        Writes a turn whose session was gone from Redis by the time it was appended.
+        What the turn read from Redis may be ahead of the database, so the write
+        starts from what the database actually holds: the row is created if it
+        was never flushed, and otherwise every message past its count is written.
+        """
+        read_count = stored_message_count(chat_history)
+        stored = await self.store.get_version(session_id)
+        if stored is None:
+            await self.store.create_session(
+                session_id, list(chat_history), history_owner(chat_history)
+            )
+            mark_written(chat_history, 0)
+            return
+        persisted_count = stored["message_count"]
+        if persisted_count <= read_count:
+            write = ChatHistory(
+                chat_history,
+                persisted_count,
+                int(stored["version"]),
+                history_owner(chat_history),
+            )
+        else:
+            # Another turn was written since this one read the session. No version
+            # matches -1, so the write rebases onto it.
+            write = ChatHistory(
+                chat_history, read_count, -1, history_owner(chat_history)
+            )
+        await self.store.update_chat_history(session_id, write)
+        if isinstance(chat_history, ChatHistory):
+            chat_history[:] = write
+            mark_written(chat_history, stored_version(write))
+
+    async def dirty_sessions(self, session_ids: List[str]) -> set:
+        # Sessions with turns not yet in the database, including ones being flushed
+        pipe = self.redis.pipeline(transaction=False)
+        for session_id in session_ids:
+            pipe.sismember(self.DIRTY_KEY, session_id)
+            pipe.hget(self.meta_key(session_id), "persisted_count")
+            pipe.llen(self.messages_key(session_id))
+        results = await pipe.execute()
+        dirty = set()
+        for i, session_id in enumerate(session_ids):
+            in_dirty_set, persisted_count, length = results[3 * i : 3 * i + 3]
+            if in_dirty_set or (
+                persisted_count is not None and int(persisted_count) != length
+            ):
+                dirty.add(session_id)
+        return dirty
+
+    async def idle_sessions(
+        self, policy: str, params: Dict[str, Any], limit: int
+    ) -> List[Tuple[str, int]]:
+        # A session whose last turns are still in Redis is not idle
+        sessions = await self.store.idle_sessions(policy, params, limit)
+        if not sessions:
+            return sessions
+        dirty = await self.dirty_sessions([session_id for session_id, _ in sessions])
+        return [session for session in sessions if session[0] not in dirty]
+
+    async def delete_idle_sessions(self, sessions: List[Tuple[str, int]]) -> List[str]:
+        dirty = await self.dirty_sessions([session_id for session_id, _ in sessions])
+        deleted = await self.store.delete_idle_sessions(
+            [session for session in sessions if session[0] not in dirty]
+        )
+        if deleted:
+            pipe = self.redis.pipeline(transaction=False)
+            for session_id in deleted:
+                pipe.delete(self.meta_key(session_id), self.messages_key(session_id))
+            pipe.srem(self.DIRTY_KEY, *deleted)
+            await pipe.execute()
+        return deleted
+
+    async def fork_session(
+        self, session_id: str, new_session_id: str, message_count: Optional[int]
+    ) -> Optional[int]:
+        # The fork is made in the database, so it needs the turns still in Redis
+        await self.flush_session(session_id)
+        return await self.store.fork_session(session_id, new_session_id, message_count)
+
+    async def flush_session(self, session_id: str):
+        lock_key = self.lock_key(session_id)
+        if not await self.redis.set(lock_key, self.worker_token, nx=True, ex=60):
+            # Another worker is flushing this session; try again next round
+            await self.redis.sadd(self.DIRTY_KEY, session_id)
+            return
+        try:
+            meta, chat_history = await self.read(session_id)
+            if not meta:
+                return
+            persisted_count = int(meta["persisted_count"])
+            if persisted_count < 0:
+                await self.store.create_session(
+                    session_id, chat_history, meta["api_key_hash"]
+                )
+            elif len(chat_history) > persisted_count:
+                await self.store.update_chat_history(
+                    session_id, ChatHistory(chat_history, persisted_count)
+                )
+            await self.flushed_script(
+                keys=[self.meta_key(session_id), self.messages_key(session_id)],
+                args=[self.ttl, len(chat_history)],
+            )
+            metrics.incr("session_redis_flushes")
+        except Exception as e:
+            print(f"Error flushing session {session_id} from Redis: {str(e)}")
+            metrics.incr("session_redis_flush_errors")
+            await self.redis.sadd(self.DIRTY_KEY, session_id)
+        finally:
+            await self.unlock_script(keys=[lock_key], args=[self.worker_token])
+
+    async def flush_dirty(self) -> int:
+        session_ids = await self.redis.spop(self.DIRTY_KEY, self.flush_batch_size)
+        for session_id in session_ids or []:
+            await self.flush_session(session_id)
+        return len(session_ids or [])
+
+    def start(self):
+        self.flush_task = asyncio.create_task(self.flush_loop())
+
+    async def flush_loop(self):
+        while True:
+            try:
+                await asyncio.sleep(self.flush_interval)
+                # Keep going while there is a backlog, but yield between rounds
+                for _ in range(10):
+                    if await self.flush_dirty() < self.flush_batch_size:
+                        break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Redis session flusher error: {str(e)}")
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        # Persist everything still pending before the worker exits
+        try:
+            for _ in range(100):
+                if not await self.flush_dirty():
+                    break
+        except Exception as e:
+            print(f"Error draining Redis sessions on shutdown: {str(e)}")
+        await self.redis.aclose()
+        await self.store.close()
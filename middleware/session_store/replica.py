@@ -0,0 +1,209 @@
+"""
+Routes session reads to a Postgres read replica (DATABASE_REPLICA_URL).
+"""
+
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from middleware_metrics import metrics
+from session_store.base import ChatHistory, DatabaseStoreProtocol
+from session_store.postgres import SessionStore
+
+# Set by the read-only history endpoints. Their reads of sessions this worker has
+# no write position for may be served by the replica; turn-path reads may not.
+replica_reads_allowed = ContextVar("replica_reads_allowed", default=False)
+
+
+class ReplicaRoutingStore(DatabaseStoreProtocol):
+    """
+    Sends session reads to a read replica whenever that can't return a stale turn.
+    Writes go to the primary, and the primary's WAL position (LSN) after each write
+    is remembered per session. A read of a session written through this worker
+    goes to the replica only once the replica has replayed past that position.
+    For sessions with no remembered position, the turn path reads the primary and
+    the read-only endpoints read the replica. A failed replica read is retried on
+    the primary.
+    """
+
+    CURRENT_LSN_SQL = text("SELECT CAST(pg_current_wal_lsn() - '0/0' AS BIGINT)")
+    # On a primary configured as the replica there is no replay position
+    REPLAY_LSN_SQL = text(
+        "SELECT CAST(COALESCE(pg_last_wal_replay_lsn(), pg_current_wal_lsn()) "
+        "- '0/0' AS BIGINT)"
+    )
+
+    def __init__(
+        self,
+        primary: SessionStore,
+        replica: SessionStore,
+        max_tracked: int,
+        lsn_refresh_seconds: float = 0.05,
+    ):
+        self.primary = primary
+        self.replica = replica
+        self.max_tracked = max_tracked
+        # How long a replay position read from the replica is reused
+        self.lsn_refresh_seconds = lsn_refresh_seconds
+        # session_id -> primary LSN after its last write, oldest first
+        self.write_lsns = OrderedDict()
+        self.replay_lsn = 0
+        self.replay_lsn_checked = 0.0
+
+    # Imports and expiry go to the primary: expiry must see the latest versions
+    async def import_sessions(self, sessions: List[Dict[str, Any]]) -> int:
+        return await self.primary.import_sessions(sessions)
+
+    async def idle_sessions(
+        self, policy: str, params: Dict[str, Any], limit: int
+    ) -> List[Tuple[str, int]]:
+        return await self.primary.idle_sessions(policy, params, limit)
+
+    async def delete_idle_sessions(self, sessions: List[Tuple[str, int]]) -> List[str]:
+        return await self.primary.delete_idle_sessions(sessions)
+
+    async def record_writes(self, session_ids: List[str]):
+        async with self.primary.engine.connect() as conn:
+            lsn = (await conn.execute(self.CURRENT_LSN_SQL)).scalar()
+        for session_id in session_ids:
+            self.write_lsns[session_id] = lsn
+            self.write_lsns.move_to_end(session_id)
+        while len(self.write_lsns) > self.max_tracked:
+            self.write_lsns.popitem(last=False)
+
+    async def create_session(
+        self, session_id: str, chat_history: List[Dict[str, str]], api_key_hash: str
+    ):
+        await self.primary.create_session(session_id, chat_history, api_key_hash)
+        await self.record_writes([session_id])
+
+    async def update_chat_history(
+        self, session_id: str, chat_history: List[Dict[str, str]]
+    ):
+        await self.primary.update_chat_history(session_id, chat_history)
+        await self.record_writes([session_id])
+
+    async def write_batch(self, batch: Dict[str, "ChatHistory"]):
+        await self.primary.write_batch(batch)
+        await self.record_writes(list(batch))
+
+    async def fork_session(
+        self, session_id: str, new_session_id: str, message_count: Optional[int]
+    ) -> Optional[int]:
+        forked = await self.primary.fork_session(
+            session_id, new_session_id, message_count
+        )
+        await self.record_writes([new_session_id])
+        return forked
+
+    async def replica_caught_up(self, write_lsn: int) -> bool:
+        # Replay only moves forward, so a cached position that is far enough is final
+        if self.replay_lsn >= write_lsn:
+            return True
+        if time.monotonic() - self.replay_lsn_checked < self.lsn_refresh_seconds:
+            return False
+        async with self.replica.engine.connect() as conn:
+            self.replay_lsn = (await conn.execute(self.REPLAY_LSN_SQL)).scalar()
+        self.replay_lsn_checked = time.monotonic()
+        return self.replay_lsn >= write_lsn
+
+    async def use_replica(self, session_ids: List[str]) -> bool:
+        write_lsns = [
+            self.write_lsns[session_id]
+            for session_id in session_ids
+            if session_id in self.write_lsns
+        ]
+        if len(write_lsns) < len(session_ids) or not session_ids:
+            if not replica_reads_allowed.get():
+                return False
+        if not write_lsns:
+            return True
+        try:
+            caught_up = await self.replica_caught_up(max(write_lsns))
+        except Exception as e:
+            print(f"Replica position check failed: {str(e)}")
+            metrics.incr("replica_errors")
+            return False
+        if not caught_up:
+            metrics.incr("replica_stale_reads_avoided")
+        return caught_up
+
+    async def read(self, session_ids: List[str], method: str, *args, **kwargs):
+        if await self.use_replica(session_ids):
+            try:
+                result = await getattr(self.replica, method)(*args, **kwargs)
+                metrics.incr("replica_reads")
+                return result
+            except Exception as e:
+                print(f"Replica read failed, reading the primary: {str(e)}")
+                metrics.incr("replica_errors")
+        return await getattr(self.primary, method)(*args, **kwargs)
+
+    async def read_stream(self, session_ids: List[str], method: str, *args, **kwargs):
+        if await self.use_replica(session_ids):
+            started = False
+            try:
+                async for item in getattr(self.replica, method)(*args, **kwargs):
+                    started = True
+                    yield item
+                metrics.incr("replica_reads")
+                return
+            except Exception as e:
+                # Part of the response is already sent; it can't be restarted
+                if started:
+                    raise
+                print(f"Replica read failed, reading the primary: {str(e)}")
+                metrics.incr("replica_errors")
+        async for item in getattr(self.primary, method)(*args, **kwargs):
+            yield item
+
+    async def get_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return await self.read([session_id], "get_session", session_id)
+
+    async def get_messages(
+        self, session_id: str, offset: int = 0, limit: Optional[int] = None
+    ) -> Optional[Dict[str, Any]]:
+        return await self.read([session_id], "get_messages", session_id, offset, limit)
+
+    async def get_version(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return await self.read([session_id], "get_version", session_id)
+
+    async def list_sessions(
+        self,
+        api_key_hash: str,
+        limit: int,
+        cursor: Optional[str] = None,
+        include_metadata: bool = False,
+    ) -> (List[Dict[str, Any]], Optional[str]):
+        return await self.read(
+            [], "list_sessions", api_key_hash, limit, cursor, include_metadata
+        )
+
+    async def stream_messages(self, session_id: str) -> AsyncGenerator:
+        async for message in self.read_stream(
+            [session_id], "stream_messages", session_id
+        ):
+            yield message
+
+    async def stream_sessions(
+        self, session_ids: List[str], api_key_hash: str
+    ) -> AsyncGenerator:
+        async for item in self.read_stream(
+            session_ids, "stream_sessions", session_ids, api_key_hash
+        ):
+            yield item
+
+    async def export_sessions(
+        self, session_ids: Optional[List[str]] = None
+    ) -> AsyncGenerator:
+        async for session in self.read_stream(
+            session_ids or [], "export_sessions", session_ids
+        ):
+            yield session
+
+    async def close(self):
+        await self.primary.close()
+        await self.replica.close()
@@ -0,0 +1,700 @@
+"""
+Session store on an embedded SQLite database (CHAT_HISTORY_STORAGE=sqlite).
+"""
+
+import asyncio
+import json
+import queue
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+from anyio import CapacityLimiter, to_thread
+
+from middleware_metrics import BATCH_SIZE_BUCKETS, metrics
+from session_store.base import (
+    SESSION_EXPORT_COLUMNS,
+    ChatHistory,
+    DatabaseStoreProtocol,
+    decode_session_cursor,
+    encode_session_cursor,
+    last_model,
+    mark_written,
+    rebase_history,
+    resolve_range,
+    stored_message_count,
+    stored_version,
+)
+
+
+def datetime_to_micros(value: datetime) -> int:
+    # SQLite has no timestamp type: timestamps are UTC microseconds since the epoch
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp() * 1_000_000)
+
+
+def micros_to_datetime(value: int) -> datetime:
+    return datetime.fromtimestamp(value / 1_000_000, timezone.utc)
+
+
+def connect_sqlite(path: str, busy_timeout_ms: int) -> sqlite3.Connection:
+    # Transactions are opened explicitly (isolation_level=None) and the connection
+    # is handed between threads, one at a time
+    conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    conn.execute(f"PRAGMA busy_timeout = {busy_timeout_ms}")
+    conn.execute("PRAGMA synchronous = FULL")
+    return conn
+
+
+class SqliteWriter:
+    """
+    The one thread that writes to the SQLite database. A write is a function of the
+    connection, queued with submit(). The thread runs what has queued up, at most
+    max_batch_size writes, in one transaction and commits them
+    together, so concurrent turns share a commit (and its fsync) the way
+    HistoryWriter batches them for Postgres. Each write runs in a savepoint of its
+    own, so a failing one is rolled back without the rest of its batch.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, max_batch_size: int):
+        self.conn = conn
+        self.max_batch_size = max_batch_size
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(
+            target=self.run, name="sqlite-writer", daemon=True
+        )
+        self.thread.start()
+
+    async def submit(self, write):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put((write, future))
+        return await future
+
+    def run(self):
+        closing = False
+        while not closing:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            # None, queued by close(), stops the thread once what is before it is written
+            closing = None in batch
+            batch = [item for item in batch if item is not None]
+            if batch:
+                self.write_batch(batch)
+        self.conn.close()
+
+    def write_batch(self, batch):
+        outcomes = []
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            for write, _ in batch:
+                self.conn.execute("SAVEPOINT write")
+                try:
+                    outcomes.append((write(self.conn), None))
+                except Exception as e:
+                    self.conn.execute("ROLLBACK TO write")
+                    outcomes.append((None, e))
+                self.conn.execute("RELEASE write")
+            self.conn.execute("COMMIT")
+        except Exception as e:
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
+            outcomes = [(None, e)] * len(batch)
+        loop = batch[0][1].get_loop()
+        loop.call_soon_threadsafe(
+            metrics.observe, "sqlite_write_batch_size", len(batch), BATCH_SIZE_BUCKETS
+        )
+        for (_, future), (result, error) in zip(batch, outcomes):
+            future.get_loop().call_soon_threadsafe(self.resolve, future, result, error)
+
+    @staticmethod
+    def resolve(future: asyncio.Future, result, error: Optional[Exception]):
+        # The submitting request may have been cancelled meanwhile
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    async def close(self):
+        self.queue.put(None)
+        await to_thread.run_sync(self.thread.join)
+
+
+class SqliteSessionStore(DatabaseStoreProtocol):
+    """
+    Session store on an embedded SQLite database (CHAT_HISTORY_STORAGE=sqlite), for
+    single-node deployments and load tests that have no Postgres. It implements
+    DatabaseStoreProtocol like SessionStore, so the wrappers of create_session_store
+    and every history feature work on top of it unchanged. The database is in WAL mode:
+    readers use a small pool of connections in worker threads and never wait on the
+    writer, and all writes go through one SqliteWriter thread, which batches them
+    into shared commits. Messages are stored one row per message, as in "messages"
+    mode, so a turn only inserts what it appended. Unlike "messages" mode, a fork
+    gets its own copy of the parent's messages. Several uvicorn workers can share
+    the database file; their writers then take turns on SQLite's write lock.
+    """
+
+    SCHEMA_SQL = """
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            session_id TEXT PRIMARY KEY,
+            api_key_hash TEXT,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            last_model TEXT,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_chat_sessions_api_key_hash_updated_at
+            ON chat_sessions (api_key_hash, updated_at DESC, session_id DESC);
+        CREATE INDEX IF NOT EXISTS idx_chat_sessions_updated_at
+            ON chat_sessions (updated_at);
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            session_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            PRIMARY KEY (session_id, seq)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS chat_session_summaries (
+            session_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            covered_count INTEGER NOT NULL
+        );
+        """
+
+    UPDATE_SQL = """
+        UPDATE chat_sessions
+        SET updated_at = :now,
+            message_count = :message_count,
+            last_model = COALESCE(:last_model, last_model),
+            version = version + 1
+        WHERE session_id = :session_id AND (:version IS NULL OR version = :version)
+        RETURNING version
+        """
+
+    INSERT_MESSAGE_SQL = """
+        INSERT INTO chat_messages (session_id, seq, message) VALUES (?, ?, ?)
+        """
+
+    MESSAGES_SQL = """
+        SELECT seq, message
+        FROM chat_messages
+        WHERE session_id = :session_id AND seq >= :start AND seq < :end
+        ORDER BY seq
+        """
+
+    LIST_SQL = """
+        SELECT session_id, updated_at, created_at, message_count, last_model
+        FROM chat_sessions
+        WHERE api_key_hash = :api_key_hash
+            AND (:cursor_updated_at IS NULL
+                OR (updated_at, session_id) < (:cursor_updated_at, :cursor_session_id))
+        ORDER BY updated_at DESC, session_id DESC
+        LIMIT :limit
+        """
+
+    EXPORT_SQL = """
+        SELECT
+            session_id, api_key_hash, created_at, updated_at, message_count,
+            last_model, version
+        FROM chat_sessions
+        WHERE session_id > :after
+            AND (:session_ids IS NULL
+                OR session_id IN (SELECT value FROM json_each(:session_ids)))
+        ORDER BY session_id
+        LIMIT :limit
+        """
+
+    FORK_MESSAGES_SQL = """
+        INSERT INTO chat_messages (session_id, seq, message)
+        SELECT :new_session_id, seq, message
+        FROM chat_messages
+        WHERE session_id = :session_id AND seq < :message_count
+        """
+
+    SAVE_SUMMARY_SQL = """
+        INSERT INTO chat_session_summaries (session_id, summary, covered_count)
+        VALUES (:session_id, :summary, :covered_count)
+        ON CONFLICT (session_id) DO UPDATE
+        SET summary = excluded.summary, covered_count = excluded.covered_count
+        WHERE chat_session_summaries.covered_count < excluded.covered_count
+        """
+
+    def __init__(
+        self,
+        path: str,
+        max_batch_size: int,
+        read_threads: int,
+        busy_timeout_ms: int = 5000,
+        fetch_size: int = 100,
+        export_fetch_size: int = 1000,
+    ):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.fetch_size = fetch_size
+        self.export_fetch_size = export_fetch_size
+        conn = connect_sqlite(path, busy_timeout_ms)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(self.SCHEMA_SQL)
+        self.writer = SqliteWriter(conn, max_batch_size)
+        # At most read_threads reads at once, each on a pooled connection
+        self.read_limiter = CapacityLimiter(read_threads)
+        self.readers = queue.SimpleQueue()
+
+    async def read(self, query):
+        return await to_thread.run_sync(
+            self.read_sync, query, limiter=self.read_limiter
+        )
+
+    def read_sync(self, query):
+        try:
+            conn = self.readers.get_nowait()
+        except queue.Empty:
+            conn = connect_sqlite(self.path, self.busy_timeout_ms)
+        try:
+            # One snapshot for all the statements of the read
+            conn.execute("BEGIN")
+            try:
+                return query(conn)
+            finally:
+                conn.execute("COMMIT")
+        finally:
+            self.readers.put(conn)
+
+    @staticmethod
+    def read_messages(
+        conn, session_id: str, start: int = 0, end: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        rows = conn.execute(
+            SqliteSessionStore.MESSAGES_SQL,
+            {
+                "session_id": session_id,
+                "start": start,
+                "end": end if end is not None else 2**62,
+            },
+        ).fetchall()
+        return [json.loads(row[1]) for row in rows]
+
+    @staticmethod
+    def insert_messages(
+        conn, session_id: str, start: int, messages: List[Dict[str, Any]]
+    ):
+        conn.executemany(
+            SqliteSessionStore.INSERT_MESSAGE_SQL,
+            [
+                (session_id, seq, json.dumps(message))
+                for seq, message in enumerate(messages, start)
+            ],
+        )
+
+    async def get_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        def query(conn):
+            row = conn.execute(
+                "SELECT api_key_hash, version FROM chat_sessions "
+                "WHERE session_id = :session_id",
+                {"session_id": session_id},
+            ).fetchone()
+            if row is None:
+                return None
+            return row, self.read_messages(conn, session_id)
+
+        result = await self.read(query)
+        if result is None:
+            return None
+        (api_key_hash, version), chat_history = result
+        return {
+            "chat_history": ChatHistory(chat_history, len(chat_history), version),
+            "api_key_hash": api_key_hash,
+        }
+
+    async def create_session(
+        self, session_id: str, chat_history: List[Dict[str, str]], api_key_hash: str
+    ):
+        messages = list(chat_history)
+
+        def write(conn):
+            now = datetime_to_micros(datetime.now(timezone.utc))
+            conn.execute(
+                "INSERT INTO chat_sessions (session_id, api_key_hash, created_at, "
+                "updated_at, message_count, last_model) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    session_id,
+                    api_key_hash,
+                    now,
+                    now,
+                    len(messages),
+                    last_model(messages),
+                ),
+            )
+            self.insert_messages(conn, session_id, 0, messages)
+
+        await self.writer.submit(write)
+
+    async def update_chat_history(
+        self, session_id: str, chat_history: List[Dict[str, str]]
+    ):
+        """
+        Compare-and-swap on the session version, as SessionStore does. The writer
+        thread holds SQLite's write lock for the whole batch, so when the version
+        moved on, the rebase and the retry see nothing else in between.
+        """
+        if len(chat_history) <= stored_message_count(chat_history):
+            return
+        version = await self.writer.submit(
+            lambda conn: self.write_history(conn, session_id, chat_history)
+        )
+        if version is not None:
+            mark_written(chat_history, version)
+
+    def write_history(
+        self, conn, session_id: str, chat_history: List[Dict[str, Any]]
+    ) -> Optional[int]:
+        # Runs on the writer thread. None if the session no longer exists.
+        row = conn.execute(
+            self.UPDATE_SQL, self.update_values(session_id, chat_history)
+        ).fetchone()
+        if row is None:
+            stored = conn.execute(
+                "SELECT version FROM chat_sessions WHERE session_id = :session_id",
+                {"session_id": session_id},
+            ).fetchone()
+            if stored is None:
+                return None
+            stored_count = stored_message_count(chat_history)
+            rebase_history(
+                chat_history,
+                chat_history[:stored_count]
+                + self.read_messages(conn, session_id, stored_count),
+                stored[0],
+            )
+            row = conn.execute(
+                self.UPDATE_SQL, self.update_values(session_id, chat_history)
+            ).fetchone()
+        start = stored_message_count(chat_history)
+        self.insert_messages(conn, session_id, start, chat_history[start:])
+        return row[0]
+
+    @staticmethod
+    def update_values(
+        session_id: str, chat_history: List[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        return {
+            "session_id": session_id,
+            "version": stored_version(chat_history),
+            "now": datetime_to_micros(datetime.now(timezone.utc)),
+            "message_count": len(chat_history),
+            "last_model": last_model(
+                chat_history[stored_message_count(chat_history) :]
+            ),
+        }
+
+    async def write_batch(self, batch: Dict[str, "ChatHistory"]):
+        # The writer thread already commits concurrent writes together
+        await asyncio.gather(
+            *(
+                self.update_chat_history(session_id, chat_history)
+                for session_id, chat_history in batch.items()
+            )
+        )
+
+    async def get_version(self, session_id: str) -> Optional[Dict[str, Any]]:
+        def query(conn):
+            return conn.execute(
+                "SELECT api_key_hash, version, message_count FROM chat_sessions "
+                "WHERE session_id = :session_id",
+                {"session_id": session_id},
+            ).fetchone()
+
+        result = await self.read(query)
+        if result is None:
+            return None
+        return {
+            "api_key_hash": result[0],
+            "version": str(result[1]),
+            "message_count": result[2],
+        }
+
+    async def stream_messages(self, session_id: str) -> AsyncGenerator:
+        # fetch_size messages per read, each in its own snapshot
+        start = 0
+        while True:
+            messages = await self.read(
+                lambda conn: self.read_messages(
+                    conn, session_id, start, start + self.fetch_size
+                )
+            )
+            for message in messages:
+                yield message
+            if len(messages) < self.fetch_size:
+                return
+            start += len(messages)
+
+    async def stream_sessions(
+        self, session_ids: List[str], api_key_hash: str
+    ) -> AsyncGenerator:
+        def owned(conn):
+            rows = conn.execute(
+                "SELECT session_id FROM chat_sessions "
+                "WHERE session_id IN (SELECT value FROM json_each(:session_ids)) "
+                "AND api_key_hash = :api_key_hash",
+                {"session_ids": json.dumps(session_ids), "api_key_hash": api_key_hash},
+            ).fetchall()
+            return [row[0] for row in rows]
+
+        for session_id in await self.read(owned):
+            chat_history = await self.read(
+                lambda conn: self.read_messages(conn, session_id)
+            )
+            yield session_id, chat_history
+
+    async def get_messages(
+        self, session_id: str, offset: int = 0, limit: Optional[int] = None
+    ) -> Optional[Dict[str, Any]]:
+        def query(conn):
+            row = conn.execute(
+                "SELECT api_key_hash, message_count FROM chat_sessions "
+                "WHERE session_id = :session_id",
+                {"session_id": session_id},
+            ).fetchone()
+            if row is None:
+                return None
+            start, end = resolve_range(row[1], offset, limit)
+            return {
+                "api_key_hash": row[0],
+                "messages": self.read_messages(conn, session_id, start, end),
+                "offset": start,
+                "total": row[1],
+            }
+
+        return await self.read(query)
+
+    async def fork_session(
+        self, session_id: str, new_session_id: str, message_count: Optional[int]
+    ) -> Optional[int]:
+        def write(conn):
+            parent = conn.execute(
+                "SELECT api_key_hash, message_count, last_model FROM chat_sessions "
+                "WHERE session_id = :session_id",
+                {"session_id": session_id},
+            ).fetchone()
+            if parent is None:
+                return None
+            count = parent[1] if message_count is None else message_count
+            if count > parent[1]:
+                return None
+            now = datetime_to_micros(datetime.now(timezone.utc))
+            conn.execute(
+                "INSERT INTO chat_sessions (session_id, api_key_hash, created_at, "
+                "updated_at, message_count, last_model) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (new_session_id, parent[0], now, now, count, parent[2]),
+            )
+            conn.execute(
+                self.FORK_MESSAGES_SQL,
+                {
+                    "session_id": session_id,
+                    "new_session_id": new_session_id,
+                    "message_count": count,
+                },
+            )
+            return count
+
+        forked = await self.writer.submit(write)
+        if forked is not None:
+            metrics.incr("sessions_forked")
+        return forked
+
+    async def list_sessions(
+        self,
+        api_key_hash: str,
+        limit: int,
+        cursor: Optional[str] = None,
+        include_metadata: bool = False,
+    ) -> (List[Dict[str, Any]], Optional[str]):
+        cursor_updated_at, cursor_session_id = None, None
+        if cursor is not None:
+            cursor_updated_at, cursor_session_id = decode_session_cursor(cursor)
+            cursor_updated_at = datetime_to_micros(cursor_updated_at)
+
+        def query(conn):
+            return conn.execute(
+                self.LIST_SQL,
+                {
+                    "api_key_hash": api_key_hash,
+                    "cursor_updated_at": cursor_updated_at,
+                    "cursor_session_id": cursor_session_id,
+                    "limit": limit + 1,
+                },
+            ).fetchall()
+
+        rows = await self.read(query)
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_session_cursor(
+                micros_to_datetime(rows[-1][1]), rows[-1][0]
+            )
+        if not include_metadata:
+            return [{"session_id": row[0]} for row in rows], next_cursor
+        return [
+            {
+                "session_id": row[0],
+                "created_at": micros_to_datetime(row[2]).isoformat(),
+                "updated_at": micros_to_datetime(row[1]).isoformat(),
+                "message_count": row[3],
+                "last_model": row[4],
+            }
+            for row in rows
+        ], next_cursor
+
+    async def export_sessions(
+        self, session_ids: Optional[List[str]] = None
+    ) -> AsyncGenerator:
+        # export_fetch_size sessions per read, paged on session_id
+        def query(conn, after: str):
+            sessions = []
+            for row in conn.execute(
+                self.EXPORT_SQL,
+                {
+                    "after": after,
+                    "session_ids": (
+                        json.dumps(session_ids) if session_ids is not None else None
+                    ),
+                    "limit": self.export_fetch_size,
+                },
+            ).fetchall():
+                session = dict(zip(SESSION_EXPORT_COLUMNS, row))
+                session["created_at"] = micros_to_datetime(session["created_at"])
+                session["updated_at"] = micros_to_datetime(session["updated_at"])
+                messages = conn.execute(
+                    "SELECT message FROM chat_messages "
+                    "WHERE session_id = :session_id ORDER BY seq",
+                    {"session_id": session["session_id"]},
+                ).fetchall()
+                session["chat_history"] = (
+                    "[" + ", ".join(message[0] for message in messages) + "]"
+                )
+                sessions.append(session)
+            return sessions
+
+        after = ""
+        while True:
+            sessions = await self.read(lambda conn: query(conn, after))
+            for session in sessions:
+                yield session
+            if len(sessions) < self.export_fetch_size:
+                return
+            after = sessions[-1]["session_id"]
+
+    async def import_sessions(self, sessions: List[Dict[str, Any]]) -> int:
+        # Session IDs that already exist are skipped, as in SessionStore
+        def write(conn):
+            inserted = 0
+            for session in sessions:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO chat_sessions (session_id, api_key_hash, "
+                    "created_at, updated_at, message_count, last_model, version) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        session["session_id"],
+                        session["api_key_hash"],
+                        datetime_to_micros(session["created_at"]),
+                        datetime_to_micros(session["updated_at"]),
+                        session["message_count"],
+                        session["last_model"],
+                        session["version"],
+                    ),
+                )
+                if cursor.rowcount == 1:
+                    self.insert_messages(
+                        conn, session["session_id"], 0, session["chat_history"]
+                    )
+                    inserted += 1
+            return inserted
+
+        return await self.writer.submit(write)
+
+    async def get_summary(self, session_id: str) -> Optional[Dict[str, Any]]:
+        def query(conn):
+            return conn.execute(
+                "SELECT summary, covered_count FROM chat_session_summaries "
+                "WHERE session_id = :session_id",
+                {"session_id": session_id},
+            ).fetchone()
+
+        result = await self.read(query)
+        if result is None:
+            return None
+        return {"summary": result[0], "covered_count": result[1]}
+
+    async def save_summary(self, session_id: str, summary: str, covered_count: int):
+        await self.writer.submit(
+            lambda conn: conn.execute(
+                self.SAVE_SUMMARY_SQL,
+                {
+                    "session_id": session_id,
+                    "summary": summary,
+                    "covered_count": covered_count,
+                },
+            )
+        )
+
+    async def idle_sessions(
+        self, policy: str, params: Dict[str, Any], limit: int
+    ) -> List[Tuple[str, int]]:
+        # The reaper's candidates: (session_id, version) of the sessions matching
+        # policy not updated for params["ttl"] seconds
+        cutoff = datetime_to_micros(datetime.now(timezone.utc)) - int(
+            params["ttl"] * 1_000_000
+        )
+
+        def query(conn):
+            rows = conn.execute(
+                f"SELECT session_id, version FROM chat_sessions "
+                f"WHERE {policy} AND updated_at < :cutoff "
+                f"ORDER BY updated_at LIMIT :limit",
+                {**params, "cutoff": cutoff, "limit": limit},
+            ).fetchall()
+            return [(row[0], row[1]) for row in rows]
+
+        return await self.read(query)
+
+    async def delete_idle_sessions(self, sessions: List[Tuple[str, int]]) -> List[str]:
+        """
+        Deletes those of the (session_id, version) pairs idle_sessions returned that
+        are still at that version, with their messages and summaries. Returns the
+        deleted session IDs.
+        """
+
+        def write(conn):
+            rows = conn.execute(
+                "DELETE FROM chat_sessions WHERE (session_id, version) IN ("
+                "SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') "
+                "FROM json_each(:sessions)) RETURNING session_id",
+                {"sessions": json.dumps(sessions)},
+            ).fetchall()
+            deleted = [row[0] for row in rows]
+            for table_name in ("chat_messages", "chat_session_summaries"):
+                conn.execute(
+                    f"DELETE FROM {table_name} "
+                    "WHERE session_id IN (SELECT value FROM json_each(:session_ids))",
+                    {"session_ids": json.dumps(deleted)},
+                )
+            return deleted
+
+        return await self.writer.submit(write)
+
+    async def close(self):
+        await self.writer.close()
+        while True:
+            try:
+                self.readers.get_nowait().close()
+            except queue.Empty:
+                return
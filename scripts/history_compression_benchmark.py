@@ -0,0 +1,282 @@
+"""
+Bytes sent to and from the database and per-turn latency of "blob" mode chat
+history, stored as plain JSON text vs zstd compressed (CHAT_HISTORY_COMPRESSION_*),
+with and without a dictionary trained on chat history JSON.
+
+Runs concurrent conversations against the middleware database through the
+middleware's own blob session store, so it needs the same environment as the
+middleware (DATABASE_MIDDLEWARE_URL, ...). Each turn reads the session, appends a
+user message, part of which is a pasted document, and an assistant reply, and
+writes it back. The benchmark sessions are deleted at the end.
+
+    python scripts/history_compression_benchmark.py --sessions 20 --turns 30
+
+--save-dictionary writes the trained dictionary to a file that can be used as
+CHAT_HISTORY_COMPRESSION_DICTIONARY.
+"""
+
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+import click
+import zstandard
+from dotenv import load_dotenv
+from sqlalchemy import text
+from tabulate import tabulate
+
+load_dotenv()
+
+MIDDLEWARE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "middleware"
+)
+sys.path.insert(0, MIDDLEWARE_DIR)
+
+SIZE_SQL = """
+    SELECT
+        COALESCE(octet_length(chat_history), 0)
+            + COALESCE(octet_length(chat_history_compressed), 0)
+    FROM chat_sessions
+    WHERE session_id = :session_id
+    """
+
+
+def make_vocabulary(rng: random.Random, size: int = 3000) -> list:
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return [
+        "".join(rng.choice(letters) for _ in range(rng.randint(2, 10)))
+        for _ in range(size)
+    ]
+
+
+def make_text(rng: random.Random, vocabulary: list, size: int) -> str:
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(vocabulary)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+def make_turn(
+    rng: random.Random, vocabulary: list, document_bytes: int, turn: int
+) -> list:
+    user = make_text(rng, vocabulary, 200)
+    # Every few turns the user pastes a document
+    if turn % 3 == 0:
+        user += "\n\n" + make_text(rng, vocabulary, document_bytes)
+    return [
+        {"role": "user", "content": user},
+        {
+            "role": "assistant",
+            "content": make_text(rng, vocabulary, 800),
+            "model": "anthropic.claude-3-5-sonnet",
+        },
+    ]
+
+
+def train_dictionary(vocabulary: list, document_bytes: int, size: int) -> bytes:
+    # Trained on conversations generated apart from the benchmarked ones
+    rng = random.Random(1)
+    samples = []
+    for _ in range(200):
+        chat_history = []
+        for turn in range(rng.randint(1, 6)):
+            chat_history.extend(make_turn(rng, vocabulary, document_bytes, turn))
+        samples.append(json.dumps(chat_history).encode("utf-8"))
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+async def run_mode(
+    app, engine, table, codec, sessions, turns, concurrency, document_bytes
+) -> dict:
+    store = app.SessionStore(engine, table, codec)
+    vocabulary = make_vocabulary(random.Random(0))
+    prefix = f"benchmark-compression-{uuid.uuid4()}"
+    latencies = []
+    read_bytes = 0
+    written_bytes = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def stored_size(session_id: str) -> int:
+        async with engine.connect() as conn:
+            return (
+                await conn.execute(text(SIZE_SQL), {"session_id": session_id})
+            ).scalar()
+
+    async def conversation(index: int):
+        nonlocal read_bytes, written_bytes
+        rng = random.Random(index)
+        session_id = f"{prefix}-{index}"
+        async with semaphore:
+            await store.create_session(
+                session_id, make_turn(rng, vocabulary, document_bytes, 0), "benchmark"
+            )
+            size = await stored_size(session_id)
+            for turn in range(1, turns):
+                new_messages = make_turn(rng, vocabulary, document_bytes, turn)
+                start = time.perf_counter()
+                session = await store.get_session(session_id)
+                chat_history = session["chat_history"]
+                chat_history.extend(new_messages)
+                await store.update_chat_history(session_id, chat_history)
+                latencies.append((time.perf_counter() - start) * 1000)
+                # The turn read the previous history and wrote the new one
+                read_bytes += size
+                size = await stored_size(session_id)
+                written_bytes += size
+
+    try:
+        await asyncio.gather(*(conversation(i) for i in range(sessions)))
+        async with engine.connect() as conn:
+            total_size = (
+                await conn.execute(
+                    text(
+                        "SELECT COALESCE(sum(pg_column_size(chat_history)), 0) "
+                        "+ COALESCE(sum(pg_column_size(chat_history_compressed)), 0) "
+                        "FROM chat_sessions WHERE session_id LIKE :prefix"
+                    ),
+                    {"prefix": f"{prefix}-%"},
+                )
+            ).scalar()
+    finally:
+        async with engine.begin() as conn:
+            await conn.execute(
+                text("DELETE FROM chat_sessions WHERE session_id LIKE :prefix"),
+                {"prefix": f"{prefix}-%"},
+            )
+
+    latencies.sort()
+    return {
+        "turns": len(latencies),
+        "read_kb_per_turn": read_bytes / len(latencies) / 1024,
+        "written_kb_per_turn": written_bytes / len(latencies) / 1024,
+        "p50_ms": latencies[len(latencies) // 2],
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        "stored_mb": total_size / (1024 * 1024),
+    }
+
+
+async def benchmark(
+    sessions, turns, concurrency, document_bytes, min_bytes, level, dictionary
+):
+    # setup_database configures the event loop's thread limiter, so call it from
+    # inside the loop, as the middleware's lifespan does
+    import app
+
+    db_engine, table = app.setup_database()[:2]
+    engine = app.create_async_db_engine(db_engine)
+    modes = {
+        "text": app.HistoryCodec(),
+        f"zstd level {level}": app.HistoryCodec(min_bytes, level),
+        f"zstd level {level} + dictionary": app.HistoryCodec(
+            min_bytes, level, dictionary
+        ),
+    }
+    results = {}
+    try:
+        for mode, codec in modes.items():
+            click.echo(f"Running {sessions} conversations of {turns} turns: {mode}")
+            results[mode] = await run_mode(
+                app,
+                engine,
+                table,
+                codec,
+                sessions,
+                turns,
+                concurrency,
+                document_bytes,
+            )
+    finally:
+        await engine.dispose()
+    return results
+
+
+@click.command()
+@click.option("--sessions", default=20, help="Conversations to run.")
+@click.option("--turns", default=30, help="Turns per conversation.")
+@click.option("--concurrency", default=10, help="Conversations run at once.")
+@click.option(
+    "--document-bytes",
+    default=20000,
+    help="Size of the document pasted every third turn.",
+)
+@click.option(
+    "--min-bytes",
+    default=16384,
+    help="CHAT_HISTORY_COMPRESSION_MIN_BYTES of the compressed modes.",
+)
+@click.option("--level", default=3, help="zstd compression level.")
+@click.option(
+    "--dictionary-size", default=112640, help="Size of the trained dictionary."
+)
+@click.option(
+    "--dictionary",
+    "dictionary_path",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Use this dictionary instead of training one.",
+)
+@click.option(
+    "--save-dictionary",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write the trained dictionary to this file.",
+)
+def main(
+    sessions,
+    turns,
+    concurrency,
+    document_bytes,
+    min_bytes,
+    level,
+    dictionary_size,
+    dictionary_path,
+    save_dictionary,
+):
+    if dictionary_path:
+        with open(dictionary_path, "rb") as f:
+            dictionary = f.read()
+    else:
+        click.echo(f"Training a {dictionary_size} byte dictionary")
+        dictionary = train_dictionary(
+            make_vocabulary(random.Random(0)), document_bytes, dictionary_size
+        )
+        if save_dictionary:
+            with open(save_dictionary, "wb") as f:
+                f.write(dictionary)
+
+    results = asyncio.run(
+        benchmark(
+            sessions, turns, concurrency, document_bytes, min_bytes, level, dictionary
+        )
+    )
+    rows = [
+        [
+            mode,
+            result["turns"],
+            f"{result['read_kb_per_turn']:.1f}",
+            f"{result['written_kb_per_turn']:.1f}",
+            f"{result['p50_ms']:.2f}",
+            f"{result['p99_ms']:.2f}",
+            f"{result['stored_mb']:.2f}",
+        ]
+        for mode, result in results.items()
+    ]
+    headers = [
+        "Storage",
+        "Turns",
+        "Read (KB/turn)",
+        "Written (KB/turn)",
+        "p50 (ms)",
+        "p99 (ms)",
+        "Stored (MB)",
+    ]
+    click.echo(tabulate(rows, headers, tablefmt="grid"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Peak worker memory when serving one very large chat history from /chat-history,
+buffered (load the whole session, serialize it in one go) vs streamed (encode it
+incrementally from a server-side cursor).
+
+Runs against the middleware database directly, using the middleware's own session
+store, so it needs the same environment as the middleware (DATABASE_MIDDLEWARE_URL,
+CHAT_HISTORY_STORAGE, ...). Seeding and each mode run in fresh processes: Linux
+carries the peak RSS of a parent over into its children, so the parent stays small.
+
+    python scripts/history_memory_benchmark.py --messages 20000 --message-bytes 2000
+"""
+
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import uuid
+
+import click
+from dotenv import load_dotenv
+from sqlalchemy import text
+from tabulate import tabulate
+
+load_dotenv()
+
+MIDDLEWARE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "middleware"
+)
+sys.path.insert(0, MIDDLEWARE_DIR)
+
+MODES = ["buffered", "streamed"]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def open_store():
+    # setup_database configures the event loop's thread limiter, so call it from
+    # inside the loop, as the middleware's lifespan does
+    import app
+
+    (
+        app.db_engine,
+        app.chat_sessions,
+        app.chat_messages,
+        app.chat_message_contents,
+        app.chat_session_summaries,
+    ) = app.setup_database()
+    app.session_store = app.create_session_store(
+        app.create_db_store(app.create_async_db_engine(app.db_engine))
+    )
+    return app
+
+
+async def seed(messages: int, message_bytes: int) -> str:
+    app = await open_store()
+    session_id = f"benchmark-{uuid.uuid4()}"
+    chat_history = [
+        {
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": f"{i} " + "x" * message_bytes,
+        }
+        for i in range(messages)
+    ]
+    await app.session_store.create_session(session_id, chat_history, "benchmark")
+    await app.session_store.close()
+    return session_id
+
+
+async def cleanup(session_id: str):
+    app = await open_store()
+    with app.db_engine.begin() as conn:
+        for table in ("chat_messages", "chat_session_summaries", "chat_sessions"):
+            conn.execute(
+                text(f"DELETE FROM {table} WHERE session_id = :session_id"),
+                {"session_id": session_id},
+            )
+    await app.session_store.close()
+
+
+async def measure(mode: str, session_id: str) -> dict:
+    app = await open_store()
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    first_byte = None
+    body_bytes = 0
+    with open(os.devnull, "wb") as sink:
+        if mode == "buffered":
+            session_data = await app.get_session_data(session_id)
+            body = json.dumps(
+                {"messages": app.strip_stored_fields(session_data["chat_history"])}
+            ).encode("utf-8")
+            first_byte = time.perf_counter()
+            body_bytes = len(body)
+            sink.write(body)
+        else:
+            async for chunk in app.stream_history_json(session_id, bedrock=False):
+                if first_byte is None:
+                    first_byte = time.perf_counter()
+                body_bytes += len(chunk)
+                sink.write(chunk)
+    end = time.perf_counter()
+    await app.session_store.close()
+    return {
+        "baseline_mb": baseline,
+        "peak_mb": peak_rss_mb(),
+        "first_byte_s": first_byte - start,
+        "total_s": end - start,
+        "body_mb": body_bytes / (1024 * 1024),
+    }
+
+
+def run_child(*args) -> str:
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), *args],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return output.strip().splitlines()[-1]
+
+
+@click.command()
+@click.option("--messages", default=20000, help="Messages in the benchmark session.")
+@click.option("--message-bytes", default=2000, help="Content size of each message.")
+@click.option("--seed-only", is_flag=True, hidden=True)
+@click.option("--measure-mode", type=click.Choice(MODES), hidden=True)
+@click.option("--session-id", hidden=True)
+def main(messages, message_bytes, seed_only, measure_mode, session_id):
+    # Child processes report back on the last line of their output
+    if seed_only:
+        click.echo(asyncio.run(seed(messages, message_bytes)))
+        return
+    if measure_mode:
+        click.echo(json.dumps(asyncio.run(measure(measure_mode, session_id))))
+        return
+
+    click.echo(f"Seeding a session with {messages} messages of {message_bytes} bytes")
+    session_id = run_child(
+        "--seed-only",
+        "--messages",
+        str(messages),
+        "--message-bytes",
+        str(message_bytes),
+    )
+    rows = []
+    try:
+        for mode in MODES:
+            result = json.loads(
+                run_child("--measure-mode", mode, "--session-id", session_id)
+            )
+            rows.append(
+                [
+                    mode,
+                    f"{result['body_mb']:.1f}",
+                    f"{result['peak_mb']:.1f}",
+                    f"{result['peak_mb'] - result['baseline_mb']:.1f}",
+                    f"{result['first_byte_s']:.3f}",
+                    f"{result['total_s']:.3f}",
+                ]
+            )
+    finally:
+        asyncio.run(cleanup(session_id))
+
+    headers = [
+        "Mode",
+        "Body (MB)",
+        "Peak RSS (MB)",
+        "RSS growth (MB)",
+        "First byte (s)",
+        "Total (s)",
+    ]
+    click.echo(tabulate(rows, headers, tablefmt="grid"))
+
+
+if __name__ == "__main__":
+    main()
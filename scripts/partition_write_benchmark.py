@@ -0,0 +1,284 @@
+"""
+Write throughput of chat history turns against a plain chat_sessions-shaped table
+vs the same table hash-partitioned on session_id (CHAT_SESSIONS_PARTITIONS), under
+concurrent load.
+
+Creates two scratch tables next to chat_sessions in the middleware database, with
+the same columns and indexes, seeds both with the same sessions and runs the same
+mix of turn updates and new sessions against each. Needs the same environment as
+the middleware (DATABASE_MIDDLEWARE_URL, ...). The scratch tables are dropped at
+the end.
+
+    python scripts/partition_write_benchmark.py --sessions 200000 --concurrency 64
+"""
+
+import asyncio
+import os
+import random
+import sys
+import time
+import uuid
+
+import click
+from dotenv import load_dotenv
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+from tabulate import tabulate
+
+load_dotenv()
+
+MIDDLEWARE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "middleware"
+)
+sys.path.insert(0, MIDDLEWARE_DIR)
+
+TABLES = ["bench_sessions_single", "bench_sessions_partitioned"]
+
+COLUMNS_DDL = """
+    session_id VARCHAR PRIMARY KEY,
+    chat_history TEXT,
+    api_key_hash VARCHAR,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    message_count INTEGER,
+    last_model VARCHAR,
+    version BIGINT NOT NULL DEFAULT 0
+"""
+
+UPDATE_SQL = """
+    UPDATE {table}
+    SET chat_history = :chat_history,
+        updated_at = now(),
+        message_count = message_count + 2,
+        version = version + 1
+    WHERE session_id = :session_id
+"""
+
+INSERT_SQL = """
+    INSERT INTO {table} (session_id, chat_history, api_key_hash, message_count)
+    VALUES (:session_id, :chat_history, :api_key_hash, 2)
+"""
+
+
+async def create_table(conn, table: str, partitions: int):
+    await conn.execute(text(f"DROP TABLE IF EXISTS {table}"))
+    if table == "bench_sessions_partitioned":
+        await conn.execute(
+            text(f"CREATE TABLE {table} ({COLUMNS_DDL}) PARTITION BY HASH (session_id)")
+        )
+        for remainder in range(partitions):
+            await conn.execute(
+                text(
+                    f"CREATE TABLE {table}_p{remainder} PARTITION OF {table} "
+                    f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+                )
+            )
+    else:
+        await conn.execute(text(f"CREATE TABLE {table} ({COLUMNS_DDL})"))
+    # The secondary indexes chat_sessions has
+    await conn.execute(text(f"CREATE INDEX ON {table} (api_key_hash)"))
+    await conn.execute(
+        text(
+            f"CREATE INDEX ON {table} (api_key_hash, updated_at DESC, session_id DESC) "
+            "INCLUDE (created_at, message_count, last_model)"
+        )
+    )
+    await conn.execute(text(f"CREATE INDEX ON {table} (updated_at)"))
+
+
+async def seed(conn, table: str, sessions: int, keys: int, message_bytes: int):
+    await conn.execute(
+        text(f"""
+            INSERT INTO {table} (session_id, chat_history, api_key_hash, message_count)
+            SELECT
+                'seed-' || i,
+                repeat('x', :message_bytes),
+                'key-' || (i % :keys),
+                2
+            FROM generate_series(1, :sessions) AS i
+            """),
+        {"sessions": sessions, "keys": keys, "message_bytes": message_bytes},
+    )
+    await conn.execute(text(f"ANALYZE {table}"))
+
+
+async def run_load(
+    engine,
+    table: str,
+    sessions: int,
+    keys: int,
+    concurrency: int,
+    duration: float,
+    new_session_ratio: float,
+    message_bytes: int,
+) -> dict:
+    update_sql = text(UPDATE_SQL.format(table=table))
+    insert_sql = text(INSERT_SQL.format(table=table))
+    chat_history = "x" * message_bytes
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                async with engine.begin() as conn:
+                    if random.random() < new_session_ratio:
+                        await conn.execute(
+                            insert_sql,
+                            {
+                                "session_id": str(uuid.uuid4()),
+                                "chat_history": chat_history,
+                                "api_key_hash": f"key-{random.randrange(keys)}",
+                            },
+                        )
+                    else:
+                        await conn.execute(
+                            update_sql,
+                            {
+                                "session_id": f"seed-{random.randint(1, sessions)}",
+                                "chat_history": chat_history,
+                            },
+                        )
+                latencies.append((time.perf_counter() - start) * 1000)
+            except Exception as e:
+                errors += 1
+                print(f"{table}: {str(e)}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    async with engine.connect() as conn:
+        size = (
+            await conn.execute(
+                # pg_partition_tree has no rows for a table that isn't partitioned
+                text(
+                    "SELECT COALESCE("
+                    "(SELECT sum(pg_total_relation_size(relid)) "
+                    "FROM pg_partition_tree(CAST(:table AS regclass))), "
+                    "pg_total_relation_size(CAST(:table AS regclass)))"
+                ),
+                {"table": table},
+            )
+        ).scalar()
+    latencies.sort()
+    return {
+        "writes": len(latencies),
+        "errors": errors,
+        "writes_per_s": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] if latencies else 0,
+        "p99_ms": (
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            if latencies
+            else 0
+        ),
+        "size_mb": size / (1024 * 1024),
+    }
+
+
+async def benchmark(
+    sessions,
+    keys,
+    partitions,
+    concurrency,
+    duration,
+    new_session_ratio,
+    message_bytes,
+):
+    # setup_database configures the event loop's thread limiter, so call it from
+    # inside the loop, as the middleware's lifespan does
+    import app
+
+    db_engine = app.setup_database()[0]
+    engine = create_async_engine(
+        db_engine.url.set(drivername="postgresql+asyncpg"),
+        pool_size=concurrency,
+        max_overflow=0,
+    )
+    results = {}
+    try:
+        for table in TABLES:
+            click.echo(f"Seeding {table} with {sessions} sessions")
+            async with engine.begin() as conn:
+                await create_table(conn, table, partitions)
+                await seed(conn, table, sessions, keys, message_bytes)
+            click.echo(f"Running {concurrency} writers against {table} for {duration}s")
+            results[table] = await run_load(
+                engine,
+                table,
+                sessions,
+                keys,
+                concurrency,
+                duration,
+                new_session_ratio,
+                message_bytes,
+            )
+    finally:
+        async with engine.begin() as conn:
+            for table in TABLES:
+                await conn.execute(text(f"DROP TABLE IF EXISTS {table}"))
+        await engine.dispose()
+    return results
+
+
+@click.command()
+@click.option("--sessions", default=200000, help="Sessions seeded in each table.")
+@click.option("--keys", default=100, help="Distinct API key hashes.")
+@click.option("--partitions", default=16, help="Hash partitions of the second table.")
+@click.option("--concurrency", default=64, help="Concurrent writers.")
+@click.option("--duration", default=30.0, help="Seconds of load per table.")
+@click.option(
+    "--new-session-ratio",
+    default=0.1,
+    help="Share of writes that create a session rather than add a turn.",
+)
+@click.option("--message-bytes", default=2000, help="Size of the written history.")
+def main(
+    sessions,
+    keys,
+    partitions,
+    concurrency,
+    duration,
+    new_session_ratio,
+    message_bytes,
+):
+    results = asyncio.run(
+        benchmark(
+            sessions,
+            keys,
+            partitions,
+            concurrency,
+            duration,
+            new_session_ratio,
+            message_bytes,
+        )
+    )
+    rows = [
+        [
+            table,
+            result["writes"],
+            result["errors"],
+            f"{result['writes_per_s']:.0f}",
+            f"{result['p50_ms']:.2f}",
+            f"{result['p99_ms']:.2f}",
+            f"{result['size_mb']:.1f}",
+        ]
+        for table, result in results.items()
+    ]
+    headers = [
+        "Table",
+        "Writes",
+        "Errors",
+        "Writes/s",
+        "p50 (ms)",
+        "p99 (ms)",
+        "Size (MB)",
+    ]
+    click.echo(tabulate(rows, headers, tablefmt="grid"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Chat history turn throughput and latency of the embedded SQLite session store
+(CHAT_HISTORY_STORAGE=sqlite) vs a Postgres one, under concurrent conversations.
+
+Runs the same conversations through the middleware's own session stores. Each turn
+reads the session, appends a user message and an assistant reply, and writes it
+back; every few turns the conversation's recent messages are also read as a range,
+as /chat-history with offset does. The SQLite database is a scratch file, deleted at
+the end. The Postgres run needs the same environment as the middleware
+(DATABASE_MIDDLEWARE_URL, ...) and deletes its benchmark sessions at the end; skip
+it with --no-postgres to benchmark SQLite on a machine without a database.
+
+    python scripts/sqlite_backend_benchmark.py --sessions 200 --turns 20 --concurrency 64
+"""
+
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+import click
+from dotenv import load_dotenv
+from sqlalchemy import text
+from tabulate import tabulate
+
+load_dotenv()
+
+MIDDLEWARE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "middleware"
+)
+sys.path.insert(0, MIDDLEWARE_DIR)
+
+
+def make_turn(rng: random.Random, message_bytes: int) -> list:
+    return [
+        {"role": "user", "content": "x" * rng.randint(1, message_bytes)},
+        {
+            "role": "assistant",
+            "content": "y" * message_bytes,
+            "model": "anthropic.claude-3-5-sonnet",
+        },
+    ]
+
+
+async def run_store(
+    store, prefix: str, sessions: int, turns: int, concurrency: int, message_bytes: int
+) -> dict:
+    turn_latencies = []
+    read_latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def conversation(index: int):
+        rng = random.Random(index)
+        session_id = f"{prefix}-{index}"
+        async with semaphore:
+            await store.create_session(
+                session_id, make_turn(rng, message_bytes), "benchmark"
+            )
+            for turn in range(1, turns):
+                new_messages = make_turn(rng, message_bytes)
+                start = time.perf_counter()
+                session = await store.get_session(session_id)
+                chat_history = session["chat_history"]
+                chat_history.extend(new_messages)
+                await store.update_chat_history(session_id, chat_history)
+                turn_latencies.append((time.perf_counter() - start) * 1000)
+                if turn % 5 == 0:
+                    start = time.perf_counter()
+                    await store.get_messages(session_id, -10)
+                    read_latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(conversation(i) for i in range(sessions)))
+    elapsed = time.perf_counter() - start
+
+    turn_latencies.sort()
+    read_latencies.sort()
+    return {
+        "turns": len(turn_latencies),
+        "turns_per_s": len(turn_latencies) / elapsed,
+        "p50_ms": turn_latencies[len(turn_latencies) // 2],
+        "p99_ms": turn_latencies[
+            min(len(turn_latencies) - 1, int(len(turn_latencies) * 0.99))
+        ],
+        "read_p50_ms": read_latencies[len(read_latencies) // 2],
+    }
+
+
+async def run_sqlite(app, batch_size, read_threads, *args) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        store = app.SqliteSessionStore(
+            os.path.join(directory, "benchmark.db"), batch_size, read_threads
+        )
+        try:
+            return await run_store(store, "benchmark-sqlite", *args)
+        finally:
+            await store.close()
+
+
+async def run_postgres(app, storage, *args) -> dict:
+    # setup_database configures the event loop's thread limiter, so call it from
+    # inside the loop, as the middleware's lifespan does
+    (
+        app.db_engine,
+        app.chat_sessions,
+        app.chat_messages,
+        app.chat_message_contents,
+        app.chat_session_summaries,
+    ) = app.setup_database()
+    app.CHAT_HISTORY_STORAGE = storage
+    store = app.create_db_store(app.create_async_db_engine(app.db_engine))
+    prefix = f"benchmark-postgres-{uuid.uuid4()}"
+    try:
+        return await run_store(store, prefix, *args)
+    finally:
+        with app.db_engine.begin() as conn:
+            for table in ("chat_messages", "chat_sessions"):
+                conn.execute(
+                    text(f"DELETE FROM {table} WHERE session_id LIKE :prefix"),
+                    {"prefix": f"{prefix}-%"},
+                )
+        await store.close()
+
+
+async def benchmark(
+    sessions,
+    turns,
+    concurrency,
+    message_bytes,
+    batch_size,
+    read_threads,
+    postgres_storage,
+):
+    import app
+
+    workload = (sessions, turns, concurrency, message_bytes)
+    results = {}
+    click.echo(f"Running {sessions} conversations of {turns} turns: sqlite")
+    results["sqlite"] = await run_sqlite(app, batch_size, read_threads, *workload)
+    if postgres_storage:
+        click.echo(
+            f"Running {sessions} conversations of {turns} turns: "
+            f"postgres ({postgres_storage})"
+        )
+        results[f"postgres ({postgres_storage})"] = await run_postgres(
+            app, postgres_storage, *workload
+        )
+    return results
+
+
+@click.command()
+@click.option("--sessions", default=200, help="Conversations to run.")
+@click.option("--turns", default=20, help="Turns per conversation.")
+@click.option("--concurrency", default=64, help="Conversations run at once.")
+@click.option("--message-bytes", default=1000, help="Size of each reply.")
+@click.option(
+    "--batch-size", default=100, help="SQLITE_WRITE_MAX_BATCH_SIZE of the SQLite run."
+)
+@click.option(
+    "--read-threads", default=8, help="SQLITE_READ_THREADS of the SQLite run."
+)
+@click.option(
+    "--postgres-storage",
+    type=click.Choice(["blob", "messages", "jsonb"]),
+    default="messages",
+    help="CHAT_HISTORY_STORAGE of the Postgres run.",
+)
+@click.option("--no-postgres", is_flag=True, help="Only benchmark SQLite.")
+def main(
+    sessions,
+    turns,
+    concurrency,
+    message_bytes,
+    batch_size,
+    read_threads,
+    postgres_storage,
+    no_postgres,
+):
+    results = asyncio.run(
+        benchmark(
+            sessions,
+            turns,
+            concurrency,
+            message_bytes,
+            batch_size,
+            read_threads,
+            None if no_postgres else postgres_storage,
+        )
+    )
+    rows = [
+        [
+            backend,
+            result["turns"],
+            f"{result['turns_per_s']:.0f}",
+            f"{result['p50_ms']:.2f}",
+            f"{result['p99_ms']:.2f}",
+            f"{result['read_p50_ms']:.2f}",
+        ]
+        for backend, result in results.items()
+    ]
+    headers = [
+        "Backend",
+        "Turns",
+        "Turns/s",
+        "p50 (ms)",
+        "p99 (ms)",
+        "Range read p50 (ms)",
+    ]
+    click.echo(tabulate(rows, headers, tablefmt="grid"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import os
+import time
+import uuid
+from locust import HttpUser, LoadTestShape, task, between, events
+from dotenv import load_dotenv
+
+load_dotenv()
+
+base_url = os.getenv("API_ENDPOINT")
+api_key = os.getenv("API_KEY")
+model_id = os.getenv("MODEL_ID", "fake-openai-endpoint")
+
+# Number of users that never use chat history. They run for the whole test and
+# their latency is what we compare before and during the history spike.
+non_history_users = int(os.getenv("NON_HISTORY_USERS", "20"))
+history_spike_users = int(os.getenv("HISTORY_SPIKE_USERS", "200"))
+baseline_seconds = int(os.getenv("BASELINE_SECONDS", "60"))
+spike_seconds = int(os.getenv("SPIKE_SECONDS", "120"))
+
+NON_HISTORY_REQUEST_NAME = "/chat/completions [no history]"
+HISTORY_REQUEST_NAME = "/chat/completions [history]"
+
+test_start = None
+non_history_latencies = {"baseline": [], "spike": []}
+
+
+def current_phase():
+    if test_start is None:
+        return None
+    if time.time() - test_start < baseline_seconds:
+        return "baseline"
+    return "spike"
+
+
+def p99(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+
+@events.test_start.add_listener
+def on_test_start(environment, **kwargs):
+    global test_start
+    test_start = time.time()
+
+
+@events.request.add_listener
+def on_request(name, response_time, exception, **kwargs):
+    phase = current_phase()
+    if name == NON_HISTORY_REQUEST_NAME and phase and exception is None:
+        non_history_latencies[phase].append(response_time)
+
+
+@events.quitting.add_listener
+def on_quitting(environment, **kwargs):
+    baseline_p99 = p99(non_history_latencies["baseline"])
+    spike_p99 = p99(non_history_latencies["spike"])
+    print(
+        f"non-history p99 baseline: {baseline_p99} ms "
+        f"({len(non_history_latencies['baseline'])} requests)"
+    )
+    print(
+        f"non-history p99 during history spike: {spike_p99} ms "
+        f"({len(non_history_latencies['spike'])} requests)"
+    )
+
+
+class NonHistoryUser(HttpUser):
+    host = base_url
+    fixed_count = non_history_users
+    wait_time = between(0.5, 1)
+
+    @task
+    def completion_without_history(self):
+        payload = {
+            "model": model_id,
+            "messages": [{"role": "user", "content": f"{uuid.uuid4()} Say hello."}],
+        }
+        self.client.post(
+            "/chat/completions", json=payload, name=NON_HISTORY_REQUEST_NAME
+        )
+
+    def on_start(self):
+        self.client.headers.update({"Authorization": f"Bearer {api_key}"})
+
+
+class HistoryUser(HttpUser):
+    host = base_url
+    wait_time = between(0.1, 0.5)
+
+    @task
+    def completion_with_history(self):
+        payload = {
+            "model": model_id,
+            "messages": [
+                {"role": "user", "content": f"{uuid.uuid4()} Continue the story."}
+            ],
+        }
+        if self.session_id:
+            payload["session_id"] = self.session_id
+        else:
+            payload["enable_history"] = True
+        response = self.client.post(
+            "/chat/completions", json=payload, name=HISTORY_REQUEST_NAME
+        )
+        if response.status_code == 200 and not self.session_id:
+            self.session_id = response.json().get("session_id")
+
+    def on_start(self):
+        self.session_id = None
+        self.client.headers.update({"Authorization": f"Bearer {api_key}"})
+
+
+class HistorySpikeShape(LoadTestShape):
+    """
+    Runs only the non-history users for the baseline phase, then adds a spike of
+    history users on top of them. Compare the two p99 values printed at the end.
+    """
+
+    def tick(self):
+        run_time = self.get_run_time()
+        if run_time < baseline_seconds:
+            return (non_history_users, non_history_users)
+        if run_time < baseline_seconds + spike_seconds:
+            total_users = non_history_users + history_spike_users
+            return (total_users, history_spike_users)
+        return None
@@ -0,0 +1,170 @@
+"""
+Session expiry (SESSION_TTL_SECONDS) on the SQLite session store, with moto standing
+in for the S3 archive bucket and fakeredis for the Redis session tier: idle sessions
+are archived and then deleted, a failed upload keeps them, a session written while
+its batch is archived is kept, and reaped sessions leave Redis too.
+
+    pytest tests/session_reaper_test_file.py
+"""
+
+import gzip
+import json
+import os
+import sqlite3
+import sys
+
+import boto3
+import fakeredis
+import pytest
+import pytest_asyncio
+from moto import mock_aws
+
+MIDDLEWARE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "middleware"
+)
+sys.path.insert(0, MIDDLEWARE_DIR)
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import app  # noqa: E402
+
+BUCKET = "session-archive"
+
+
+def message(content: str):
+    return {"role": "user", "content": content}
+
+
+@pytest.fixture
+def archive_bucket(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setattr(app, "SESSION_TTL_SECONDS", 3600)
+    monkeypatch.setattr(app, "SESSION_TTL_BY_KEY", {})
+    monkeypatch.setattr(app, "SESSION_ARCHIVE_BUCKET", BUCKET)
+    monkeypatch.setattr(app, "SESSION_ARCHIVE_ENDPOINT_URL", None)
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket=BUCKET)
+        yield s3
+
+
+@pytest_asyncio.fixture
+async def db_store(tmp_path, monkeypatch):
+    path = os.path.join(str(tmp_path), "sessions.db")
+    monkeypatch.setattr(app, "SQLITE_DATABASE_PATH", path)
+    store = app.SqliteSessionStore(path, 100, 2)
+    yield store
+    await store.close()
+
+
+def make_idle(store, *session_ids):
+    # Last written at the epoch, far past any TTL
+    with sqlite3.connect(store.path) as conn:
+        conn.executemany(
+            "UPDATE chat_sessions SET updated_at = 0 WHERE session_id = ?",
+            [(session_id,) for session_id in session_ids],
+        )
+
+
+async def reap(reaper):
+    for policy, params in reaper.policies():
+        await reaper.reap_batch(policy, params)
+
+
+def archived_sessions(s3):
+    sessions = []
+    for obj in s3.list_objects_v2(Bucket=BUCKET).get("Contents", []):
+        body = s3.get_object(Bucket=BUCKET, Key=obj["Key"])["Body"].read()
+        sessions.extend(json.loads(line) for line in gzip.decompress(body).splitlines())
+    return sessions
+
+
+@pytest.mark.asyncio
+async def test_idle_sessions_are_archived_then_deleted(archive_bucket, db_store):
+    for session_id in ("idle-1", "idle-2", "active"):
+        await db_store.create_session(session_id, [message(session_id)], "key")
+    make_idle(db_store, "idle-1", "idle-2")
+
+    await reap(app.SqliteSessionReaper(db_store))
+
+    archived = archived_sessions(archive_bucket)
+    assert sorted(session["session_id"] for session in archived) == [
+        "idle-1",
+        "idle-2",
+    ]
+    assert all(session["api_key_hash"] == "key" for session in archived)
+    assert await db_store.get_session("idle-1") is None
+    assert await db_store.get_session("idle-2") is None
+    assert await db_store.get_session("active") is not None
+
+
+@pytest.mark.asyncio
+async def test_failed_upload_keeps_the_sessions(archive_bucket, db_store):
+    await db_store.create_session("idle", [message("idle")], "key")
+    make_idle(db_store, "idle")
+    archive_bucket.delete_bucket(Bucket=BUCKET)
+
+    with pytest.raises(Exception):
+        await reap(app.SqliteSessionReaper(db_store))
+    assert await db_store.get_session("idle") is not None
+
+
+@pytest.mark.asyncio
+async def test_session_written_during_archive_is_kept(archive_bucket, db_store):
+    for session_id in ("idle", "resumed"):
+        await db_store.create_session(session_id, [message(session_id)], "key")
+    make_idle(db_store, "idle", "resumed")
+    reaper = app.SqliteSessionReaper(db_store)
+    archive = reaper.archive
+
+    async def archive_while_resumed(session_ids):
+        # A turn lands between picking the batch and deleting it
+        await archive(session_ids)
+        chat_history = (await db_store.get_session("resumed"))["chat_history"]
+        chat_history.append(message("again"))
+        await db_store.update_chat_history("resumed", chat_history)
+
+    reaper.archive = archive_while_resumed
+    await reap(reaper)
+
+    assert await db_store.get_session("idle") is None
+    resumed = await db_store.get_session("resumed")
+    assert [m["content"] for m in resumed["chat_history"]] == ["resumed", "again"]
+
+
+@pytest.mark.asyncio
+async def test_reaped_sessions_leave_redis(archive_bucket, db_store):
+    redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    store = app.RedisSessionStore(db_store, redis_client)
+    for session_id in ("flushed", "dirty"):
+        await db_store.create_session(session_id, [message(session_id)], "key")
+        await store.get_session(session_id)
+    # "dirty" has a turn that is only in Redis so far
+    chat_history = (await store.get_session("dirty"))["chat_history"]
+    chat_history.append(message("unflushed"))
+    await store.update_chat_history("dirty", chat_history)
+    make_idle(db_store, "flushed", "dirty")
+
+    await reap(app.SqliteSessionReaper(store))
+
+    assert [s["session_id"] for s in archived_sessions(archive_bucket)] == ["flushed"]
+    assert await db_store.get_session("flushed") is None
+    assert not await redis_client.exists(
+        store.meta_key("flushed"), store.messages_key("flushed")
+    )
+    assert await store.get_session("flushed") is None
+    assert await redis_client.sismember(store.DIRTY_KEY, "dirty")
+    chat_history = (await store.get_session("dirty"))["chat_history"]
+    assert [m["content"] for m in chat_history] == ["dirty", "unflushed"]
+    await redis_client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_one_worker_reaps_at_a_time(db_store):
+    first, second = app.SqliteSessionReaper(db_store), app.SqliteSessionReaper(db_store)
+    async with first.lease() as leased:
+        assert leased
+        async with second.lease() as also_leased:
+            assert not also_leased
+    async with second.lease() as leased:
+        assert leased
@@ -0,0 +1,164 @@
+"""
+The Redis session tier (SESSION_REDIS_ENABLED) over a SQLite session store, with
+fakeredis standing in for Redis: loading sessions, appending turns, flushing them to
+the database, and turns whose session was evicted from Redis before they were
+written.
+
+    pytest tests/session_redis_tier_test_file.py
+"""
+
+import os
+import sys
+
+import fakeredis
+import pytest
+import pytest_asyncio
+
+MIDDLEWARE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "middleware"
+)
+sys.path.insert(0, MIDDLEWARE_DIR)
+
+from middleware_metrics import metrics  # noqa: E402
+from session_store import RedisSessionStore, SqliteSessionStore  # noqa: E402
+
+
+def message(i: int):
+    return {"role": "user" if i % 2 == 0 else "assistant", "content": f"m{i}"}
+
+
+def contents(chat_history):
+    return [m["content"] for m in chat_history]
+
+
+@pytest_asyncio.fixture
+async def stores(tmp_path):
+    db = SqliteSessionStore(os.path.join(str(tmp_path), "sessions.db"), 100, 2)
+    redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    store = RedisSessionStore(db, redis_client, ttl=60)
+    yield store, db, redis_client
+    await store.close()
+
+
+async def append_turn(store, session_id: str, *messages):
+    chat_history = (await store.get_session(session_id))["chat_history"]
+    chat_history.extend(messages)
+    await store.update_chat_history(session_id, chat_history)
+    return chat_history
+
+
+async def evict(store, redis_client, session_id: str):
+    await redis_client.delete(
+        store.meta_key(session_id), store.messages_key(session_id)
+    )
+
+
+@pytest.mark.asyncio
+async def test_load_copies_the_session_into_redis(stores):
+    store, db, redis_client = stores
+    await db.create_session("s1", [message(0), message(1)], "key")
+
+    session = await store.get_session("s1")
+    assert contents(session["chat_history"]) == ["m0", "m1"]
+    assert await redis_client.hget(store.meta_key("s1"), "persisted_count") == "2"
+    assert await redis_client.ttl(store.meta_key("s1")) > 0
+
+    # Served from Redis now, with the owner and where a new turn starts
+    hits = metrics.counters["session_redis_hits"]
+    session = await store.get_session("s1")
+    assert metrics.counters["session_redis_hits"] == hits + 1
+    assert session["api_key_hash"] == "key"
+    assert contents(session["chat_history"]) == ["m0", "m1"]
+    assert session["chat_history"].stored_count == 2
+
+
+@pytest.mark.asyncio
+async def test_append_stays_in_redis_until_flushed(stores):
+    store, db, redis_client = stores
+    await db.create_session("s1", [message(0), message(1)], "key")
+    await append_turn(store, "s1", message(2), message(3))
+
+    assert contents((await db.get_session("s1"))["chat_history"]) == ["m0", "m1"]
+    assert await redis_client.sismember(store.DIRTY_KEY, "s1")
+    # A dirty session has no TTL, so it can't be evicted before it is flushed
+    assert await redis_client.ttl(store.meta_key("s1")) == -1
+    assert await redis_client.ttl(store.messages_key("s1")) == -1
+
+    assert await store.flush_dirty() == 1
+    assert contents((await db.get_session("s1"))["chat_history"]) == [
+        "m0",
+        "m1",
+        "m2",
+        "m3",
+    ]
+    assert not await redis_client.sismember(store.DIRTY_KEY, "s1")
+    assert await redis_client.hget(store.meta_key("s1"), "persisted_count") == "4"
+    assert await redis_client.ttl(store.meta_key("s1")) > 0
+
+
+@pytest.mark.asyncio
+async def test_flush_creates_a_new_session(stores):
+    store, db, redis_client = stores
+    await store.create_session("s1", [message(0)], "key")
+    await append_turn(store, "s1", message(1))
+    assert await db.get_session("s1") is None
+
+    await store.flush_dirty()
+    session = await db.get_session("s1")
+    assert session["api_key_hash"] == "key"
+    assert contents(session["chat_history"]) == ["m0", "m1"]
+
+
+@pytest.mark.asyncio
+async def test_evicted_new_session_is_created_by_the_write(stores):
+    store, db, redis_client = stores
+    await store.create_session("s1", [message(0)], "key")
+    chat_history = (await store.get_session("s1"))["chat_history"]
+    chat_history.append(message(1))
+    await evict(store, redis_client, "s1")
+
+    await store.update_chat_history("s1", chat_history)
+    session = await db.get_session("s1")
+    assert session["api_key_hash"] == "key"
+    assert contents(session["chat_history"]) == ["m0", "m1"]
+
+
+@pytest.mark.asyncio
+async def test_evicted_write_keeps_the_unflushed_turns_it_read(stores):
+    store, db, redis_client = stores
+    await db.create_session("s1", [message(0), message(1)], "key")
+    await append_turn(store, "s1", message(2), message(3))
+    chat_history = (await store.get_session("s1"))["chat_history"]
+    chat_history.append(message(4))
+    await evict(store, redis_client, "s1")
+
+    await store.update_chat_history("s1", chat_history)
+    assert contents((await db.get_session("s1"))["chat_history"]) == [
+        "m0",
+        "m1",
+        "m2",
+        "m3",
+        "m4",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_evicted_write_goes_after_a_turn_persisted_since_it_read(stores):
+    store, db, redis_client = stores
+    await db.create_session("s1", [message(0), message(1)], "key")
+    chat_history = (await store.get_session("s1"))["chat_history"]
+    # Another turn lands in the database, and the session leaves Redis
+    other = (await db.get_session("s1"))["chat_history"]
+    other.extend([message(2), message(3)])
+    await db.update_chat_history("s1", other)
+    await evict(store, redis_client, "s1")
+
+    chat_history.append({"role": "user", "content": "late"})
+    await store.update_chat_history("s1", chat_history)
+    assert contents((await db.get_session("s1"))["chat_history"]) == [
+        "m0",
+        "m1",
+        "m2",
+        "m3",
+        "late",
+    ]
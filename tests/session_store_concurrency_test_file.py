@@ -0,0 +1,165 @@
+"""
+Two turns written concurrently to the same session, in every storage mode, with and
+without group commit, deferred writes and the session cache. Both turns must be
+stored, each one whole and after everything that was stored when it was written. A
+turn written inline must leave its caller holding what it stored, and the next read
+through the cache must see the stored row.
+
+The SQLite runs need nothing but a scratch directory. The Postgres modes (blob,
+messages, jsonb) run against the middleware database of DATABASE_MIDDLEWARE_URL and
+are skipped when it is not set.
+
+    pytest tests/session_store_concurrency_test_file.py
+"""
+
+import asyncio
+import os
+import sys
+import uuid
+
+import pytest
+from sqlalchemy import text
+
+MIDDLEWARE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "middleware"
+)
+sys.path.insert(0, MIDDLEWARE_DIR)
+
+from session_store import (  # noqa: E402
+    BatchingSessionStore,
+    CachedSessionStore,
+    DeferredHistoryStore,
+    HistoryWriter,
+    JsonbSessionStore,
+    MessageTableSessionStore,
+    SessionCache,
+    SessionStore,
+    SqliteSessionStore,
+)
+
+STORAGE_MODES = ["sqlite", "blob", "messages", "jsonb"]
+# "deferred-batched" is HISTORY_DURABILITY=async-batched
+TIERS = ["sync", "group-commit", "deferred", "deferred-batched"]
+DEFERRED_TIERS = ("deferred", "deferred-batched")
+
+
+def postgres_tables():
+    if not os.environ.get("DATABASE_MIDDLEWARE_URL"):
+        pytest.skip("DATABASE_MIDDLEWARE_URL is not set")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    import app
+
+    if app.db_engine is None:
+        (
+            app.db_engine,
+            app.chat_sessions,
+            app.chat_messages,
+            app.chat_message_contents,
+            app.chat_session_summaries,
+        ) = app.setup_database()
+    return app
+
+
+def create_db_store(storage: str, directory: str):
+    if storage == "sqlite":
+        return SqliteSessionStore(os.path.join(directory, "sessions.db"), 100, 4)
+    app = postgres_tables()
+    engine = app.create_async_db_engine(app.db_engine)
+    if storage == "messages":
+        return MessageTableSessionStore(
+            engine, app.chat_sessions, app.chat_messages, app.chat_message_contents
+        )
+    if storage == "jsonb":
+        return JsonbSessionStore(engine, app.chat_sessions)
+    return SessionStore(engine, app.chat_sessions)
+
+
+def delete_postgres_session(session_id: str):
+    app = postgres_tables()
+    with app.db_engine.begin() as conn:
+        for table in ("chat_messages", "chat_sessions"):
+            conn.execute(
+                text(f"DELETE FROM {table} WHERE session_id = :session_id"),
+                {"session_id": session_id},
+            )
+
+
+def create_store(db_store, tier: str, cached: bool):
+    # The tiers in the order create_session_store stacks them
+    store = db_store
+    if tier in ("group-commit", "deferred-batched"):
+        writer = HistoryWriter(store, 100, 5)
+        writer.start()
+        store = BatchingSessionStore(store, writer)
+    if cached:
+        store = CachedSessionStore(store, SessionCache(1 << 20, 60))
+    if tier in DEFERRED_TIERS:
+        store = DeferredHistoryStore(store, 1000, 3)
+    return store
+
+
+def message(role: str, content: str):
+    return {"role": role, "content": content}
+
+
+async def run_turn(store, session_id: str, name: str, both_loaded: asyncio.Barrier):
+    session = await store.get_session(session_id)
+    # Neither turn writes before both have read the session
+    await both_loaded.wait()
+    chat_history = session["chat_history"]
+    chat_history.extend(
+        [message("user", f"{name} question"), message("assistant", f"{name} answer")]
+    )
+    await store.update_chat_history(session_id, chat_history)
+    return chat_history
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("cached", [False, True], ids=["uncached", "cached"])
+@pytest.mark.parametrize("tier", TIERS)
+@pytest.mark.parametrize("storage", STORAGE_MODES)
+async def test_concurrent_turns_are_both_stored_in_order(
+    storage, tier, cached, tmp_path
+):
+    db_store = create_db_store(storage, str(tmp_path))
+    store = create_store(db_store, tier, cached)
+    session_id = f"test-concurrent-{uuid.uuid4()}"
+    first_turn = [message("user", "hello"), message("assistant", "hi")]
+    try:
+        await store.create_session(session_id, first_turn, "test-key")
+        both_loaded = asyncio.Barrier(2)
+        written = await asyncio.gather(
+            run_turn(store, session_id, "a", both_loaded),
+            run_turn(store, session_id, "b", both_loaded),
+        )
+        # The next turn's read goes through every tier; the row is read directly
+        next_read = (await store.get_session(session_id))["chat_history"]
+        stored = (await db_store.get_session(session_id))["chat_history"]
+    finally:
+        await store.close()
+        if storage != "sqlite":
+            delete_postgres_session(session_id)
+
+    turns = {
+        name: [
+            message("user", f"{name} question"),
+            message("assistant", f"{name} answer"),
+        ]
+        for name in ("a", "b")
+    }
+    assert stored[:2] == first_turn
+    assert stored[2:] in (turns["a"] + turns["b"], turns["b"] + turns["a"])
+    assert next_read == stored
+    for name, chat_history in zip(("a", "b"), written):
+        assert chat_history.stored_count == len(chat_history)
+        if tier in DEFERRED_TIERS:
+            # The write lands after update_chat_history returns
+            assert chat_history == first_turn + turns[name]
+        else:
+            # What was stored as of this turn's write: rebased onto the other turn
+            # if that one was stored first, or merged with it by group commit
+            assert chat_history == stored[: len(chat_history)]
+            own_turn = stored.index(turns[name][0])
+            assert chat_history[own_turn : own_turn + 2] == turns[name]
+    if tier not in DEFERRED_TIERS:
+        assert stored in written